@@ -1,29 +1,62 @@
+import argparse
+
 import base64
 
+import calendar
+
+import copy
+
+import functools
+
 import hashlib
 
+import heapq
+
 import hmac
 
 import html as html_mod
 
 import json
 
+import multiprocessing
+
 import os
 
+import queue
+
 import random
 
 import re
 
+import socket
+
 import sys
 
 import io
 
+import threading
+
 import time
 
+import uuid
+
+from urllib.parse import quote
+
 from datetime import datetime, timedelta, timezone
 
+from collections import deque
+
+from concurrent.futures import ThreadPoolExecutor
+
+from contextlib import contextmanager, nullcontext
+
 from dataclasses import dataclass
 
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - non-POSIX runners
+    fcntl = None
+
 
 
 import requests
@@ -48,18 +81,80 @@ PUSH_66_REMAINING_FRACTION = 0.66
 
 PUSH_33_REMAINING_FRACTION = 0.33
 
+# Longest a profile may go unvisited in `--scan due` mode.  Bounds how stale
+# RevenueCat verification and downgrade checks can get for idle profiles.
+NEXT_ACTION_MAX_DEFER = timedelta(hours=24)
+
 FCM_SCOPE = "https://www.googleapis.com/auth/firebase.messaging"
 
 PAGE_SIZE = 1000
 
 PROFILE_BATCH_SIZE = 200
 
+# Adaptive profile batch bounds (BatchSizer).  The upper bound matches the
+# PostgREST max-rows cap, so PAGE_SIZE itself stays fixed.
+PROFILE_BATCH_MIN_SIZE = 50
+
+PROFILE_BATCH_MAX_SIZE = PAGE_SIZE
+
+PROFILE_BATCH_TARGET_SECONDS = 1.0  # grow while a page comes back faster than this
+
+PROFILE_BATCH_MAX_PAYLOAD_BYTES = 4 * 1024 * 1024  # shrink once a page is larger than this
+
+# Encoded length budget for one `in.(...)` filter value; longer id lists are
+# split across requests so URLs stay under common proxy limits (8 KiB).
+IN_FILTER_MAX_URL_CHARS = 4000
+
 PROFILE_SELECT_FIELDS = (
     "id,email,sender_name,status,subscription_status,last_check_in,timer_days,"
     "hmac_key_encrypted,warning_sent_at,push_66_sent_at,push_33_sent_at,"
     "selected_theme,selected_soul_fire,created_at,downgrade_email_pending,app_mode"
 )
 
+# Due-index column (sql_67).  Only `--scan due` selects it, and only rows that
+# carry it get a fresh value written back after processing.
+NEXT_ACTION_COLUMN = "next_action_at"
+
+# Contact and key material: only needed for users who get a push, an email
+# or a delivery, so the profile scan leaves them out and
+# load_profile_contacts fetches them for the profiles being processed.
+PROFILE_CONTACT_FIELDS = ("email", "sender_name", "hmac_key_encrypted")
+
+PROFILE_SCAN_SELECT_FIELDS = ",".join(
+    column for column in PROFILE_SELECT_FIELDS.split(",") if column not in PROFILE_CONTACT_FIELDS
+)
+
+ENTRY_SELECT_FIELDS = (
+    "id,user_id,title,action_type,data_type,status,payload_encrypted,"
+    "recipient_email_encrypted,data_key_encrypted,hmac_signature,audio_file_path,"
+    "is_zero_knowledge,scheduled_at,grace_until,entry_mode,last_sent_year"
+)
+
+# Heavy per-entry columns, only needed for entries actually being delivered.
+ENTRY_CIPHERTEXT_FIELDS = (
+    "payload_encrypted",
+    "recipient_email_encrypted",
+    "data_key_encrypted",
+    "hmac_signature",
+)
+
+# What the profile scan loads for classification; ciphertext comes later
+# via load_entry_ciphertexts for due entries only.
+ENTRY_METADATA_SELECT_FIELDS = ",".join(
+    column for column in ENTRY_SELECT_FIELDS.split(",") if column not in ENTRY_CIPHERTEXT_FIELDS
+)
+
+ENTRY_CIPHERTEXT_CHUNK_SIZE = 100  # ids per bulk ciphertext request (keeps the URL short)
+
+DECRYPT_POOL_MIN_VALUES = 64  # fewer ciphertexts than this are decrypted inline, in entry order
+
+DECRYPT_POOL_WORKERS = 4  # AES-GCM releases the GIL, so these use separate cores
+
+# Profiles plus their entries in one request (PostgREST resource embedding).
+PROFILE_WITH_ENTRIES_SELECT_FIELDS = (
+    f"{PROFILE_SCAN_SELECT_FIELDS},vault_entries({ENTRY_METADATA_SELECT_FIELDS})"
+)
+
 REQUEST_TIMEOUT_SECONDS = 30
 
 HTTP_RETRY_DELAYS_SECONDS = (1, 3, 8)
@@ -72,6 +167,48 @@ MAX_RUNTIME_SECONDS = 5.5 * 3600  # 5h30m — exit gracefully before GH Actions
 
 RESEND_INTER_CHUNK_DELAY = 0.15  # seconds between batch chunks to respect rate limits
 
+RESEND_MAX_CONCURRENT_REQUESTS = 2  # Resend default rate limit is 2 req/s per team
+
+RESEND_MIN_REQUEST_INTERVAL = 0.5  # seconds between Resend request starts — keeps us under 2 req/s
+
+PROFILE_CONCURRENCY = 8  # users processed in parallel (HEARTBEAT_PROFILE_CONCURRENCY overrides)
+
+USER_ENTRY_CAP = 500  # entries delivered per user per run, 0 = no cap (HEARTBEAT_USER_ENTRY_CAP overrides)
+
+PROFILE_PREFETCH_BATCHES = 1  # batches fetched ahead of processing (HEARTBEAT_PREFETCH_BATCHES overrides)
+
+PROFILE_PREFETCH_MAX_BATCHES = 2
+
+# Work classes for the profile work queue, most urgent first.  A user is
+# filed under the most urgent class of work it has this run.
+WORK_DELIVERY = 0  # expired vault, due Forever Letter or Time Capsule entry
+WORK_NOTIFICATION = 1  # 66% / 33% push, 24h warning email
+WORK_SUBSCRIPTION = 2  # RevenueCat verification, downgrade
+WORK_MAINTENANCE = 3  # next_action_at refresh and other bookkeeping
+
+WORK_CLASS_NAMES = ("delivery", "notification", "subscription", "maintenance")
+
+WORK_QUEUE_MAX_PENDING = 400  # lower-class users held back before they are forced through
+
+# Runtime budget planner (RuntimePlanner).  Optional passes are shed, in
+# this order of appearance during a run, when the remaining work is
+# projected not to fit the budget.
+OPTIONAL_PASSES = ("heal_guards", "rc_verification", "push_66", "bot_cleanup")
+
+PLANNER_EWMA_ALPHA = 0.3  # weight of the newest measurement in each cost average
+
+PLANNER_POST_PASS_RESERVE_SECONDS = 120  # grace-period letters, cleanup and the run summary
+
+PLANNER_PRESSURE_FRACTION = 0.9  # previous run used this much of the budget → skip startup heal guards
+
+LEASE_TTL_SECONDS = 300  # shard lease expiry; renewed after every profile batch
+
+LEASE_COMPLETED_HOLD_SECONDS = 600  # keep a finished shard leased so peers skip it this cycle
+
+LEASE_RENEW_INTERVAL_SECONDS = 60  # background renewal while a leased shard is being processed
+
+MAINTENANCE_LEASE_TTL_SECONDS = 1800  # startup / closing passes run on one leasing runner at a time
+
 REVENUECAT_ENTITLEMENT_ID = "AfterWord Pro"
 
 RC_VERIFY_RATE_LIMIT_DELAY = 1.1  # seconds between RC API calls — RC V1 limit is ~60 req/min
@@ -81,8 +218,15 @@ RC_429_BACKOFF_SECONDS = 30       # pause when RC returns 429 (rate limited)
 FREE_THEMES = frozenset({"oledVoid", "midnightFrost", "shadowRose", None})
 FREE_SOUL_FIRES = frozenset({"etherealOrb", "goldenPulse", "nebulaHeart", None})
 
-_HTTP_SESSION: requests.Session | None = None
+_http_local = threading.local()  # one requests.Session per worker thread
 _resend_quota_exhausted = False  # set True when Resend daily limit (100/day free) is hit
+_resend_request_slots = threading.BoundedSemaphore(RESEND_MAX_CONCURRENT_REQUESTS)
+_resend_throttle_lock = threading.Lock()
+_resend_next_call_at = 0.0  # time.monotonic() before which the next Resend call must wait
+_resend_call_interval = RESEND_MIN_REQUEST_INTERVAL
+_rc_throttle_lock = threading.Lock()
+_rc_next_call_at = 0.0  # time.monotonic() before which the next RC call must wait
+_rc_call_interval = RC_VERIFY_RATE_LIMIT_DELAY  # scaled up per shard in --workers mode
 
 # ── Stdout capture (tee to buffer + real stdout) ──
 class _TeeWriter:
@@ -101,6 +245,10 @@ class _TeeWriter:
     def getvalue(self):
         return self._buffer.getvalue()
 
+    def capture(self, s):
+        """Append to the captured log without echoing (already printed elsewhere)."""
+        self._buffer.write(s)
+
 _log_buffer: _TeeWriter | None = None
 
 # ── Heartbeat run metrics (populated during execution, stored in DB at end) ──
@@ -119,9 +267,13 @@ _metrics = {
     "rc_verifications": 0,
     "errors": [],
     "warnings": [],
+    **{f"deferred_{name}": 0 for name in OPTIONAL_PASSES},
 }
 
 
+_metrics_lock = threading.Lock()  # guards _metrics when users run concurrently
+
+
 def _reset_metrics():
     """Reset all metrics for a fresh heartbeat run."""
     _metrics["emails_sent"] = 0
@@ -138,16 +290,206 @@ def _reset_metrics():
     _metrics["rc_verifications"] = 0
     _metrics["errors"] = []
     _metrics["warnings"] = []
+    for name in OPTIONAL_PASSES:
+        _metrics[f"deferred_{name}"] = 0
+
+
+def _incr_metric(name: str, amount: int = 1) -> None:
+    """Thread-safe increment of a numeric run metric."""
+    with _metrics_lock:
+        _metrics[name] += amount
+
+
+def _metrics_snapshot() -> dict:
+    """Copy of the current run metrics (lists copied too)."""
+    with _metrics_lock:
+        return {
+            key: list(value) if isinstance(value, list) else value
+            for key, value in _metrics.items()
+        }
+
+
+def _merge_metrics(snapshot: dict) -> None:
+    """Add another process's metrics snapshot into this run's metrics."""
+    with _metrics_lock:
+        for key, value in snapshot.items():
+            if isinstance(value, list):
+                _metrics.setdefault(key, []).extend(value)
+            else:
+                _metrics[key] = _metrics.get(key, 0) + value
 
 
 def _record_error(msg: str):
     """Record a CRITICAL-level event."""
-    _metrics["errors"].append(msg[:500])
+    with _metrics_lock:
+        _metrics["errors"].append(msg[:500])
 
 
 def _record_warning(msg: str):
     """Record a WARNING-level event."""
-    _metrics["warnings"].append(msg[:500])
+    with _metrics_lock:
+        _metrics["warnings"].append(msg[:500])
+
+
+class RuntimePlanner:
+    """Projects whether the rest of a run fits its time budget.
+
+    Per-operation costs (RevenueCat call, Resend email chunk, FCM push, DB
+    write) and per-user costs for each WORK_* class are kept as moving
+    averages of measured durations.  run_profile_pass reports how many users
+    are still queued per class, and how many profiles it has scanned so
+    far; expected_profiles (the previous run's profile count) covers the
+    part of the scan still ahead, at the measured seconds per scanned
+    profile.  When the projected time for both plus
+    PLANNER_POST_PASS_RESERVE_SECONDS exceeds what is left of the budget,
+    should_defer() starts shedding OPTIONAL_PASSES.
+    """
+
+    __slots__ = (
+        "budget_seconds", "started_at", "pressure", "expected_profiles",
+        "_costs", "_queued", "_scanned", "_scan_seconds", "_announced", "_lock",
+    )
+
+    def __init__(self, budget_seconds: float, *, pressure: bool = False, expected_profiles: int = 0):
+        self.budget_seconds = budget_seconds
+        self.started_at = time.monotonic()
+        self.pressure = pressure  # the previous run nearly ran out of time
+        self.expected_profiles = expected_profiles
+        self._costs: dict[str, float] = {}
+        self._queued: dict[int, int] = {}
+        self._scanned = 0
+        self._scan_seconds = 0.0
+        self._announced: set[str] = set()
+        self._lock = threading.Lock()
+
+    def record(self, op: str, seconds: float) -> None:
+        with self._lock:
+            previous = self._costs.get(op)
+            self._costs[op] = (
+                seconds if previous is None
+                else previous + PLANNER_EWMA_ALPHA * (seconds - previous)
+            )
+
+    def cost(self, op: str) -> float:
+        with self._lock:
+            return self._costs.get(op, 0.0)
+
+    def set_queued(self, counts: dict[int, int]) -> None:
+        with self._lock:
+            self._queued = dict(counts)
+
+    def record_scan(self, profiles: int, seconds: float) -> None:
+        """Feed back one scanned profile batch and the wall time it took."""
+        with self._lock:
+            self._scanned += profiles
+            self._scan_seconds += seconds
+
+    def remaining_scan_seconds(self) -> float:
+        """Time the profiles not scanned yet are expected to take."""
+        with self._lock:
+            if not self._scanned:
+                return 0.0
+            left = max(0, self.expected_profiles - self._scanned)
+            return left * self._scan_seconds / self._scanned
+
+    def _user_cost(self, work_class: int) -> float:
+        """Measured per-user cost for a class, else an estimate from operation costs."""
+        with self._lock:
+            measured = self._costs.get(f"user_{WORK_CLASS_NAMES[work_class]}")
+        if measured is not None:
+            return measured
+        db_write = self.cost("db_write")
+        if work_class == WORK_DELIVERY:
+            return self.cost("email_chunk") + db_write
+        if work_class == WORK_NOTIFICATION:
+            return self.cost("push") + db_write
+        if work_class == WORK_SUBSCRIPTION:
+            return max(self.cost("rc_call"), _rc_call_interval) + db_write
+        return db_write
+
+    def projected_seconds(self) -> float:
+        with self._lock:
+            queued = dict(self._queued)
+        return PLANNER_POST_PASS_RESERVE_SECONDS + self.remaining_scan_seconds() + sum(
+            count * self._user_cost(work_class) for work_class, count in queued.items()
+        )
+
+    def remaining_seconds(self) -> float:
+        return self.budget_seconds - (time.monotonic() - self.started_at)
+
+    def should_defer(self, pass_name: str) -> bool:
+        projected = self.projected_seconds()
+        remaining = self.remaining_seconds()
+        over = projected > remaining or (pass_name == "heal_guards" and self.pressure)
+        if over:
+            with self._lock:
+                first = pass_name not in self._announced
+                self._announced.add(pass_name)
+            if first:
+                print(
+                    f"Runtime planner: deferring {pass_name} "
+                    f"(projected {projected:.0f}s, {remaining:.0f}s left"
+                    f"{', previous run was near the limit' if self.pressure else ''})"
+                )
+        return over
+
+
+_run_planner: RuntimePlanner | None = None
+
+
+@contextmanager
+def _timed_op(op: str):
+    """Feed the duration of the wrapped operation to the run's planner."""
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        planner = _run_planner
+        if planner is not None:
+            planner.record(op, time.monotonic() - started)
+
+
+def defer_optional_pass(pass_name: str) -> bool:
+    """True, and counted in the run metrics, when pass_name should be skipped this run."""
+    planner = _run_planner
+    if planner is None or not planner.should_defer(pass_name):
+        return False
+    _incr_metric(f"deferred_{pass_name}")
+    return True
+
+
+def _load_previous_run(client) -> dict:
+    """The latest heartbeat_runs row's runtime and profile count ({} if unavailable)."""
+    try:
+        rows = (
+            client.table("heartbeat_runs")
+            .select("runtime_seconds,profiles_processed")
+            .order("started_at", desc=True)
+            .limit(1)
+            .execute()
+        ).data or []
+    except Exception as exc:  # noqa: BLE001
+        print(f"Could not read the previous heartbeat run: {exc}")
+        return {}
+    return rows[0] if rows else {}
+
+
+def _previous_run_was_tight(previous_run: dict) -> bool:
+    """Whether the previous run used most of the runtime budget."""
+    if previous_run.get("runtime_seconds") is None:
+        return False
+    return float(previous_run["runtime_seconds"]) >= PLANNER_PRESSURE_FRACTION * MAX_RUNTIME_SECONDS
+
+
+def _planner_op_for_url(url: str) -> str:
+    """Planner cost bucket for an outgoing POST."""
+    if url.startswith("https://api.resend.com/emails/batch"):
+        return "email_chunk"
+    if url.startswith("https://api.resend.com/"):
+        return "email"
+    if url.startswith("https://fcm.googleapis.com/"):
+        return "push"
+    return "http_post"
 
 
 def _mark_resend_quota_exhausted(response: "requests.Response") -> bool:
@@ -160,25 +502,141 @@ def _mark_resend_quota_exhausted(response: "requests.Response") -> bool:
     """
     global _resend_quota_exhausted
     if response.status_code == 429:
-        _resend_quota_exhausted = True
-        print("Resend rate/quota limit hit — skipping remaining emails this run")
+        with _metrics_lock:
+            already_flagged = _resend_quota_exhausted
+            _resend_quota_exhausted = True
+        if not already_flagged:
+            print("Resend rate/quota limit hit — skipping remaining emails this run")
         return True
     return False
 
 
 def _get_http_session() -> requests.Session:
-    global _HTTP_SESSION
-    if _HTTP_SESSION is None:
-        _HTTP_SESSION = requests.Session()
-    return _HTTP_SESSION
+    """Return this thread's HTTP session (requests.Session is not thread-safe)."""
+    session = getattr(_http_local, "session", None)
+    if session is None:
+        session = requests.Session()
+        _http_local.session = session
+    return session
+
+
+def _throttle_revenuecat() -> None:
+    """Space RC API calls _rc_call_interval apart across all threads."""
+    global _rc_next_call_at
+    with _rc_throttle_lock:
+        now = time.monotonic()
+        wait = _rc_next_call_at - now
+        _rc_next_call_at = max(now, _rc_next_call_at) + _rc_call_interval
+    if wait > 0:
+        time.sleep(wait)
+
+
+def _throttle_resend() -> None:
+    """Space Resend calls _resend_call_interval apart across all threads.
+
+    The request-slot semaphore only caps how many calls are in flight; fast
+    responses would still let more than 2 start per second.
+    """
+    global _resend_next_call_at
+    with _resend_throttle_lock:
+        now = time.monotonic()
+        wait = _resend_next_call_at - now
+        _resend_next_call_at = max(now, _resend_next_call_at) + _resend_call_interval
+    if wait > 0:
+        time.sleep(wait)
+
 
+def _postgrest_quote(value) -> str:
+    """Quote a value for use inside a PostgREST `or=(...)` expression."""
+    return '"' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
 
-def fetch_all_rows(query_builder) -> list[dict]:
-    """Paginate through a Supabase query to fetch all matching rows.
 
-    Supabase PostgREST caps responses at ~1000 rows by default.
-    This helper fetches in PAGE_SIZE batches using .range() until
-    a batch returns fewer rows than the page size.
+def _keyset_after(query, key: str | tuple[str, ...], last_key):
+    """Filter query to rows whose key sorts after last_key.
+
+    A tuple key compares row-wise: (k1, k2) > (v1, v2) becomes
+    `k1 >= v1` (index-friendly) plus `or(k1 > v1, and(k1 = v1, k2 > v2))`.
+    """
+    if isinstance(key, str):
+        return query.gt(key, last_key)
+    clauses = []
+    for idx, column in enumerate(key):
+        parts = [
+            f"{prefix_column}.eq.{_postgrest_quote(value)}"
+            for prefix_column, value in zip(key[:idx], last_key[:idx])
+        ]
+        parts.append(f"{column}.gt.{_postgrest_quote(last_key[idx])}")
+        clauses.append(parts[0] if len(parts) == 1 else f"and({','.join(parts)})")
+    return query.gte(key[0], last_key[0]).or_(",".join(clauses))
+
+
+def keyset_pages(
+    query_builder,
+    *,
+    key: str | tuple[str, ...] = "id",
+    page_size: int | None = None,
+    start_after: str | tuple[str, ...] | None = None,
+    prefetch: int = 0,
+    sizer: "BatchSizer | None" = None,
+):
+    """Stream a query's rows in pages using keyset (seek) pagination on `key`.
+
+    Each page runs a copy of query_builder with order(key), limit(page_size)
+    and `key > last seen`, so page N costs the same index seek as page 1
+    (offset pagination scans and discards every earlier row).  The builder
+    must not be ordered or limited already; filters are kept.  `key` should
+    be unique — rows sharing the last key of a page are skipped, which
+    iter_entry_owner_profiles relies on to read distinct owners.  A tuple of
+    non-null columns sorts and seeks on all of them (the last one should be
+    unique), e.g. ("next_action_at", "id").
+
+    start_after resumes after a known key.  prefetch > 0 fetches that many
+    pages ahead on a background thread (see prefetch_batches).  sizer, if
+    given, replaces page_size and is fed each page's timing.
+
+    Usage:
+        for rows in keyset_pages(
+            client.table("profiles").select("id,email").eq("status", "active")
+        ):
+            ...
+    """
+    def _pages():
+        last_key = start_after
+        while True:
+            if sizer is not None:
+                size = sizer.size
+            else:
+                size = page_size or PAGE_SIZE
+            query = copy.copy(query_builder)
+            for column in (key,) if isinstance(key, str) else key:
+                query = query.order(column)
+            query = query.limit(size)
+            if last_key is not None:
+                query = _keyset_after(query, key, last_key)
+            fetch_started = time.monotonic()
+            rows = query.execute().data or []
+            if sizer is not None:
+                sizer.record(rows, time.monotonic() - fetch_started)
+            if not rows:
+                return
+            yield rows
+            if len(rows) < size:
+                return
+            if isinstance(key, str):
+                last_key = str(rows[-1][key])
+            else:
+                last_key = tuple(str(rows[-1][column]) for column in key)
+
+    if prefetch > 0:
+        return prefetch_batches(_pages(), lambda rows: rows, prefetch)
+    return _pages()
+
+
+def fetch_all_rows(query_builder, *, key: str = "id") -> list[dict]:
+    """Fetch every row matching a Supabase query, ordered by `key`.
+
+    Supabase PostgREST caps responses at ~1000 rows by default, so this
+    walks keyset_pages in PAGE_SIZE pages.  Do not order the builder.
 
     Usage:
         rows = fetch_all_rows(
@@ -188,60 +646,329 @@ def fetch_all_rows(query_builder) -> list[dict]:
         )
     """
     all_rows: list[dict] = []
-    offset = 0
-    while True:
-        response = query_builder.range(offset, offset + PAGE_SIZE - 1).execute()
-        batch = response.data or []
-        all_rows.extend(batch)
-        if len(batch) < PAGE_SIZE:
-            break
-        offset += PAGE_SIZE
+    for rows in keyset_pages(query_builder, key=key):
+        all_rows.extend(rows)
     return all_rows
 
 
-def iter_rows(query_builder, page_size: int = PAGE_SIZE):
+def iter_rows(query_builder, page_size: int | None = None, *, key: str = "id"):
     """Yield paginated rows in batches to avoid loading huge result sets at once."""
-    offset = 0
-    while True:
-        response = query_builder.range(offset, offset + page_size - 1).execute()
-        batch = response.data or []
-        if not batch:
-            break
-        yield batch
-        if len(batch) < page_size:
-            break
-        offset += page_size
+    return keyset_pages(query_builder, key=key, page_size=page_size)
+
 
+def split_in_values(values: list, max_chars: int | None = None) -> list[list]:
+    """Split values for an `in.(...)` filter so each encoded list fits max_chars.
+
+    Lengths are measured URL-encoded, including the `%2C` separators.
+    """
+    limit = IN_FILTER_MAX_URL_CHARS if max_chars is None else max_chars
+    chunks: list[list] = []
+    current: list = []
+    used = 0
+    for value in values:
+        cost = len(quote(str(value), safe="")) + (3 if current else 0)
+        if current and used + cost > limit:
+            chunks.append(current)
+            current = []
+            cost -= 3
+            used = 0
+        current.append(value)
+        used += cost
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+class BatchSizer:
+    """Adapts the profile page size to observed fetch latency and payload size.
+
+    Full pages that come back well under PROFILE_BATCH_TARGET_SECONDS grow
+    the next page by half; slow or oversized pages halve it.  The size stays
+    within [PROFILE_BATCH_MIN_SIZE, PROFILE_BATCH_MAX_SIZE].
+    """
 
-def iter_active_profiles(client, page_size: int = PROFILE_BATCH_SIZE):
+    __slots__ = ("size", "min_size", "max_size", "target_seconds", "max_payload_bytes")
+
+    def __init__(
+        self,
+        size: int = PROFILE_BATCH_SIZE,
+        *,
+        min_size: int = PROFILE_BATCH_MIN_SIZE,
+        max_size: int = PROFILE_BATCH_MAX_SIZE,
+        target_seconds: float = PROFILE_BATCH_TARGET_SECONDS,
+        max_payload_bytes: int = PROFILE_BATCH_MAX_PAYLOAD_BYTES,
+    ):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.size = min(max(size, min_size), max_size)
+        self.target_seconds = target_seconds
+        self.max_payload_bytes = max_payload_bytes
+
+    def record(self, rows: list[dict], elapsed: float) -> None:
+        """Feed back one fetched page and adjust the size of the next one."""
+        payload_bytes = len(json.dumps(rows, default=str)) if rows else 0
+        if elapsed > self.target_seconds or payload_bytes > self.max_payload_bytes:
+            self.size = max(self.min_size, self.size // 2)
+        elif len(rows) >= self.size and elapsed < self.target_seconds / 2:
+            self.size = min(self.max_size, self.size + self.size // 2)
+
+
+def _select_profiles(source, embed_entries: bool = False, *, with_next_action: bool = False):
+    """select() for a profile query, optionally embedding each profile's active entries.
+
+    with_next_action adds NEXT_ACTION_COLUMN (due scan only).
+    """
+    if not embed_entries:
+        fields = PROFILE_SCAN_SELECT_FIELDS
+    else:
+        fields = PROFILE_WITH_ENTRIES_SELECT_FIELDS
+    if with_next_action:
+        fields = f"{NEXT_ACTION_COLUMN},{fields}"
+    if not embed_entries:
+        return source.select(fields)
+    query = source.select(fields).eq("vault_entries.status", "active")
+    # Order the embedded entries with `vault_entries.order=id`.  The
+    # builder's order(..., foreign_table=...) renders a top-level
+    # `order=vault_entries(id)` in postgrest-py 0.16, which would sort the
+    # profiles themselves and break keyset_pages' order on id.
+    query.params = query.params.add("vault_entries.order", "id")
+    return query
+
+
+def iter_active_profiles(
+    client,
+    page_size: int = PROFILE_BATCH_SIZE,
+    *,
+    id_range: tuple[str | None, str | None] | None = None,
+    due_before: datetime | None = None,
+    candidates_at: datetime | None = None,
+    include_rc_candidates: bool = True,
+    or_filter: str | None = None,
+    embed_entries: bool = False,
+    sizer: BatchSizer | None = None,
+    start_after: str | None = None,
+    order: str = "id",
+):
     """Yield active profiles via keyset pagination to avoid offset-skip issues.
 
     Heartbeat mutates profile.status while processing users. Offset pagination can
     skip rows when the filtered set shrinks mid-run. Keyset pagination on `id`
     remains stable under those updates.
+
+    id_range optionally restricts the scan to one [lower, upper) id shard.
+    due_before restricts it to profiles whose next_action_at has arrived.
+    candidates_at reads through the heartbeat_timer_candidates RPC (sql_72),
+    which drops profiles with nothing actionable at that time.
+    or_filter is an extra PostgREST `or` condition.
+    embed_entries adds each profile's active entries under "vault_entries".
+    sizer, if given, replaces page_size and is fed each page's timing.
+    start_after skips ids up to and including it (resume checkpoints).
+    order "urgency" (due_before only) walks (next_action_at, id) instead of
+    id, so the longest-overdue profiles come first.
     """
-    last_seen_id: str | None = None
-    while True:
-        query = (
-            client.table("profiles")
-            .select(PROFILE_SELECT_FIELDS)
-            .eq("status", "active")
-            .order("id")
-            .limit(page_size)
-        )
-        if last_seen_id is not None:
-            query = query.gt("id", last_seen_id)
-        response = query.execute()
-        batch = response.data or []
-        if not batch:
-            break
-        yield batch
-        last_seen_id = str(batch[-1]["id"])
+    if order == "urgency" and due_before is None:
+        raise ValueError("Urgency order needs due_before (only due profiles have a stable next_action_at order)")
+    lower_id, upper_id = id_range or (None, None)
+    source = (
+        client.rpc("heartbeat_timer_candidates", {
+            "p_now": candidates_at.isoformat(),
+            "p_push_66_fraction": PUSH_66_REMAINING_FRACTION,
+            "p_push_33_fraction": PUSH_33_REMAINING_FRACTION,
+            "p_warning_window_seconds": int(WARNING_WINDOW.total_seconds()),
+            "p_include_rc_candidates": include_rc_candidates,
+        })
+        if candidates_at is not None
+        else client.table("profiles")
+    )
+    query = _select_profiles(
+        source, embed_entries, with_next_action=due_before is not None,
+    ).eq("status", "active")
+    if lower_id is not None:
+        query = query.gte("id", lower_id)
+    if upper_id is not None:
+        query = query.lt("id", upper_id)
+    if due_before is not None:
+        query = query.lte("next_action_at", due_before.isoformat())
+    if or_filter is not None:
+        query = query.or_(or_filter)
+    yield from keyset_pages(
+        query,
+        key=("next_action_at", "id") if order == "urgency" else "id",
+        page_size=page_size,
+        sizer=sizer,
+        start_after=start_after,
+    )
 
 
 
 
 
+# Profiles that may need RevenueCat / downgrade handling without owning any
+# active entry (owners scan, second pass).  NULL theme / soul fire / timer
+# are free defaults and do not match; like _has_pro_indicators, 0 timer
+# days counts as the default 30.
+_NON_OWNER_WORK_FILTER = ",".join([
+    "downgrade_email_pending.is.true",
+    "subscription_status.in.(" + ",".join(sorted(PAID_STATUSES)) + ")",
+    "timer_days.not.in.(0,30)",
+    "selected_theme.not.in.(" + ",".join(sorted(t for t in FREE_THEMES if t)) + ")",
+    "selected_soul_fire.not.in.(" + ",".join(sorted(s for s in FREE_SOUL_FIRES if s)) + ")",
+])
+
+
+def iter_entry_owner_profiles(
+    client,
+    page_size: int = PROFILE_BATCH_SIZE,
+    *,
+    id_range: tuple[str | None, str | None] | None = None,
+    embed_entries: bool = False,
+    sizer: BatchSizer | None = None,
+):
+    """Yield active profiles that own active entries, then those needing subscription work.
+
+    Most free users own no vault entries and process_profile has nothing to
+    do for them.  The first pass streams distinct owner ids from
+    vault_entries (keyset on user_id, served by idx_vault_entries_user_status)
+    and loads just those profiles.  The second pass picks up entry-less
+    profiles with paid status, pro indicators or a pending downgrade email.
+    """
+    lower_id, upper_id = id_range or (None, None)
+    owner_ids_seen: set[str] = set()
+    query = client.table("vault_entries").select("user_id").eq("status", "active")
+    if lower_id is not None:
+        query = query.gte("user_id", lower_id)
+    if upper_id is not None:
+        query = query.lt("user_id", upper_id)
+    # keyset on user_id continues after each page's last owner: any of its
+    # remaining entry rows would only repeat the id.
+    for rows in keyset_pages(query, key="user_id"):
+        owner_ids = list(dict.fromkeys(str(row["user_id"]) for row in rows))
+        start = 0
+        while start < len(owner_ids):
+            if sizer is not None:
+                page_size = sizer.size
+            chunk = owner_ids[start:start + page_size]
+            start += len(chunk)
+            owner_ids_seen.update(chunk)
+            batch: list[dict] = []
+            fetch_started = time.monotonic()
+            for id_chunk in split_in_values(chunk):
+                batch.extend((
+                    _select_profiles(client.table("profiles"), embed_entries)
+                    .eq("status", "active")
+                    .in_("id", id_chunk)
+                    .order("id")
+                    .execute()
+                ).data or [])
+            if sizer is not None:
+                sizer.record(batch, time.monotonic() - fetch_started)
+            if batch:
+                yield batch
+
+    for batch in iter_active_profiles(
+        client,
+        page_size,
+        id_range=id_range,
+        or_filter=_NON_OWNER_WORK_FILTER,
+        embed_entries=embed_entries,
+        sizer=sizer,
+    ):
+        batch = [p for p in batch if str(p["id"]) not in owner_ids_seen]
+        if batch:
+            yield batch
+
+
+PROFILE_SCAN_MODES = ("full", "due", "candidates", "owners")
+
+# Profile processing order: "id" (keyset on id) or "urgency" (due scan only:
+# earliest next_action_at first, so overdue deadlines are handled first).
+PROFILE_ORDER_MODES = ("id", "urgency")
+
+# Scans that walk profiles in a single id order and so can resume from a
+# checkpoint.  The owners scan makes two passes over the id space.
+RESUME_SCAN_MODES = ("full", "due", "candidates")
+
+
+def iter_profiles_for_scan(
+    client,
+    scan_mode: str,
+    *,
+    now: datetime,
+    id_range: tuple[str | None, str | None] | None = None,
+    include_rc_candidates: bool = True,
+    embed_entries: bool = False,
+    sizer: BatchSizer | None = None,
+    start_after: str | None = None,
+    order: str = "id",
+):
+    """Profile batches for one of PROFILE_SCAN_MODES.
+
+    full        every active profile
+    due         next_action_at <= now (sql_67)
+    candidates  server-side timer filter RPC (sql_68)
+    owners      users owning active entries, plus entry-less subscription work
+
+    sizer, if given, adapts the page size as the scan runs.
+    start_after (RESUME_SCAN_MODES only) skips ids up to and including it.
+    order is one of PROFILE_ORDER_MODES; "urgency" needs the due scan.
+    """
+    if start_after is not None and scan_mode not in RESUME_SCAN_MODES:
+        raise ValueError(f"Scan mode {scan_mode} cannot start after a profile id")
+    if order not in PROFILE_ORDER_MODES:
+        raise ValueError(f"Unknown profile order: {order}")
+    if order == "urgency" and scan_mode != "due":
+        raise ValueError("Urgency order is only available for the due scan")
+    if scan_mode == "full":
+        return iter_active_profiles(
+            client, id_range=id_range, embed_entries=embed_entries, sizer=sizer,
+            start_after=start_after,
+        )
+    if scan_mode == "due":
+        return iter_active_profiles(
+            client, id_range=id_range, due_before=now, embed_entries=embed_entries, sizer=sizer,
+            start_after=start_after, order=order,
+        )
+    if scan_mode == "candidates":
+        return iter_active_profiles(
+            client,
+            id_range=id_range,
+            candidates_at=now,
+            include_rc_candidates=include_rc_candidates,
+            embed_entries=embed_entries,
+            sizer=sizer,
+            start_after=start_after,
+        )
+    if scan_mode == "owners":
+        return iter_entry_owner_profiles(
+            client, id_range=id_range, embed_entries=embed_entries, sizer=sizer,
+        )
+    raise ValueError(f"Unknown scan mode: {scan_mode}")
+
+
+def iter_profiles_resuming(
+    client,
+    scan_mode: str,
+    *,
+    resume_after: str | None,
+    id_range: tuple[str | None, str | None] | None = None,
+    **scan_kwargs,
+):
+    """iter_profiles_for_scan starting after resume_after, then wrapping around.
+
+    The second leg covers the ids from the start of the range up to (not
+    including) resume_after, so every profile is visited once per full pass.
+    """
+    yield from iter_profiles_for_scan(
+        client, scan_mode, id_range=id_range, start_after=resume_after, **scan_kwargs,
+    )
+    if resume_after is None:
+        return
+    lower_id, _upper_id = id_range or (None, None)
+    yield from iter_profiles_for_scan(
+        client, scan_mode, id_range=(lower_id, resume_after), **scan_kwargs,
+    )
+
+
 def get_env(name: str, default: str | None = None) -> str:
 
     value = os.getenv(name, default)
@@ -275,6 +1002,163 @@ def parse_iso(value: str | None) -> datetime | None:
     return parsed.astimezone(timezone.utc)
 
 
+class _SlotRecord:
+    """Row container with fixed __slots__ that still behaves like the row dict.
+
+    Selected columns live in slots (no per-row __dict__); get / [] / `in`
+    work as on the PostgREST dict, so code and tests written against plain
+    dicts keep working.  Keys outside the column set go to a small overflow
+    dict created on first use.
+    """
+
+    __slots__ = ("_extra",)
+
+    _COLUMNS: frozenset = frozenset()
+
+    def __init__(self, row: dict):
+        self._extra = None
+        for key, value in row.items():
+            self[key] = value
+
+    def __getitem__(self, key: str):
+        if key in self._COLUMNS:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        if self._extra is not None and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key: str, value) -> None:
+        if key in self._COLUMNS:
+            setattr(self, key, value)
+            self._column_changed(key)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __contains__(self, key: str) -> bool:
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key: str, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def _column_changed(self, key: str) -> None:
+        pass
+
+
+_UNPARSED = object()
+
+_PROFILE_COLUMNS = tuple(PROFILE_SELECT_FIELDS.split(",")) + (NEXT_ACTION_COLUMN,)
+
+_ENTRY_COLUMNS = tuple(ENTRY_SELECT_FIELDS.split(","))
+
+
+class ProfileRecord(_SlotRecord):
+    """Fetched profile row; last_check_in is parsed once, on first use.
+
+    Rows fetched with PROFILE_SCAN_SELECT_FIELDS carry contact_loaded=False
+    until load_profile_contacts fills in PROFILE_CONTACT_FIELDS.
+    """
+
+    __slots__ = _PROFILE_COLUMNS + ("_last_check_in_at", "contact_loaded")
+
+    _COLUMNS = frozenset(_PROFILE_COLUMNS)
+
+    def __init__(self, row: dict, *, contact_loaded: bool = True):
+        self._last_check_in_at = _UNPARSED
+        self.contact_loaded = contact_loaded
+        super().__init__(row)
+
+    @property
+    def last_check_in_at(self) -> datetime | None:
+        if self._last_check_in_at is _UNPARSED:
+            self._last_check_in_at = parse_iso(self.get("last_check_in"))
+        return self._last_check_in_at
+
+    def _column_changed(self, key: str) -> None:
+        if key == "last_check_in":
+            self._last_check_in_at = _UNPARSED
+
+
+class EntryRecord(_SlotRecord):
+    """Fetched vault_entries row with normalized entry_mode and parsed scheduled_at.
+
+    Rows fetched with ENTRY_METADATA_SELECT_FIELDS carry
+    ciphertext_loaded=False until load_entry_ciphertexts fills them in.
+    """
+
+    __slots__ = _ENTRY_COLUMNS + ("mode", "_scheduled_at_at", "ciphertext_loaded")
+
+    _COLUMNS = frozenset(_ENTRY_COLUMNS)
+
+    def __init__(self, row: dict, *, ciphertext_loaded: bool = True):
+        self.mode = "standard"
+        self._scheduled_at_at = _UNPARSED
+        self.ciphertext_loaded = ciphertext_loaded
+        super().__init__(row)
+
+    @property
+    def scheduled_at_at(self) -> datetime | None:
+        if self._scheduled_at_at is _UNPARSED:
+            self._scheduled_at_at = parse_iso(self.get("scheduled_at"))
+        return self._scheduled_at_at
+
+    def _column_changed(self, key: str) -> None:
+        if key == "entry_mode":
+            self.mode = self.entry_mode or "standard"
+        elif key == "scheduled_at":
+            self._scheduled_at_at = _UNPARSED
+
+
+def _entry_mode(entry: dict) -> str:
+    if isinstance(entry, EntryRecord):
+        return entry.mode
+    return entry.get("entry_mode") or "standard"
+
+
+def _entry_scheduled_at(entry: dict) -> datetime | None:
+    if isinstance(entry, EntryRecord):
+        return entry.scheduled_at_at
+    return parse_iso(entry.get("scheduled_at"))
+
+
+def _profile_last_check_in(profile: dict) -> datetime | None:
+    if isinstance(profile, ProfileRecord):
+        return profile.last_check_in_at
+    return parse_iso(profile.get("last_check_in"))
+
+
+class EntrySummary:
+    """Per-user facts about active entries, gathered in one pass."""
+
+    __slots__ = ("has_entries", "has_recurring", "has_audio", "send_count")
+
+    def __init__(self, entries: list[dict]):
+        self.has_entries = False  # any non-recurring entry (drives the guardian timer)
+        self.has_recurring = False
+        self.has_audio = False
+        self.send_count = 0  # non-recurring entries whose action is not destroy
+        for entry in entries:
+            if _entry_mode(entry) == "recurring":
+                self.has_recurring = True
+            else:
+                self.has_entries = True
+                if (entry.get("action_type") or "send").lower() != "destroy":
+                    self.send_count += 1
+            if (entry.get("data_type") or "").lower() == "audio":
+                self.has_audio = True
+
+
 @dataclass(frozen=True)
 class TimerState:
 
@@ -431,58 +1315,491 @@ def should_send_24h_warning_email(profile: dict, timer_state: TimerState, now: d
     return not _already_marked_in_cycle(warning_sent_at, timer_state.last_check_in)
 
 
+# Timer warning stages, earliest first, with the profile column that marks
+# each one sent in the current check-in cycle.
+NOTIFICATION_STAGE_COLUMNS = {
+    "warning_66": "push_66_sent_at",
+    "warning_33": "push_33_sent_at",
+    "email_24h": "warning_sent_at",
+}
 
+NOTIFICATION_STAGE_LABELS = {
+    "warning_66": "Push 66% warning",
+    "warning_33": "Push 33% warning",
+    "email_24h": "Warning email",
+}
 
 
-def decode_secret_box(encoded: str) -> tuple[bytes, bytes, bytes]:
-
-    parts = encoded.split(".")
+def due_notification_stages(profile: dict, timer_state: TimerState, now: datetime) -> list[str]:
+    """Timer warning stages due and not yet sent this cycle, earliest first.
 
-    if len(parts) != 3:
+    process_profile sends only the last (most urgent) one and marks the
+    rest as satisfied.
+    """
+    checks = (
+        ("warning_66", should_send_push_66),
+        ("warning_33", should_send_push_33),
+        ("email_24h", should_send_24h_warning_email),
+    )
+    return [stage for stage, check in checks if check(profile, timer_state, now)]
 
-        raise ValueError("Invalid encrypted payload format.")
 
-    nonce = base64.b64decode(parts[0])
+def _has_pro_indicators(profile: dict) -> bool:
+    return (
+        int(profile.get("timer_days") or 30) != 30
+        or profile.get("selected_theme") not in FREE_THEMES
+        or profile.get("selected_soul_fire") not in FREE_SOUL_FIRES
+    )
 
-    cipher_text = base64.b64decode(parts[1])
 
-    mac = base64.b64decode(parts[2])
+def _needs_downgrade_pass(profile: dict, active_entries: list[dict], now: datetime) -> bool:
+    """Whether handle_subscription_downgrade still has something to revert or send."""
+    if profile.get("downgrade_email_pending"):
+        return True
+    if (profile.get("subscription_status") or "free").lower() != "free":
+        return False
+    if _has_pro_indicators(profile):
+        return True
+    free_max = now + timedelta(days=30)
+    for entry in active_entries:
+        if (entry.get("data_type") or "").lower() == "audio":
+            return True
+        if _entry_mode(entry) == "recurring":
+            return True
+        scheduled_at = _entry_scheduled_at(entry)
+        if scheduled_at is not None and scheduled_at > free_max:
+            return True
+    return False
 
-    return nonce, cipher_text, mac
 
+def _has_non_timer_work(
+    profile: dict,
+    active_entries: list[dict],
+    now: datetime,
+    *,
+    include_rc_candidates: bool = True,
+) -> bool:
+    """Work process_profile does regardless of the guardian timer.
 
+    Time Capsule mode, NULL last_check_in (logged as a warning), RevenueCat
+    verification, outstanding downgrades and Forever Letters.
+    """
+    sub_status = (profile.get("subscription_status") or "free").lower()
+    return bool(
+        (profile.get("app_mode") or "vault").lower() == "scheduled"
+        or not profile.get("last_check_in")
+        or (include_rc_candidates and (
+            sub_status in PAID_STATUSES
+            or _has_pro_indicators(profile)
+            or profile.get("downgrade_email_pending")
+        ))
+        or _needs_downgrade_pass(profile, active_entries, now)
+        or any(_entry_mode(e) == "recurring" for e in active_entries)
+    )
 
 
+@dataclass(frozen=True)
+class TimerBatchFlags:
 
-def decrypt_with_server_secret(encoded: str, server_secret: str) -> bytes:
+    expired: list[bool]
 
-    nonce, cipher_text, mac = decode_secret_box(encoded)
+    push_66: list[bool]
 
-    key = hashlib.sha256(server_secret.encode("utf-8")).digest()
+    push_33: list[bool]
 
-    aes = AESGCM(key)
+    email_24h: list[bool]
 
-    combined = cipher_text + mac
+    def any_due(self, index: int) -> bool:
+        return (
+            self.expired[index]
+            or self.push_66[index]
+            or self.push_33[index]
+            or self.email_24h[index]
+        )
 
-    return aes.decrypt(nonce, combined, None)
+    def subset_for(self, batch: list[dict], profiles: list[dict]) -> "TimerBatchFlags":
+        """Flags for profiles, a subsequence of the batch these flags were computed for."""
+        if profiles is batch:
+            return self
+        position = {id(profile): index for index, profile in enumerate(batch)}
+        indices = [position[id(profile)] for profile in profiles]
+        return TimerBatchFlags(
+            expired=[self.expired[i] for i in indices],
+            push_66=[self.push_66[i] for i in indices],
+            push_33=[self.push_33[i] for i in indices],
+            email_24h=[self.email_24h[i] for i in indices],
+        )
 
 
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
 
+_ONE_MICROSECOND = timedelta(microseconds=1)
 
 
-def extract_server_ciphertext(value: str) -> str:
+def _epoch_us(value: datetime) -> int:
+    return (value - _EPOCH) // _ONE_MICROSECOND
 
-    if not value:
 
-        return value
+def _timer_offsets_us(timer_days: int | str | None) -> tuple[int, int, int, int]:
+    """(total, push_66, push_33, email_24h) offsets from last_check_in in µs.
 
-    try:
+    Built with the same timedelta arithmetic as build_timer_state so the
+    rounding of the fractional trigger points matches it exactly.
+    """
+    total_seconds = _normalize_timer_days(timer_days) * 86400
+    push_66 = _compute_trigger_from_remaining(
+        last_check_in=_EPOCH,
+        total_seconds=total_seconds,
+        remaining_fraction=PUSH_66_REMAINING_FRACTION,
+    )
+    push_33 = _compute_trigger_from_remaining(
+        last_check_in=_EPOCH,
+        total_seconds=total_seconds,
+        remaining_fraction=PUSH_33_REMAINING_FRACTION,
+    )
+    total_us = total_seconds * 1_000_000
+    return (
+        total_us,
+        _epoch_us(push_66),
+        _epoch_us(push_33),
+        max(total_us - WARNING_WINDOW // _ONE_MICROSECOND, 0),
+    )
 
-        decoded = json.loads(value)
 
-    except Exception:  # noqa: BLE001
+def evaluate_timer_batch(profiles: list[dict], now: datetime) -> TimerBatchFlags:
+    """Timer checks for a whole profile batch in one pass.
 
-        return value
+    Equivalent to build_timer_state + should_send_* per profile, but works
+    on integer epoch microseconds and computes trigger offsets once per
+    distinct timer_days.  Profiles without last_check_in get all-False flags
+    (process_profile skips them).
+    """
+    now_us = _epoch_us(now)
+    offsets_by_days: dict = {}
+    expired: list[bool] = []
+    push_66: list[bool] = []
+    push_33: list[bool] = []
+    email_24h: list[bool] = []
+
+    def _marked(value: str | None, last_check_in_us: int) -> bool:
+        sent_at = parse_iso(value)
+        return sent_at is not None and _epoch_us(sent_at) >= last_check_in_us
+
+    for profile in profiles:
+        last_check_in = _profile_last_check_in(profile)
+        if last_check_in is None:
+            expired.append(False)
+            push_66.append(False)
+            push_33.append(False)
+            email_24h.append(False)
+            continue
+        timer_days = profile.get("timer_days")
+        offsets = offsets_by_days.get(timer_days)
+        if offsets is None:
+            offsets = offsets_by_days[timer_days] = _timer_offsets_us(timer_days)
+        total_us, push_66_us, push_33_us, email_us = offsets
+        lci_us = _epoch_us(last_check_in)
+
+        # remaining_seconds truncates toward zero, so "expired" means < 1s left.
+        expired.append(lci_us + total_us - now_us < 1_000_000)
+        push_66.append(
+            now_us >= lci_us + push_66_us
+            and not _marked(profile.get("push_66_sent_at"), lci_us)
+        )
+        push_33.append(
+            now_us >= lci_us + push_33_us
+            and not _marked(profile.get("push_33_sent_at"), lci_us)
+        )
+        email_24h.append(
+            now_us >= lci_us + email_us
+            and is_paid(profile.get("subscription_status"))
+            and not _marked(profile.get("warning_sent_at"), lci_us)
+        )
+
+    return TimerBatchFlags(expired=expired, push_66=push_66, push_33=push_33, email_24h=email_24h)
+
+
+def select_profiles_needing_pass(
+    profile_batch: list[dict],
+    entries_by_user: dict[str, list[dict]],
+    now: datetime,
+    *,
+    include_rc_candidates: bool = True,
+    flags: TimerBatchFlags | None = None,
+) -> list[dict]:
+    """Drop profiles for which process_profile would do nothing this run.
+
+    Timer checks come from evaluate_timer_batch (or flags, if the caller
+    already has them for this batch); everything else from
+    _has_non_timer_work.  Users without standard entries have no live timer.
+    """
+    if flags is None:
+        flags = evaluate_timer_batch(profile_batch, now)
+    selected = []
+    for index, profile in enumerate(profile_batch):
+        entries = entries_by_user.get(str(profile.get("id")), [])
+        if (EntrySummary(entries).has_entries and flags.any_due(index)) or _has_non_timer_work(
+            profile, entries, now, include_rc_candidates=include_rc_candidates,
+        ):
+            selected.append(profile)
+    return selected
+
+
+def classify_profile_work(
+    profile_batch: list[dict],
+    entries_by_user: dict[str, list[dict]],
+    now: datetime,
+    *,
+    include_rc_candidates: bool = True,
+    flags: TimerBatchFlags | None = None,
+) -> list[int]:
+    """Most urgent WORK_* class of each profile's work this run.
+
+    flags, if given, are evaluate_timer_batch's result for profile_batch.
+    """
+    if flags is None:
+        flags = evaluate_timer_batch(profile_batch, now)
+    classes = []
+    for index, profile in enumerate(profile_batch):
+        entries = entries_by_user.get(str(profile.get("id")), [])
+        scheduled_mode = (profile.get("app_mode") or "vault").lower() == "scheduled"
+        has_entries = False
+        delivery_due = False
+        for entry in entries:
+            if _entry_mode(entry) == "recurring":
+                next_send = _next_recurring_send_at(entry, now)
+                delivery_due = delivery_due or (next_send is not None and next_send <= now)
+                continue
+            has_entries = True
+            if scheduled_mode:
+                scheduled_at = _entry_scheduled_at(entry)
+                delivery_due = delivery_due or (scheduled_at is not None and scheduled_at <= now)
+        if not scheduled_mode and has_entries and flags.expired[index]:
+            delivery_due = True
+
+        sub_status = (profile.get("subscription_status") or "free").lower()
+        if delivery_due:
+            classes.append(WORK_DELIVERY)
+        elif not scheduled_mode and has_entries and flags.any_due(index):
+            classes.append(WORK_NOTIFICATION)
+        elif _needs_downgrade_pass(profile, entries, now) or (include_rc_candidates and (
+            sub_status in PAID_STATUSES or _has_pro_indicators(profile)
+        )):
+            classes.append(WORK_SUBSCRIPTION)
+        else:
+            classes.append(WORK_MAINTENANCE)
+    return classes
+
+
+class ProfileWorkQueue:
+    """Users waiting for process_profile, handed out most urgent class first.
+
+    Each item is a whole user, so one user's passes still run in
+    process_profile's order.  Within a class, users come out in the order
+    their batches arrived.  The queue also tracks which fetched batches are
+    fully processed, for resume checkpoints.
+    """
+
+    __slots__ = ("_heap", "_seq", "_batches")
+
+    def __init__(self):
+        self._heap: list[tuple] = []
+        self._seq = 0
+        self._batches: deque = deque()  # [last_profile_id, users still queued]
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def add_batch(self, last_id: str, work: list[tuple[int, dict, list[dict]]]) -> None:
+        """Queue one fetched batch as (work_class, profile, entries) items."""
+        batch = [last_id, len(work)]
+        self._batches.append(batch)
+        for work_class, profile, entries in work:
+            heapq.heappush(self._heap, (work_class, self._seq, profile, entries, batch))
+            self._seq += 1
+
+    def class_counts(self) -> dict[int, int]:
+        counts: dict[int, int] = {}
+        for item in self._heap:
+            counts[item[0]] = counts.get(item[0], 0) + 1
+        return counts
+
+    def peek_class(self) -> int | None:
+        return self._heap[0][0] if self._heap else None
+
+    def pop_group(self, limit: int) -> list[tuple]:
+        """Up to `limit` items of the most urgent class present."""
+        group = [heapq.heappop(self._heap)]
+        while self._heap and len(group) < limit and self._heap[0][0] == group[0][0]:
+            group.append(heapq.heappop(self._heap))
+        return group
+
+    def finish(self, group: list[tuple]) -> None:
+        for item in group:
+            item[4][1] -= 1
+
+    def pop_completed(self) -> str | None:
+        """Last profile id of the newest batch that is done, along with every batch before it."""
+        last_id = None
+        while self._batches and self._batches[0][1] == 0:
+            last_id = self._batches.popleft()[0]
+        return last_id
+
+
+def is_timer_candidate(
+    profile: dict,
+    active_entries: list[dict],
+    now: datetime,
+    *,
+    include_rc_candidates: bool = True,
+) -> bool:
+    """Python side of the heartbeat_is_timer_candidate predicate (sql_72).
+
+    True when process_profile may have something to do for this profile:
+    non-timer work, an expired timer, or a warning stage should_send_*
+    would send.  supabase/test_timer_candidates.sql holds fixtures that
+    are run through both this function and the SQL predicate.
+    """
+    if _has_non_timer_work(profile, active_entries, now, include_rc_candidates=include_rc_candidates):
+        return True
+    if not active_entries:
+        return False
+
+    timer_state = build_timer_state(_profile_last_check_in(profile), profile.get("timer_days"), now)
+    return timer_state.remaining_seconds <= 0 or bool(due_notification_stages(profile, timer_state, now))
+
+
+def _next_recurring_send_at(entry: dict, now: datetime) -> datetime | None:
+    """Start of the UTC day a Forever Letter next becomes due (may be in the past)."""
+    scheduled_at = _entry_scheduled_at(entry)
+    if scheduled_at is None:
+        return None
+    year = max(now.year, scheduled_at.year)
+    last_sent_year = entry.get("last_sent_year")
+    if last_sent_year is not None and int(last_sent_year) >= year:
+        year = int(last_sent_year) + 1
+    day = scheduled_at.day
+    if scheduled_at.month == 2 and day == 29 and not calendar.isleap(year):
+        day = 28
+    return datetime(year, scheduled_at.month, day, tzinfo=timezone.utc)
+
+
+def compute_next_action_at(profile: dict, active_entries: list[dict], now: datetime) -> datetime:
+    """Earliest time the heartbeat next has work for this profile.
+
+    Mirrors the passes in process_profile: pushes, 24h email and expiry for
+    vault mode, scheduled_at for Time Capsule entries, the next annual date
+    for Forever Letters, and "now" while a downgrade is still outstanding.
+    Capped at now + NEXT_ACTION_MAX_DEFER so RevenueCat and downgrade checks
+    keep running for idle profiles.
+    """
+    candidates = [now + NEXT_ACTION_MAX_DEFER]
+    sub_status = (profile.get("subscription_status") or "free").lower()
+    if _needs_downgrade_pass(profile, active_entries, now):
+        return now
+
+    app_mode = (profile.get("app_mode") or "vault").lower()
+    has_entries = False
+    for entry in active_entries:
+        if _entry_mode(entry) == "recurring":
+            next_send = _next_recurring_send_at(entry, now)
+            if next_send is not None:
+                candidates.append(next_send)
+            continue
+        has_entries = True
+        if app_mode == "scheduled":
+            scheduled_at = _entry_scheduled_at(entry)
+            if scheduled_at is not None:
+                candidates.append(scheduled_at)
+
+    last_check_in = _profile_last_check_in(profile)
+    if app_mode != "scheduled" and has_entries and last_check_in is not None:
+        timer_state = build_timer_state(last_check_in, profile.get("timer_days"), now)
+        candidates.append(timer_state.deadline)
+        if not _already_marked_in_cycle(parse_iso(profile.get("push_66_sent_at")), last_check_in):
+            candidates.append(timer_state.push_66_at)
+        if not _already_marked_in_cycle(parse_iso(profile.get("push_33_sent_at")), last_check_in):
+            candidates.append(timer_state.push_33_at)
+        if is_paid(sub_status) and not _already_marked_in_cycle(
+            parse_iso(profile.get("warning_sent_at")), last_check_in
+        ):
+            candidates.append(timer_state.email_24h_at)
+
+    return min(candidates)
+
+
+def store_next_action_at(client, profile: dict, next_action_at: datetime) -> None:
+    """Persist next_action_at unless the row changed since it was fetched.
+
+    DB triggers (sql_67) reset next_action_at to now() whenever a check-in,
+    subscription or entry change could create earlier work.  Matching on the
+    value we read means such a reset is never overwritten by a stale result.
+    """
+    seen = profile.get("next_action_at")
+    query = (
+        client.table("profiles")
+        .update({"next_action_at": next_action_at.isoformat()})
+        .eq("id", str(profile["id"]))
+    )
+    query = query.eq("next_action_at", seen) if seen else query.is_("next_action_at", "null")
+    with _timed_op("db_write"):
+        query.execute()
+
+
+
+
+
+def decode_secret_box(encoded: str) -> tuple[bytes, bytes, bytes]:
+
+    parts = encoded.split(".")
+
+    if len(parts) != 3:
+
+        raise ValueError("Invalid encrypted payload format.")
+
+    nonce = base64.b64decode(parts[0])
+
+    cipher_text = base64.b64decode(parts[1])
+
+    mac = base64.b64decode(parts[2])
+
+    return nonce, cipher_text, mac
+
+
+
+
+
+@functools.lru_cache(maxsize=4)
+def _server_cipher(server_secret: str) -> AESGCM:
+    """AES-GCM cipher keyed by SHA-256(SERVER_SECRET), derived once per secret."""
+    return AESGCM(hashlib.sha256(server_secret.encode("utf-8")).digest())
+
+
+def decrypt_with_server_secret(encoded: str, server_secret: str) -> bytes:
+
+    nonce, cipher_text, mac = decode_secret_box(encoded)
+
+    return _server_cipher(server_secret).decrypt(nonce, cipher_text + mac, None)
+
+
+
+
+
+def extract_server_ciphertext(value: str) -> str:
+
+    # Plain secret boxes are base64 parts joined by "."; only a JSON wrapper
+    # ({"server": ..., ...}) starts with a brace, so skip json.loads otherwise.
+    if not value or not value.lstrip().startswith("{"):
+
+        return value
+
+    try:
+
+        decoded = json.loads(value)
+
+    except Exception:  # noqa: BLE001
+
+        return value
 
 
 
@@ -500,6 +1817,109 @@ def extract_server_ciphertext(value: str) -> str:
 
 
 
+class DecryptionContext:
+    """Server-secret decryption state shared by every user in one run.
+
+    Holds the derived AES-GCM cipher and memoizes decrypted per-user HMAC
+    keys for the run, keyed by their ciphertext so a rotated key is never
+    served stale.
+    """
+
+    __slots__ = ("server_secret", "_cipher", "_hmac_keys", "_lock")
+
+    def __init__(self, server_secret: str):
+        self.server_secret = server_secret
+        self._cipher = _server_cipher(server_secret)
+        self._hmac_keys: dict[str, bytes] = {}
+        self._lock = threading.Lock()
+
+    def decrypt(self, value: str) -> bytes:
+        """Decrypt a plain secret box or a JSON-wrapped one."""
+        nonce, cipher_text, mac = decode_secret_box(extract_server_ciphertext(value))
+        return self._cipher.decrypt(nonce, cipher_text + mac, None)
+
+    def _decrypt_or_error(self, value: str) -> bytes | Exception:
+        try:
+            return self.decrypt(value)
+        except Exception as exc:  # noqa: BLE001
+            return exc
+
+    def decrypt_many(self, values: list[str]) -> list[bytes | Exception]:
+        """Decrypt each value, in order; a failure is returned in its slot, not raised.
+
+        DECRYPT_POOL_MIN_VALUES or more values are spread over a pool of
+        DECRYPT_POOL_WORKERS threads.
+        """
+        if len(values) < DECRYPT_POOL_MIN_VALUES:
+            return [self._decrypt_or_error(value) for value in values]
+        with ThreadPoolExecutor(
+            max_workers=DECRYPT_POOL_WORKERS,
+            thread_name_prefix="heartbeat-decrypt",
+        ) as pool:
+            return list(pool.map(self._decrypt_or_error, values))
+
+    def hmac_key(self, hmac_key_encrypted: str) -> bytes:
+        with self._lock:
+            cached = self._hmac_keys.get(hmac_key_encrypted)
+        if cached is None:
+            cached = self.decrypt(hmac_key_encrypted)
+            with self._lock:
+                self._hmac_keys[hmac_key_encrypted] = cached
+        return cached
+
+
+_run_decryption: DecryptionContext | None = None
+
+
+def _decryption_context(server_secret: str) -> DecryptionContext:
+    ctx = _run_decryption
+    if ctx is None or ctx.server_secret != server_secret:
+        return DecryptionContext(server_secret)
+    return ctx
+
+
+def predecrypt_entry_secrets(entries: list[dict], server_secret: str) -> dict[str, bytes | Exception]:
+    """Decrypt the recipient and data-key ciphertexts of send entries up front.
+
+    Maps each extracted ciphertext to its plaintext or decryption error.
+    Returns {} for fewer than DECRYPT_POOL_MIN_VALUES ciphertexts, which
+    the prepare loop then decrypts inline via decrypt_prefetched().
+    """
+    values = []
+    for entry in entries:
+        if (entry.get("action_type") or "send").lower() == "destroy":
+            continue
+        values.append(entry.get("recipient_email_encrypted") or "")
+        if not entry.get("is_zero_knowledge", False):
+            values.append(entry.get("data_key_encrypted") or "")
+    ciphertexts = list(dict.fromkeys(extract_server_ciphertext(v) for v in values if v))
+    if len(ciphertexts) < DECRYPT_POOL_MIN_VALUES:
+        return {}
+    return dict(zip(ciphertexts, _decryption_context(server_secret).decrypt_many(ciphertexts)))
+
+
+def decrypt_prefetched(
+    predecrypted: dict[str, bytes | Exception],
+    ciphertext: str,
+    server_secret: str,
+) -> bytes:
+    """Plaintext from predecrypt_entry_secrets, else decrypt now; errors are raised either way."""
+    result = predecrypted.get(ciphertext)
+    if result is None:
+        return decrypt_with_server_secret(ciphertext, server_secret)
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+
+def decrypt_user_hmac_key(hmac_key_encrypted: str, server_secret: str) -> bytes:
+    """A user's HMAC key, memoized for the run when a DecryptionContext is active."""
+    ctx = _run_decryption
+    if ctx is None or ctx.server_secret != server_secret:
+        return decrypt_with_server_secret(hmac_key_encrypted, server_secret)
+    return ctx.hmac_key(hmac_key_encrypted)
+
+
 def compute_hmac_signature(message: str, key_bytes: bytes) -> str:
 
     digest = hmac.new(key_bytes, message.encode("utf-8"), hashlib.sha256).digest()
@@ -532,6 +1952,22 @@ def _is_retryable_http_status(status_code: int) -> bool:
     return status_code in (408, 425, 429, 500, 502, 503, 504)
 
 
+def _is_definite_rejection(status_code: int | None) -> bool:
+    """True when the API refused the request outright (a non-retryable 4xx).
+
+    Only then is it safe to re-send the same emails under another
+    Idempotency-Key: after a timeout or a 5xx the request may have gone out,
+    and a new key would deliver it twice.  409 is Resend's key-conflict reply
+    (the same key still in flight), so it is not a rejection either.
+    """
+    return (
+        status_code is not None
+        and 400 <= status_code < 500
+        and status_code != 409
+        and not _is_retryable_http_status(status_code)
+    )
+
+
 def _post_json_with_retries(
     url: str,
     *,
@@ -547,19 +1983,30 @@ def _post_json_with_retries(
 
     for attempt in range(len(HTTP_RETRY_DELAYS_SECONDS) + 1):
 
+        # Cap in-flight Resend calls so concurrent users don't trip its rate limit
+        is_resend = url.startswith("https://api.resend.com/")
+        slot = _resend_request_slots if is_resend else nullcontext()
+
         try:
 
-            response = _get_http_session().post(
+            with slot:
 
-                url,
+                if is_resend:
+                    _throttle_resend()
 
-                headers=request_headers,
+                with _timed_op(_planner_op_for_url(url)):
 
-                json=payload,
+                    response = _get_http_session().post(
 
-                timeout=timeout,
+                        url,
 
-            )
+                        headers=request_headers,
+
+                        json=payload,
+
+                        timeout=timeout,
+
+                    )
 
         except requests.RequestException as exc:
 
@@ -696,32 +2143,25 @@ def wrap_email_html(
     )
 
 
-def send_email(
-    api_key: str,
+def build_email_payload(
     from_email: str,
     to_email: str,
     subject: str,
     text: str,
     html: str,
     *,
-    idempotency_key: str | None = None,
     preheader: str = "",
-) -> None:
-    if _resend_quota_exhausted:
-        raise RuntimeError("Resend daily quota exhausted — email deferred to next run")
-
-    formatted_from = _format_from_address(from_email)
+) -> dict:
+    """Resend payload for one transactional email (single or batch endpoint)."""
     reply_to_email = _extract_email_address(from_email)
-    wrapped_html = wrap_email_html(
-        html, unsubscribe_email=reply_to_email, preheader=preheader,
-    )
-
-    payload: dict = {
-        "from": formatted_from,
+    return {
+        "from": _format_from_address(from_email),
         "to": [to_email],
         "subject": subject,
         "text": text,
-        "html": wrapped_html,
+        "html": wrap_email_html(
+            html, unsubscribe_email=reply_to_email, preheader=preheader,
+        ),
         "reply_to": reply_to_email,
         "headers": {
             "List-Unsubscribe": f"<mailto:{reply_to_email}?subject=Unsubscribe>",
@@ -729,6 +2169,23 @@ def send_email(
         },
     }
 
+
+def send_email(
+    api_key: str,
+    from_email: str,
+    to_email: str,
+    subject: str,
+    text: str,
+    html: str,
+    *,
+    idempotency_key: str | None = None,
+    preheader: str = "",
+) -> None:
+    if _resend_quota_exhausted:
+        raise RuntimeError("Resend daily quota exhausted — email deferred to next run")
+
+    payload = build_email_payload(from_email, to_email, subject, text, html, preheader=preheader)
+
     response = _post_json_with_retries(
 
         "https://api.resend.com/emails",
@@ -748,14 +2205,182 @@ def send_email(
     )
 
     if response.status_code >= 400:
-        _metrics["emails_failed"] += 1
+        _incr_metric("emails_failed")
         _mark_resend_quota_exhausted(response)
         raise RuntimeError(f"Resend error: {response.status_code} {response.text}")
 
-    _metrics["emails_sent"] += 1
+    _incr_metric("emails_sent")
+
+
+
+
+
+class NotificationOutbox:
+    """Notification emails collected during one profile batch.
+
+    Warning, downgrade and tamper emails queued with send_notification_email
+    are flushed through /emails/batch once the batch's users are done.  The
+    batch is sent with permissive validation, so a message Resend rejects
+    (bad address, ...) is reported on its own and does not hold back the
+    rest.  If Resend refuses the batch request outright (a definite 4xx),
+    each message falls back to the single-email endpoint under its own
+    idempotency key; if the outcome is ambiguous (timeout, 5xx after
+    retries) the batch may have gone out, so the messages stay unmarked
+    and the next run retries them.  A message's
+    on_sent callback (which clears downgrade_email_pending, sets
+    warning_sent_at, ...) runs only after the message was accepted.
+    """
+
+    __slots__ = ("resend_key", "_lock", "_messages")
+
+    def __init__(self, resend_key: str):
+        self.resend_key = resend_key
+        self._lock = threading.Lock()
+        self._messages: dict[str, tuple[dict, object]] = {}  # dedupe_key -> (payload, on_sent)
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    def add(self, payload: dict, dedupe_key: str, on_sent=None) -> None:
+        tag_value = re.sub(r"[^A-Za-z0-9_-]", "_", dedupe_key)[:256]
+        payload = {**payload, "tags": [{"name": "dedupe_key", "value": tag_value}]}
+        with self._lock:
+            self._messages.setdefault(dedupe_key, (payload, on_sent))
+
+    def flush(self) -> None:
+        with self._lock:
+            messages, self._messages = list(self._messages.items()), {}
+        for chunk_start in range(0, len(messages), RESEND_BATCH_LIMIT):
+            chunk = messages[chunk_start : chunk_start + RESEND_BATCH_LIMIT]
+            if len(chunk) == 1:
+                self._send_single(*chunk[0])
+                continue
+            self._send_batch(chunk)
+
+    def _headers(self) -> dict:
+        return {
+            "Authorization": f"Bearer {self.resend_key}",
+            "Content-Type": "application/json",
+        }
+
+    def _send_batch(self, chunk: list[tuple[str, tuple[dict, object]]]) -> None:
+        batch_hash = hashlib.md5(
+            "|".join(sorted(key for key, _ in chunk)).encode()
+        ).hexdigest()[:16]
+        rejected_batch = False
+        try:
+            if _resend_quota_exhausted:
+                raise RuntimeError("Resend daily quota exhausted — email deferred to next run")
+            response = _post_json_with_retries(
+                "https://api.resend.com/emails/batch",
+                headers={**self._headers(), "x-batch-validation": "permissive"},
+                payload=[payload for _, (payload, _) in chunk],
+                idempotency_key=f"notify-batch-{batch_hash}",
+            )
+            if response.status_code >= 400:
+                _mark_resend_quota_exhausted(response)
+                rejected_batch = _is_definite_rejection(response.status_code)
+                raise RuntimeError(f"Resend batch error: {response.status_code} {response.text}")
+            errors = (json.loads(response.text or "{}") or {}).get("errors") or []
+        except Exception as exc:  # noqa: BLE001
+            if rejected_batch and not _resend_quota_exhausted:
+                print(
+                    f"Notification batch of {len(chunk)} email(s) rejected: {exc} — "
+                    f"sending them one by one"
+                )
+                for dedupe_key, message in chunk:
+                    self._send_single(dedupe_key, message)
+                return
+            # The batch may have gone out: a single send under another key
+            # could deliver twice, so leave the messages for the next run.
+            _incr_metric("emails_failed", len(chunk))
+            print(f"Notification batch of {len(chunk)} email(s) failed: {exc} — will retry next run")
+            return
+
+        rejected = {}
+        for error in errors:
+            if isinstance(error, dict) and isinstance(error.get("index"), int):
+                rejected[error["index"]] = error.get("message") or "rejected"
+        for index, (dedupe_key, (_, on_sent)) in enumerate(chunk):
+            if index in rejected:
+                _incr_metric("emails_failed")
+                print(f"Notification {dedupe_key} rejected by Resend: {rejected[index]} — will retry next run")
+                continue
+            _incr_metric("emails_sent")
+            self._run_on_sent(dedupe_key, on_sent)
+
+    def _send_single(self, dedupe_key: str, message: tuple[dict, object]) -> None:
+        payload, on_sent = message
+        try:
+            if _resend_quota_exhausted:
+                raise RuntimeError("Resend daily quota exhausted — email deferred to next run")
+            response = _post_json_with_retries(
+                "https://api.resend.com/emails",
+                headers=self._headers(),
+                payload=payload,
+                idempotency_key=dedupe_key,
+            )
+            if response.status_code >= 400:
+                _mark_resend_quota_exhausted(response)
+                raise RuntimeError(f"Resend error: {response.status_code} {response.text}")
+        except Exception as exc:  # noqa: BLE001
+            _incr_metric("emails_failed")
+            print(f"Notification {dedupe_key} failed: {exc} — will retry next run")
+            return
+        _incr_metric("emails_sent")
+        self._run_on_sent(dedupe_key, on_sent)
+
+    @staticmethod
+    def _run_on_sent(dedupe_key: str, on_sent) -> None:
+        if on_sent is None:
+            return
+        try:
+            on_sent()
+        except Exception as exc:  # noqa: BLE001
+            print(f"Post-send update failed for {dedupe_key}: {exc}")
+
 
+_notification_outbox: NotificationOutbox | None = None
 
 
+def send_notification_email(
+    api_key: str,
+    from_email: str,
+    to_email: str,
+    subject: str,
+    text: str,
+    html: str,
+    *,
+    idempotency_key: str,
+    preheader: str = "",
+    on_sent=None,
+    batchable: bool = True,
+) -> None:
+    """send_email for warning / downgrade / tamper mail.
+
+    Inside process_profile_batch a batchable message joins the batch's
+    NotificationOutbox and on_sent runs when the outbox is flushed.
+    Otherwise — and for retries of a message an earlier run already tried,
+    which pass batchable=False so Resend can dedupe them on their own
+    idempotency key — it is sent now and on_sent runs straight after.
+    Raises like send_email when the message cannot be sent or queued.
+    """
+    outbox = _notification_outbox
+    if outbox is None or not batchable:
+        send_email(
+            api_key, from_email, to_email, subject, text, html,
+            idempotency_key=idempotency_key, preheader=preheader,
+        )
+        if on_sent is not None:
+            on_sent()
+        return
+    if _resend_quota_exhausted:
+        raise RuntimeError("Resend daily quota exhausted — email deferred to next run")
+    outbox.add(
+        build_email_payload(from_email, to_email, subject, text, html, preheader=preheader),
+        idempotency_key,
+        on_sent,
+    )
 
 
 def send_warning_email(
@@ -765,12 +2390,27 @@ def send_warning_email(
     from_email: str,
     *,
     remaining_fraction: float = 0.0,
+    on_sent=None,
+    batchable: bool = True,
 ) -> None:
+    """Send (or queue, see send_notification_email) the timer warning email.
+
+    on_sent runs once the email is delivered, or right away when the
+    profile has no email address, so the stage is not retried forever.
+    A slim-scanned profile whose contact row was not loaded raises instead:
+    its address is unknown, not empty, and the next run retries it.
+    """
+
+    if isinstance(profile, ProfileRecord) and not profile.contact_loaded:
+        raise RuntimeError("contact row not loaded — warning deferred to next run")
 
     email = profile.get("email")
 
     if not email:
 
+        if on_sent is not None:
+            on_sent()
+
         return
 
     sender_name = profile.get("sender_name") or "Afterword"
@@ -816,7 +2456,7 @@ def send_warning_email(
     )
 
     idempotency_key = f"warning-{profile.get('id', 'unknown')}-{deadline.date().isoformat()}"
-    send_email(
+    send_notification_email(
         resend_key,
         from_email,
         email,
@@ -825,6 +2465,8 @@ def send_warning_email(
         html,
         idempotency_key=idempotency_key,
         preheader=f"Hi {sender_name}, your Afterword timer needs attention — check in to keep your vault secure.",
+        on_sent=on_sent,
+        batchable=batchable,
     )
 
 
@@ -917,9 +2559,9 @@ def send_push_v1(
     )
 
     if response.status_code < 400:
-        _metrics["pushes_sent"] += 1
+        _incr_metric("pushes_sent")
     else:
-        _metrics["pushes_failed"] += 1
+        _incr_metric("pushes_failed")
 
     return response
 
@@ -1353,6 +2995,14 @@ def send_unlock_email(
 
 RESEND_BATCH_LIMIT = 100
 
+DELIVERY_BATCH_LINGER_SECONDS = 0.2  # longest a user's chunk waits for others to fill a shared batch
+
+# A timer warning whose 24h stage has been due for longer than one scheduled
+# run (*/15 cron) was probably tried before.  It is sent on its own under its
+# idempotency key instead of joining a notification batch, so a message is
+# batched at most once and Resend dedupes every later retry on that key.
+NOTIFICATION_BATCH_FRESH_WINDOW = timedelta(minutes=15)
+
 
 def send_batch_emails(
     api_key: str,
@@ -1445,18 +3095,6 @@ def mark_profile_status(client, user_id: str, status: str) -> None:
 
 
 
-def mark_warning_sent(client, user_id: str, timestamp: datetime) -> None:
-
-    client.table("profiles").update(
-
-        {"warning_sent_at": timestamp.isoformat()}
-
-    ).eq("id", user_id).execute()
-
-
-
-
-
 def claim_entry_for_sending(client, entry_id: str) -> bool:
 
     response = (
@@ -1488,6 +3126,69 @@ def claim_entry_for_sending(client, entry_id: str) -> bool:
 
 
 
+def load_entry_ciphertexts(client, entries: list[dict]) -> None:
+    """Bulk-load ciphertext columns for metadata-only entries about to be delivered.
+
+    Plain dict entries (and fully loaded records) are left alone.  An entry
+    deleted since the scan simply stays unloaded; its sending claim fails.
+    """
+    pending = {
+        str(entry["id"]): entry
+        for entry in entries
+        if isinstance(entry, EntryRecord) and not entry.ciphertext_loaded
+    }
+    for entry in _bulk_load_columns(client, "vault_entries", pending, ENTRY_CIPHERTEXT_FIELDS):
+        entry.ciphertext_loaded = True
+
+
+def load_profile_contacts(client, profiles: list[dict]) -> list[dict]:
+    """Bulk-load email, sender_name and hmac_key_encrypted for slim-scanned profiles.
+
+    Plain dict profiles (and fully loaded records) are left alone.  Returns
+    the profiles whose row did not come back (deleted since the scan, ...):
+    their contact columns are still unknown, so callers skip them this run.
+    """
+    pending = {
+        str(profile["id"]): profile
+        for profile in profiles
+        if isinstance(profile, ProfileRecord) and not profile.contact_loaded
+    }
+    for profile in _bulk_load_columns(client, "profiles", pending, PROFILE_CONTACT_FIELDS):
+        profile.contact_loaded = True
+    return [profile for profile in pending.values() if not profile.contact_loaded]
+
+
+def _bulk_load_columns(client, table: str, pending: dict[str, dict], columns) -> list[dict]:
+    """Fetch `columns` for the rows in pending (keyed by id) and copy them in.
+
+    Requests are chunked by ENTRY_CIPHERTEXT_CHUNK_SIZE ids, and further by
+    split_in_values, to keep URLs short.
+    Returns the records that were found.
+    """
+    loaded: list[dict] = []
+    row_ids = list(pending)
+    id_chunks = [
+        id_chunk
+        for start in range(0, len(row_ids), ENTRY_CIPHERTEXT_CHUNK_SIZE)
+        for id_chunk in split_in_values(row_ids[start:start + ENTRY_CIPHERTEXT_CHUNK_SIZE])
+    ]
+    for id_chunk in id_chunks:
+        rows = (
+            client.table(table)
+            .select("id," + ",".join(columns))
+            .in_("id", id_chunk)
+            .execute()
+        ).data or []
+        for row in rows:
+            record = pending.get(str(row["id"]))
+            if record is None:
+                continue
+            for column in columns:
+                record[column] = row.get(column)
+            loaded.append(record)
+    return loaded
+
+
 def release_entry_lock(client, entry_id: str) -> None:
 
     client.table("vault_entries").update({"status": "active"}).eq(
@@ -1559,26 +3260,16 @@ def heal_inconsistent_profiles(client, now: datetime) -> None:
     # Guard 1: Active profiles with stale protocol_executed_at (keyset-paginated)
     try:
         healed_1 = 0
-        last_id_g1: str | None = None
-        while True:
-            q1 = (
-                client.table("profiles")
-                .select("id")
-                .eq("status", "active")
-                .not_.is_("protocol_executed_at", "null")
-                .order("id")
-                .limit(PROFILE_BATCH_SIZE)
-            )
-            if last_id_g1 is not None:
-                q1 = q1.gt("id", last_id_g1)
-            resp1 = q1.execute()
-            rows1 = resp1.data or []
-            if not rows1:
-                break
-            last_id_g1 = str(rows1[-1]["id"])
-            for row in rows1:
-                uid = str(row["id"])
-                client.table("profiles").update({
+        for rows1 in keyset_pages(
+            client.table("profiles")
+            .select("id")
+            .eq("status", "active")
+            .not_.is_("protocol_executed_at", "null"),
+            page_size=PROFILE_BATCH_SIZE,
+        ):
+            for row in rows1:
+                uid = str(row["id"])
+                client.table("profiles").update({
                     "protocol_executed_at": None,
                 }).eq("id", uid).eq("status", "active").execute()
                 healed_1 += 1
@@ -1590,23 +3281,13 @@ def heal_inconsistent_profiles(client, now: datetime) -> None:
     # Guard 2: Inactive profiles with NULL protocol_executed_at (keyset-paginated)
     try:
         healed_2 = 0
-        last_id_g2: str | None = None
-        while True:
-            q2 = (
-                client.table("profiles")
-                .select("id")
-                .eq("status", "inactive")
-                .is_("protocol_executed_at", "null")
-                .order("id")
-                .limit(PROFILE_BATCH_SIZE)
-            )
-            if last_id_g2 is not None:
-                q2 = q2.gt("id", last_id_g2)
-            resp2 = q2.execute()
-            rows2 = resp2.data or []
-            if not rows2:
-                break
-            last_id_g2 = str(rows2[-1]["id"])
+        for rows2 in keyset_pages(
+            client.table("profiles")
+            .select("id")
+            .eq("status", "inactive")
+            .is_("protocol_executed_at", "null"),
+            page_size=PROFILE_BATCH_SIZE,
+        ):
             for row in rows2:
                 uid = str(row["id"])
                 client.table("profiles").update({
@@ -1678,95 +3359,286 @@ def _try_send_tampering_notification(
         f"<p>— The Afterword Team</p>"
     )
     try:
-        send_email(
+        send_notification_email(
             resend_key, from_email, email, subject, text, html,
             idempotency_key=f"tamper-{uid}-{now.date().isoformat()}",
             preheader="Important security notice about your Afterword vault.",
+            on_sent=lambda: print(f"User {uid}: sent tampering notification email"),
         )
-        print(f"User {uid}: sent tampering notification email")
     except Exception as exc:  # noqa: BLE001
         print(f"User {uid}: failed to send tampering notification: {exc}")
 
 
-def process_expired_entries(
+def _release_entry_locks(client, entry_ids: list[str]) -> None:
+    for entry_id in entry_ids:
+        try:
+            release_entry_lock(client, entry_id)
+        except Exception:  # noqa: BLE001
+            pass
+
+
+class _QueuedSend:
+    """One user's chunk waiting in a DeliveryBatchQueue."""
+
+    __slots__ = ("items", "done", "email_ids", "rejected")
+
+    def __init__(self, items: list[tuple[str, dict]]):
+        self.items = items  # (entry_id, email_payload)
+        self.done = threading.Event()
+        self.email_ids: list[str | None] | None = None  # None = the shared batch failed
+        self.rejected = False  # the shared batch failed with a definite 4xx
+
+
+class DeliveryBatchQueue:
+    """Run-wide Resend batch shared by users delivered concurrently.
+
+    Each deliver_due_entries chunk is queued and its thread waits.  Once the
+    queued emails reach RESEND_BATCH_LIMIT, or the oldest waiter has waited
+    linger_seconds, one waiting thread posts everything queued as a single
+    /emails/batch request with permissive validation, so an email Resend
+    rejects (bad recipient, ...) fails on its own: its slot in the result is
+    None while the rest of the batch goes out.  The ids in the response come
+    back in payload order and are sliced back to each chunk, so every user
+    marks or releases only its own entries.  When Resend rejects the whole
+    request outright (a definite 4xx) every user falls back to a batch of its
+    own, whose idempotency key depends only on that user's entries; when the
+    outcome is ambiguous (timeout, 5xx after retries) the emails may have gone
+    out, so users release their entries for the next run instead.
+    """
+
+    __slots__ = ("resend_key", "linger_seconds", "_lock", "_pending", "_pending_count")
+
+    def __init__(self, resend_key: str, *, linger_seconds: float = DELIVERY_BATCH_LINGER_SECONDS):
+        self.resend_key = resend_key
+        self.linger_seconds = linger_seconds
+        self._lock = threading.Lock()
+        self._pending: list[_QueuedSend] = []
+        self._pending_count = 0
+
+    def _take_pending(self) -> list[_QueuedSend]:
+        batch, self._pending, self._pending_count = self._pending, [], 0
+        return batch
+
+    def send(self, items: list[tuple[str, dict]]) -> tuple[list[str | None] | None, bool]:
+        """Queue one chunk and block until its batch is sent.
+
+        Returns (email_ids, rejected): one email id per item (None where
+        Resend rejected that email), or None if the batch request failed, in
+        which case rejected says whether Resend refused it outright.
+        """
+        queued = _QueuedSend(items)
+        ready: list[list[_QueuedSend]] = []
+        with self._lock:
+            if self._pending and self._pending_count + len(items) > RESEND_BATCH_LIMIT:
+                ready.append(self._take_pending())
+            self._pending.append(queued)
+            self._pending_count += len(items)
+            if self._pending_count >= RESEND_BATCH_LIMIT:
+                ready.append(self._take_pending())
+        for batch in ready:
+            self._post(batch)
+        if not queued.done.wait(self.linger_seconds):
+            with self._lock:
+                batch = self._take_pending() if queued in self._pending else None
+            if batch:
+                self._post(batch)
+            queued.done.wait()
+        return queued.email_ids, queued.rejected
+
+    def _post(self, batch: list[_QueuedSend]) -> None:
+        entry_ids = [entry_id for queued in batch for entry_id, _ in queued.items]
+        # Deterministic idempotency key: hash of the batch's sorted entry IDs
+        batch_hash = hashlib.md5("|".join(sorted(entry_ids)).encode()).hexdigest()[:16]
+        email_ids: list[str | None] = []
+        failed = True
+        rejected = False
+        try:
+            if _resend_quota_exhausted:
+                return
+            response = _post_json_with_retries(
+                "https://api.resend.com/emails/batch",
+                headers={
+                    "Authorization": f"Bearer {self.resend_key}",
+                    "Content-Type": "application/json",
+                    "x-batch-validation": "permissive",
+                },
+                payload=[payload for queued in batch for _, payload in queued.items],
+                idempotency_key=f"unlock-batch-{batch_hash}",
+            )
+            if response.status_code >= 400:
+                _mark_resend_quota_exhausted(response)
+                rejected = _is_definite_rejection(response.status_code)
+                raise RuntimeError(f"Resend batch error: {response.status_code} {response.text}")
+            failed = False
+            try:
+                body = response.json()
+            except Exception:  # noqa: BLE001
+                body = {}
+            rejected_slots = {
+                error["index"]: error.get("message") or "rejected"
+                for error in body.get("errors") or []
+                if isinstance(error, dict) and isinstance(error.get("index"), int)
+            }
+            # Accepted emails' ids, in payload order, skipping the rejected slots
+            accepted_ids = iter([str(item.get("id") or "") for item in body.get("data") or []])
+            for index, entry_id in enumerate(entry_ids):
+                if index in rejected_slots:
+                    print(f"Resend rejected entry {entry_id}: {rejected_slots[index]}")
+                    email_ids.append(None)
+                else:
+                    email_ids.append(next(accepted_ids, ""))
+        except Exception as exc:  # noqa: BLE001
+            print(
+                f"Shared Resend batch of {len(entry_ids)} email(s) from {len(batch)} "
+                f"chunk(s) failed: {type(exc).__name__}: {exc}"
+            )
+        finally:
+            offset = 0
+            for queued in batch:
+                if not failed:
+                    queued.email_ids = email_ids[offset : offset + len(queued.items)]
+                queued.rejected = rejected
+                offset += len(queued.items)
+                queued.done.set()
+
+
+_run_delivery_queue: DeliveryBatchQueue | None = None
+
+
+def _finalize_expired_send(client, profile: dict, entry_id: str, entry_title: str, fcm_ctx, now: datetime) -> bool:
+    """Mark a delivered expired-vault entry sent and push the owner; True = counts as delivered."""
+    marked = False
+    for _mark_attempt in range(3):
+        try:
+            if mark_entry_sent(client, entry_id, now):
+                marked = True
+                break
+        except Exception as mark_exc:  # noqa: BLE001
+            if _mark_attempt == 2:
+                print(f"Failed to mark entry {entry_id} as sent after 3 attempts: {mark_exc}")
+        if _mark_attempt < 2:
+            time.sleep(1)
+    if not marked:
+        print(f"WARNING: Could not mark entry {entry_id} as sent — will be requeued")
+        _record_warning(f"Could not mark entry {entry_id} as sent — will be requeued")
+    _incr_metric("entries_delivered")
+    try:
+        send_executed_push(
+            client, profile["id"], entry_id, entry_title, fcm_ctx,
+        )
+    except Exception:  # noqa: BLE001
+        pass
+    return True
+
+
+def _finalize_scheduled_send(client, entry_id: str, now: datetime) -> bool:
+    """Mark a delivered Time Capsule entry sent with its own grace_until; True once marked."""
+    for _mark_attempt in range(3):
+        try:
+            if mark_entry_sent(client, entry_id, now):
+                # Set per-entry grace_until = now + 30 days
+                grace_until = (now + timedelta(days=30)).isoformat()
+                gu_ok = False
+                for _gu_attempt in range(3):
+                    try:
+                        client.table("vault_entries").update({
+                            "grace_until": grace_until,
+                        }).eq("id", entry_id).execute()
+                        # Double-guard: verify grace_until persisted
+                        verify = client.table("vault_entries").select("grace_until").eq("id", entry_id).execute()
+                        if verify.data and verify.data[0].get("grace_until"):
+                            gu_ok = True
+                            break
+                        else:
+                            print(f"WARNING: grace_until write silently reverted for {entry_id} (attempt {_gu_attempt + 1})")
+                            _record_warning(f"grace_until write silently reverted for {entry_id} (attempt {_gu_attempt + 1})")
+                    except Exception:  # noqa: BLE001
+                        if _gu_attempt < 2:
+                            time.sleep(0.5)
+                if not gu_ok:
+                    # Email already sent — do NOT revert to active.
+                    # Reverting would cause duplicate emails on next run.
+                    # Missing grace_until just means the entry won't
+                    # auto-cleanup, which is far safer than re-sending.
+                    print(f"WARNING: grace_until failed for scheduled entry {entry_id}, keeping status=sent (no revert)")
+                    _record_warning(f"grace_until failed for scheduled entry {entry_id}, keeping status=sent")
+                _incr_metric("scheduled_delivered")
+                return True
+        except Exception as mark_exc:  # noqa: BLE001
+            if _mark_attempt == 2:
+                print(f"Failed to mark scheduled entry {entry_id} as sent: {mark_exc}")
+        if _mark_attempt < 2:
+            time.sleep(1)
+    return False
+
+
+def deliver_due_entries(
     client,
     profile: dict,
-    entries: list[dict],
+    due_entries: list[dict],
+    *,
+    hmac_key_bytes: bytes | None,
     server_secret: str,
     resend_key: str,
     from_email: str,
     viewer_base_url: str,
-    fcm_ctx: dict | None,
     now: datetime,
-) -> tuple[bool, int]:
-    """Process expired vault entries using batch email sending.
-
-    Three-phase approach for send entries:
-      Phase 1 – Validate & prepare: claim lock, HMAC check, decrypt, build payload
-      Phase 2 – Batch send: one Resend API call for ALL emails (avoids rate limits)
-      Phase 3 – Finalise: mark entries as sent, send push notifications
-
-    Returns (had_send, input_send_count):
-      - had_send: True if any 'send' entries were successfully emailed
-      - input_send_count: number of send-type entries in the input
+    fcm_ctx: dict | None = None,
+    scheduled: bool = False,
+) -> int:
+    """Claim → HMAC → decrypt → build payload → batch send → mark sent, streamed.
+
+    Shared by expired-vault and Time Capsule delivery.  Entries are prepared
+    RESEND_BATCH_LIMIT at a time; each full chunk goes to a single sender
+    thread, which posts it to Resend and marks its entries sent while the
+    caller's thread prepares the next chunk.  At most two chunks of
+    decrypted keys and payloads exist at once.  During a concurrent pass
+    the chunk joins the run's DeliveryBatchQueue instead of being posted
+    on its own.
+
+    SAFETY: a send entry is NEVER deleted on a validation failure — its lock
+    is released so it stays in the DB for retry next cycle.  Entries are
+    marked sent right after their chunk succeeds, so they can never be
+    re-claimed; when a chunk fails, it and the already-prepared next chunk
+    are released and the rest stay unclaimed.
+
+    Returns the number of entries delivered (expired: in a sent chunk;
+    scheduled: also marked sent).
     """
-    had_send = False
-    input_send_count = sum(
-        1 for e in entries
-        if (e.get("action_type") or "send").lower() != "destroy"
-        and (e.get("entry_mode") or "standard") != "recurring"
-    )
-
+    user_id = str(profile.get("id", "?"))
     sender_name = profile.get("sender_name") or "Afterword"
-    user_id = profile.get("id", "?")
-
-    hmac_key_encrypted = profile.get("hmac_key_encrypted")
-    hmac_key_bytes = None
-    if hmac_key_encrypted:
-        try:
-            hmac_key_bytes = decrypt_with_server_secret(hmac_key_encrypted, server_secret)
-        except Exception as exc:  # noqa: BLE001
-            print(f"WARNING: Failed to decrypt HMAC key for user {user_id}: {exc} — delivery will proceed without HMAC check")
-            _record_warning(f"Failed to decrypt HMAC key for user {user_id}: {exc}")
-    elif input_send_count > 0:
-        print(f"WARNING: User {user_id} has {input_send_count} send entries but hmac_key_encrypted is NULL — delivery will proceed without HMAC check")
-        _record_warning(f"User {user_id} has {input_send_count} send entries but hmac_key_encrypted is NULL")
+    entry_label = "scheduled entry" if scheduled else "send entry"
+    user_label = f"User {user_id} (scheduled)" if scheduled else f"User {user_id}"
+    idem_prefix = "scheduled-batch" if scheduled else "unlock-batch"
 
     # Counters for post-loop integrity summary
     hmac_mismatches = 0
     decryption_failures = 0
+    delivered = 0  # written by the sender thread only
+    sent_chunks = 0
 
-    # ── Phase 1: Process destroy entries immediately, prepare send entries ──
-    # Each prepared send is (entry_id, entry_title, recipient, viewer_link, security_key, email_payload)
-    prepared_sends: list[tuple[str, str, str, str, str, dict]] = []
-
-    for entry in entries:
-        # Skip recurring (Forever Letters) — never consumed by timer expiry
-        if (entry.get("entry_mode") or "standard") == "recurring":
-            continue
+    def _prepare(entry: dict, predecrypted: dict) -> tuple[str, str, dict] | None:
+        nonlocal hmac_mismatches, decryption_failures
         entry_id = entry.get("id", "unknown")
         try:
             if not claim_entry_for_sending(client, entry_id):
-                continue
+                return None
 
             action = (entry.get("action_type") or "send").lower()
+            entry_title = entry.get("title") or "Untitled"
 
             if action == "destroy":
-                entry_title = entry.get("title") or "Untitled"
-                try:
-                    send_executed_push(
-                        client, profile["id"], entry_id, entry_title,
-                        fcm_ctx, action="destroy",
-                    )
-                except Exception:  # noqa: BLE001
-                    pass
+                if not scheduled:
+                    try:
+                        send_executed_push(
+                            client, profile["id"], entry_id, entry_title,
+                            fcm_ctx, action="destroy",
+                        )
+                    except Exception:  # noqa: BLE001
+                        pass
                 delete_entry(client, entry)
-                _metrics["entries_destroyed"] += 1
-                continue
-
-            # ── SEND entry validation ──
-            # SAFETY: NEVER delete a send entry on validation failure.
-            # Release the lock so it stays in the DB for retry next cycle.
+                _incr_metric("entries_destroyed")
+                return None
 
             # ── HMAC integrity check (advisory, NOT a delivery gate) ──
             # AES-GCM authenticated encryption is the authoritative tamper
@@ -1774,51 +3646,44 @@ def process_expired_entries(
             # HMAC mismatches are most often caused by legitimate HMAC key
             # rotation (device change, app reinstall, secure-storage wipe)
             # and must NOT block delivery.
-            hmac_ok = False
+            recipient_encrypted = entry.get("recipient_email_encrypted") or ""
             if hmac_key_bytes is not None:
-                recipient_encrypted = entry.get("recipient_email_encrypted") or ""
                 signature_message = f"{entry.get('payload_encrypted')}|{recipient_encrypted}"
                 expected_signature = compute_hmac_signature(signature_message, hmac_key_bytes)
-                hmac_ok = expected_signature == entry.get("hmac_signature")
-                if not hmac_ok:
+                if expected_signature != entry.get("hmac_signature"):
                     hmac_mismatches += 1
-            else:
-                recipient_encrypted = entry.get("recipient_email_encrypted") or ""
 
             if not recipient_encrypted:
-                print(f"CRITICAL: Empty recipient for send entry {entry_id} user {user_id} — entry preserved")
-                _record_error(f"Empty recipient for send entry {entry_id} user {user_id}")
+                print(f"CRITICAL: Empty recipient for {entry_label} {entry_id} user {user_id} — entry preserved")
+                _record_error(f"Empty recipient for {entry_label} {entry_id} user {user_id}")
                 release_entry_lock(client, entry_id)
-                continue
+                return None
 
             # Step 1: Decrypt recipient email (AES-GCM — authoritative integrity check)
             try:
                 recipient_ciphertext = extract_server_ciphertext(recipient_encrypted)
-                recipient_email = decrypt_with_server_secret(
-                    recipient_ciphertext, server_secret
+                recipient_email = decrypt_prefetched(
+                    predecrypted, recipient_ciphertext, server_secret
                 ).decode("utf-8").strip()
             except Exception as dec_exc:  # noqa: BLE001
-                print(f"CRITICAL: Failed to decrypt recipient for send entry {entry_id} user {user_id}: {dec_exc}")
-                _record_error(f"Failed to decrypt recipient for send entry {entry_id} user {user_id}: {dec_exc}")
+                print(f"CRITICAL: Failed to decrypt recipient for {entry_label} {entry_id} user {user_id}: {dec_exc}")
+                _record_error(f"Failed to decrypt recipient for {entry_label} {entry_id} user {user_id}: {dec_exc}")
                 decryption_failures += 1
                 release_entry_lock(client, entry_id)
-                continue
+                return None
 
             if not _EMAIL_RE.match(recipient_email):
-                print(f"CRITICAL: Invalid recipient email format for send entry {entry_id} user {user_id} — entry preserved")
-                _record_error(f"Invalid recipient email format for send entry {entry_id} user {user_id}")
+                print(f"CRITICAL: Invalid recipient email format for {entry_label} {entry_id} user {user_id} — entry preserved")
+                _record_error(f"Invalid recipient email format for {entry_label} {entry_id} user {user_id}")
                 release_entry_lock(client, entry_id)
-                continue
+                return None
 
             # Step 2: Decrypt data key or handle ZK entry
-            is_zk = entry.get("is_zero_knowledge", False)
             viewer_link = build_viewer_link(viewer_base_url, entry_id)
-            entry_title = entry.get("title") or "Untitled"
 
-            if is_zk:
+            if entry.get("is_zero_knowledge", False):
                 # Zero-knowledge: server never has the data key.
                 # Send email WITHOUT the security key.
-                security_key = None
                 email_payload = build_zk_unlock_email_payload(
                     recipient_email, entry_id, sender_name, entry_title,
                     viewer_link, from_email,
@@ -1826,20 +3691,20 @@ def process_expired_entries(
             else:
                 data_key_encrypted = entry.get("data_key_encrypted")
                 if not data_key_encrypted:
-                    print(f"CRITICAL: Missing data_key_encrypted for send entry {entry_id} user {user_id} — entry preserved")
-                    _record_error(f"Missing data_key_encrypted for send entry {entry_id} user {user_id}")
+                    print(f"CRITICAL: Missing data_key_encrypted for {entry_label} {entry_id} user {user_id} — entry preserved")
+                    _record_error(f"Missing data_key_encrypted for {entry_label} {entry_id} user {user_id}")
                     release_entry_lock(client, entry_id)
-                    continue
+                    return None
 
                 try:
                     data_key_ciphertext = extract_server_ciphertext(data_key_encrypted)
-                    data_key_bytes = decrypt_with_server_secret(data_key_ciphertext, server_secret)
+                    data_key_bytes = decrypt_prefetched(predecrypted, data_key_ciphertext, server_secret)
                 except Exception as dk_exc:  # noqa: BLE001
-                    print(f"CRITICAL: Failed to decrypt data_key for send entry {entry_id} user {user_id}: {dk_exc}")
-                    _record_error(f"Failed to decrypt data_key for send entry {entry_id} user {user_id}: {dk_exc}")
+                    print(f"CRITICAL: Failed to decrypt data_key for {entry_label} {entry_id} user {user_id}: {dk_exc}")
+                    _record_error(f"Failed to decrypt data_key for {entry_label} {entry_id} user {user_id}: {dk_exc}")
                     decryption_failures += 1
                     release_entry_lock(client, entry_id)
-                    continue
+                    return None
 
                 security_key = base64.b64encode(data_key_bytes).decode("utf-8")
                 email_payload = build_unlock_email_payload(
@@ -1847,119 +3712,160 @@ def process_expired_entries(
                     viewer_link, security_key, from_email,
                 )
 
-            prepared_sends.append((entry_id, entry_title, recipient_email, viewer_link, security_key, email_payload))
+            return entry_id, entry_title, email_payload
 
         except Exception as exc:  # noqa: BLE001
             try:
                 release_entry_lock(client, entry_id)
             except Exception:  # noqa: BLE001
                 pass
-            print(f"SEND FAILED (prepare) entry {entry_id} user {user_id}: {type(exc).__name__}: {exc}")
-
-    # ── Phase 2+3: Send in chunks, mark entries as sent after each chunk ──
-    # Each chunk is up to RESEND_BATCH_LIMIT (100) emails via Resend batch API.
-    # Entries are marked "sent" IMMEDIATELY after their chunk succeeds, so they
-    # can never be re-claimed by claim_entry_for_sending on retry.  This
-    # eliminates all duplicate-email risk regardless of idempotency key expiry.
-    if prepared_sends:
-        all_entry_ids = [eid for eid, _, _, _, _, _ in prepared_sends]
-
-        # Stable idempotency key base: hash of sorted entry IDs
-        entry_hash = hashlib.md5(
-            "|".join(sorted(all_entry_ids)).encode()
-        ).hexdigest()[:16]
-        idem_base = f"unlock-batch-{user_id}-{entry_hash}"
-
-        total_chunks = (len(prepared_sends) + RESEND_BATCH_LIMIT - 1) // RESEND_BATCH_LIMIT
-        print(f"User {user_id}: sending {len(prepared_sends)} emails in {total_chunks} chunk(s)")
-
-        for chunk_start in range(0, len(prepared_sends), RESEND_BATCH_LIMIT):
-            # Early bail if Resend quota was hit by a previous chunk / email
-            if _resend_quota_exhausted:
-                for eid in all_entry_ids[chunk_start:]:
-                    try:
-                        release_entry_lock(client, eid)
-                    except Exception:  # noqa: BLE001
-                        pass
-                break
-
-            chunk = prepared_sends[chunk_start : chunk_start + RESEND_BATCH_LIMIT]
-            chunk_payloads = [p for _, _, _, _, _, p in chunk]
-            chunk_idx = chunk_start // RESEND_BATCH_LIMIT
-            chunk_key = idem_base if total_chunks == 1 else f"{idem_base}-{chunk_idx}"
-
+            print(f"SEND FAILED (prepare) {entry_label} {entry_id} user {user_id}: {type(exc).__name__}: {exc}")
+            return None
+
+    def _prepared_chunks():
+        """Yield lists of up to RESEND_BATCH_LIMIT prepared sends, loading and
+        decrypting ciphertexts one window of entries at a time."""
+        chunk: list[tuple[str, str, dict]] = []
+        for window_start in range(0, len(due_entries), RESEND_BATCH_LIMIT):
+            window = due_entries[window_start : window_start + RESEND_BATCH_LIMIT]
             try:
-                response = _post_json_with_retries(
-                    "https://api.resend.com/emails/batch",
-                    headers={
-                        "Authorization": f"Bearer {resend_key}",
-                        "Content-Type": "application/json",
-                    },
-                    payload=chunk_payloads,
-                    idempotency_key=chunk_key,
+                load_entry_ciphertexts(client, [
+                    e for e in window
+                    if (e.get("action_type") or "send").lower() != "destroy"
+                ])
+                # Large windows decrypt on a thread pool before their claims
+                predecrypted = predecrypt_entry_secrets(window, server_secret)
+            except Exception as exc:  # noqa: BLE001
+                # Nothing in this window is claimed yet: its entries stay
+                # active and are retried next run.
+                print(
+                    f"SEND FAILED (load) {len(window)} {entry_label}(s) user {user_id}: "
+                    f"{type(exc).__name__}: {exc} — left active for the next run"
                 )
-                if response.status_code >= 400:
-                    _mark_resend_quota_exhausted(response)
-                    raise RuntimeError(
-                        f"Resend batch error (chunk {chunk_idx}): "
-                        f"{response.status_code} {response.text}"
-                    )
-            except Exception as chunk_exc:  # noqa: BLE001
-                print(f"CHUNK {chunk_idx} FAILED for user {user_id}: "
-                      f"{type(chunk_exc).__name__}: {chunk_exc}")
-                # Release THIS chunk + all remaining chunks for retry next cycle
-                for eid in all_entry_ids[chunk_start:]:
-                    try:
-                        release_entry_lock(client, eid)
-                    except Exception:  # noqa: BLE001
-                        pass
-                break
-
-            # ── Chunk succeeded — mark entries as sent IMMEDIATELY ──
-            for entry_id, entry_title, *_ in chunk:
-                marked = False
-                for _mark_attempt in range(3):
-                    try:
-                        if mark_entry_sent(client, entry_id, now):
-                            marked = True
-                            break
-                    except Exception as mark_exc:  # noqa: BLE001
-                        if _mark_attempt == 2:
-                            print(f"Failed to mark entry {entry_id} as sent after 3 attempts: {mark_exc}")
-                    if _mark_attempt < 2:
-                        time.sleep(1)
-                if not marked:
-                    print(f"WARNING: Could not mark entry {entry_id} as sent — will be requeued")
-                    _record_warning(f"Could not mark entry {entry_id} as sent — will be requeued")
-                had_send = True
-                _metrics["entries_delivered"] += 1
-                try:
-                    send_executed_push(
-                        client, profile["id"], entry_id, entry_title, fcm_ctx,
-                    )
-                except Exception:  # noqa: BLE001
-                    pass
-
+                _record_error(f"Failed to load {entry_label} ciphertexts for user {user_id}: {exc}")
+                continue
+            for entry in window:
+                prepared = _prepare(entry, predecrypted)
+                if prepared is None:
+                    continue
+                chunk.append(prepared)
+                if len(chunk) == RESEND_BATCH_LIMIT:
+                    yield chunk
+                    chunk = []
+        if chunk:
+            yield chunk
+
+    def _send_chunk(chunk: list[tuple[str, str, dict]], chunk_idx: int) -> bool:
+        """Runs on the sender thread; False when the chunk was released instead of sent."""
+        chunk_ids = [entry_id for entry_id, _, _ in chunk]
+        if chunk_idx:
             # Throttle between chunks to respect Resend rate limits
-            if chunk_start + RESEND_BATCH_LIMIT < len(prepared_sends):
-                time.sleep(RESEND_INTER_CHUNK_DELAY)
+            time.sleep(RESEND_INTER_CHUNK_DELAY)
+        # Early bail if Resend quota was hit by a previous chunk / email
+        if _resend_quota_exhausted:
+            _release_entry_locks(client, chunk_ids)
+            return False
+
+        delivery_queue = _run_delivery_queue
+        if delivery_queue is not None:
+            # Concurrent users share full Resend batches
+            email_ids, batch_rejected = delivery_queue.send(
+                [(entry_id, payload) for entry_id, _, payload in chunk]
+            )
+            if email_ids is not None:
+                rejected_ids = [
+                    entry_id for (entry_id, _, _), email_id in zip(chunk, email_ids) if email_id is None
+                ]
+                if rejected_ids:
+                    # Only the rejected entries stay active for the next run
+                    _release_entry_locks(client, rejected_ids)
+                    chunk = [item for item, email_id in zip(chunk, email_ids) if email_id is not None]
+                    if not chunk:
+                        return False
+                return _finalize_chunk(chunk)
+            if _resend_quota_exhausted or not batch_rejected:
+                # The shared batch may have gone out (timeout, 5xx): a send
+                # under another key could deliver twice, so leave the entries
+                # for the next run.
+                print(f"CHUNK {chunk_idx} for {user_label}: shared batch failed — released for the next run")
+                _release_entry_locks(client, chunk_ids)
+                return False
+            # Resend refused the shared batch outright: retry this chunk as
+            # the user's own batch, keyed on this chunk's entries alone.
+            print(f"CHUNK {chunk_idx} for {user_label}: shared batch was rejected — sending it on its own")
+
+        # Stable idempotency key: hash of this chunk's sorted entry IDs
+        chunk_hash = hashlib.md5("|".join(sorted(chunk_ids)).encode()).hexdigest()[:16]
+        try:
+            response = _post_json_with_retries(
+                "https://api.resend.com/emails/batch",
+                headers={
+                    "Authorization": f"Bearer {resend_key}",
+                    "Content-Type": "application/json",
+                },
+                payload=[payload for _, _, payload in chunk],
+                idempotency_key=f"{idem_prefix}-{user_id}-{chunk_hash}",
+            )
+            if response.status_code >= 400:
+                _mark_resend_quota_exhausted(response)
+                raise RuntimeError(
+                    f"Resend batch error (chunk {chunk_idx}): "
+                    f"{response.status_code} {response.text}"
+                )
+        except Exception as chunk_exc:  # noqa: BLE001
+            print(f"CHUNK {chunk_idx} FAILED for {user_label}: "
+                  f"{type(chunk_exc).__name__}: {chunk_exc}")
+            # Release this chunk for retry next cycle
+            _release_entry_locks(client, chunk_ids)
+            return False
+
+        return _finalize_chunk(chunk)
+
+    def _finalize_chunk(chunk: list[tuple[str, str, dict]]) -> bool:
+        nonlocal delivered, sent_chunks
+        sent_chunks += 1
+        # ── Chunk succeeded — mark entries as sent IMMEDIATELY ──
+        for entry_id, entry_title, _ in chunk:
+            finalized = (
+                _finalize_scheduled_send(client, entry_id, now)
+                if scheduled
+                else _finalize_expired_send(client, profile, entry_id, entry_title, fcm_ctx, now)
+            )
+            if finalized:
+                delivered += 1
+        return True
+
+    chunks = _prepared_chunks()
+    in_flight = None
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="heartbeat-deliver") as sender:
+        try:
+            for chunk_idx, chunk in enumerate(chunks):
+                if in_flight is not None and not in_flight.result():
+                    # Previous chunk failed — release this one, leave the rest unclaimed
+                    _release_entry_locks(client, [entry_id for entry_id, _, _ in chunk])
+                    break
+                in_flight = sender.submit(_send_chunk, chunk, chunk_idx)
+        finally:
+            chunks.close()
+    if sent_chunks:
+        print(f"{user_label}: sent {delivered} email(s) in {sent_chunks} chunk(s)")
 
     # ── Post-loop integrity summary ──
     if hmac_mismatches > 0 and decryption_failures == 0:
         # All decryptions succeeded → data was NOT tampered, just key rotation.
         print(
-            f"HMAC-INFO: User {user_id}: {hmac_mismatches} HMAC mismatch(es) "
+            f"HMAC-INFO: {user_label}: {hmac_mismatches} HMAC mismatch(es) "
             f"but all AES-GCM decryptions succeeded — likely HMAC key rotation "
             f"(device change / app reinstall). Entries delivered normally."
         )
     elif decryption_failures > 0:
         # AES-GCM decryption failed → genuine corruption or tampering.
         print(
-            f"CRITICAL: User {user_id}: {decryption_failures} entry decryption "
+            f"CRITICAL: {user_label}: {decryption_failures} entry decryption "
             f"failure(s) detected — possible data corruption or tampering. "
             f"HMAC mismatches: {hmac_mismatches}."
         )
-        _record_error(f"User {user_id}: {decryption_failures} entry decryption failure(s) — possible tampering. HMAC mismatches: {hmac_mismatches}")
+        _record_error(f"{user_label}: {decryption_failures} entry decryption failure(s) — possible tampering. HMAC mismatches: {hmac_mismatches}")
         _try_send_tampering_notification(
             client=client,
             profile=profile,
@@ -1969,7 +3875,71 @@ def process_expired_entries(
             now=now,
         )
 
-    return had_send, input_send_count
+    return delivered
+
+
+def process_expired_entries(
+    client,
+    profile: dict,
+    entries: list[dict],
+    server_secret: str,
+    resend_key: str,
+    from_email: str,
+    viewer_base_url: str,
+    fcm_ctx: dict | None,
+    now: datetime,
+) -> tuple[bool, int]:
+    """Process expired vault entries using batch email sending.
+
+    Destroy entries are deleted; send entries stream through
+    deliver_due_entries (claim, HMAC check, decrypt, build payload, Resend
+    batch send, mark sent and push the owner), one chunk at a time.
+
+    Returns (had_send, input_send_count):
+      - had_send: True if any 'send' entries were successfully emailed
+      - input_send_count: number of send-type entries in the input
+    """
+    input_send_count = EntrySummary(entries).send_count
+
+    user_id = profile.get("id", "?")
+
+    hmac_key_encrypted = profile.get("hmac_key_encrypted")
+    hmac_key_bytes = None
+    if hmac_key_encrypted:
+        try:
+            hmac_key_bytes = decrypt_user_hmac_key(hmac_key_encrypted, server_secret)
+        except Exception as exc:  # noqa: BLE001
+            print(f"WARNING: Failed to decrypt HMAC key for user {user_id}: {exc} — delivery will proceed without HMAC check")
+            _record_warning(f"Failed to decrypt HMAC key for user {user_id}: {exc}")
+    elif input_send_count > 0:
+        print(f"WARNING: User {user_id} has {input_send_count} send entries but hmac_key_encrypted is NULL — delivery will proceed without HMAC check")
+        _record_warning(f"User {user_id} has {input_send_count} send entries but hmac_key_encrypted is NULL")
+
+    # Skip recurring (Forever Letters) — never consumed by timer expiry.
+    # Destroy entries go first: a capped user then always has its remaining
+    # send entries in a later run, so the last run still sees had_send and
+    # starts the grace period instead of the destroy-only reset.
+    due_entries = cap_user_entries(
+        sorted(
+            (e for e in entries if _entry_mode(e) != "recurring"),
+            key=lambda e: (e.get("action_type") or "send").lower() != "destroy",
+        ),
+        user_id,
+    )
+
+    delivered = deliver_due_entries(
+        client,
+        profile,
+        due_entries,
+        hmac_key_bytes=hmac_key_bytes,
+        server_secret=server_secret,
+        resend_key=resend_key,
+        from_email=from_email,
+        viewer_base_url=viewer_base_url,
+        now=now,
+        fcm_ctx=fcm_ctx,
+    )
+    return delivered > 0, input_send_count
 
 
 def process_scheduled_entries(
@@ -1992,288 +3962,79 @@ def process_scheduled_entries(
 
     Returns the number of entries successfully sent.
     """
-    sender_name = profile.get("sender_name") or "Afterword"
     user_id = str(profile.get("id", "?"))
-    sent_count = 0
-
-    # Counters for post-loop integrity summary (parity with process_expired_entries)
-    hmac_mismatches = 0
-    decryption_failures = 0
 
     # Filter to entries whose scheduled_at has arrived
     due_entries = []
     for entry in entries:
         # Skip recurring (Forever Letters) — handled by process_recurring_entries
-        if (entry.get("entry_mode") or "standard") == "recurring":
+        if _entry_mode(entry) == "recurring":
             continue
         scheduled_at_str = entry.get("scheduled_at")
         if not scheduled_at_str:
             continue
-        scheduled_at = parse_iso(scheduled_at_str)
+        scheduled_at = _entry_scheduled_at(entry)
         if scheduled_at is not None and scheduled_at <= now:
             due_entries.append(entry)
 
     if not due_entries:
         return 0
+    # Oldest capsules first when the per-user cap holds some back
+    due_entries.sort(key=_entry_scheduled_at)
+    due_entries = cap_user_entries(due_entries, user_id)
 
     hmac_key_encrypted = profile.get("hmac_key_encrypted")
     hmac_key_bytes = None
     if hmac_key_encrypted:
         try:
-            hmac_key_bytes = decrypt_with_server_secret(hmac_key_encrypted, server_secret)
+            hmac_key_bytes = decrypt_user_hmac_key(hmac_key_encrypted, server_secret)
         except Exception as exc:  # noqa: BLE001
             print(f"WARNING: Failed to decrypt HMAC key for scheduled user {user_id}: {exc}")
             _record_warning(f"Failed to decrypt HMAC key for scheduled user {user_id}: {exc}")
 
-    prepared_sends: list[tuple[str, str, str, str, str | None, dict]] = []
+    sent_count = deliver_due_entries(
+        client,
+        profile,
+        due_entries,
+        hmac_key_bytes=hmac_key_bytes,
+        server_secret=server_secret,
+        resend_key=resend_key,
+        from_email=from_email,
+        viewer_base_url=viewer_base_url,
+        now=now,
+        scheduled=True,
+    )
 
-    for entry in due_entries:
-        entry_id = entry.get("id", "unknown")
+    if sent_count > 0:
         try:
-            if not claim_entry_for_sending(client, entry_id):
-                continue
-
-            action = (entry.get("action_type") or "send").lower()
+            client.table("profiles").update({
+                "had_vault_activity": True,
+            }).eq("id", user_id).execute()
+        except Exception:  # noqa: BLE001
+            pass
+        print(f"User {user_id} (scheduled): {sent_count} entries delivered")
 
-            if action == "destroy":
-                entry_title = entry.get("title") or "Untitled"
-                delete_entry(client, entry)
-                _metrics["entries_destroyed"] += 1
-                continue
+    return sent_count
 
-            # Decrypt recipient email
-            recipient_encrypted = entry.get("recipient_email_encrypted") or ""
 
-            # ── HMAC integrity check (advisory, NOT a delivery gate) ──
-            # Mirrors process_expired_entries: AES-GCM is the authoritative
-            # tamper check; HMAC mismatches are usually key rotation.
-            if hmac_key_bytes is not None:
-                signature_message = f"{entry.get('payload_encrypted')}|{recipient_encrypted}"
-                expected_signature = compute_hmac_signature(signature_message, hmac_key_bytes)
-                hmac_ok = expected_signature == entry.get("hmac_signature")
-                if not hmac_ok:
-                    hmac_mismatches += 1
+def process_recurring_entries(
+    client,
+    profile: dict,
+    entries: list[dict],
+    server_secret: str,
+    resend_key: str,
+    from_email: str,
+    viewer_base_url: str,
+    now: datetime,
+) -> int:
+    """Process recurring (Forever Letters) entries whose annual date has arrived.
 
-            if not recipient_encrypted:
-                print(f"CRITICAL: Empty recipient for scheduled entry {entry_id} user {user_id}")
-                _record_error(f"Empty recipient for scheduled entry {entry_id} user {user_id}")
-                release_entry_lock(client, entry_id)
-                continue
-
-            try:
-                recipient_ciphertext = extract_server_ciphertext(recipient_encrypted)
-                recipient_email = decrypt_with_server_secret(
-                    recipient_ciphertext, server_secret
-                ).decode("utf-8").strip()
-            except Exception as dec_exc:  # noqa: BLE001
-                print(f"CRITICAL: Failed to decrypt recipient for scheduled entry {entry_id}: {dec_exc}")
-                _record_error(f"Failed to decrypt recipient for scheduled entry {entry_id}: {dec_exc}")
-                decryption_failures += 1
-                release_entry_lock(client, entry_id)
-                continue
-
-            if not _EMAIL_RE.match(recipient_email):
-                print(f"CRITICAL: Invalid recipient email format for scheduled entry {entry_id}")
-                _record_error(f"Invalid recipient email format for scheduled entry {entry_id}")
-                release_entry_lock(client, entry_id)
-                continue
-
-            # Decrypt data key or handle ZK
-            is_zk = entry.get("is_zero_knowledge", False)
-            viewer_link = build_viewer_link(viewer_base_url, entry_id)
-            entry_title = entry.get("title") or "Untitled"
-
-            if is_zk:
-                security_key = None
-                email_payload = build_zk_unlock_email_payload(
-                    recipient_email, entry_id, sender_name, entry_title,
-                    viewer_link, from_email,
-                )
-            else:
-                data_key_encrypted = entry.get("data_key_encrypted")
-                if not data_key_encrypted:
-                    print(f"CRITICAL: Missing data_key for scheduled entry {entry_id}")
-                    _record_error(f"Missing data_key for scheduled entry {entry_id}")
-                    release_entry_lock(client, entry_id)
-                    continue
-
-                try:
-                    data_key_ciphertext = extract_server_ciphertext(data_key_encrypted)
-                    data_key_bytes = decrypt_with_server_secret(data_key_ciphertext, server_secret)
-                except Exception as dk_exc:  # noqa: BLE001
-                    print(f"CRITICAL: Failed to decrypt data_key for scheduled entry {entry_id}: {dk_exc}")
-                    _record_error(f"Failed to decrypt data_key for scheduled entry {entry_id}: {dk_exc}")
-                    decryption_failures += 1
-                    release_entry_lock(client, entry_id)
-                    continue
-
-                security_key = base64.b64encode(data_key_bytes).decode("utf-8")
-                email_payload = build_unlock_email_payload(
-                    recipient_email, entry_id, sender_name, entry_title,
-                    viewer_link, security_key, from_email,
-                )
-
-            prepared_sends.append((entry_id, entry_title, recipient_email, viewer_link, security_key, email_payload))
-
-        except Exception as exc:  # noqa: BLE001
-            try:
-                release_entry_lock(client, entry_id)
-            except Exception:  # noqa: BLE001
-                pass
-            print(f"SEND FAILED (prepare) scheduled entry {entry_id} user {user_id}: {exc}")
-
-    # Send prepared emails in batches
-    if prepared_sends:
-        all_entry_ids = [eid for eid, _, _, _, _, _ in prepared_sends]
-        entry_hash = hashlib.md5(
-            "|".join(sorted(all_entry_ids)).encode()
-        ).hexdigest()[:16]
-        idem_base = f"scheduled-batch-{user_id}-{entry_hash}"
-
-        total_chunks = (len(prepared_sends) + RESEND_BATCH_LIMIT - 1) // RESEND_BATCH_LIMIT
-        print(f"User {user_id} (scheduled): sending {len(prepared_sends)} emails in {total_chunks} chunk(s)")
-
-        for chunk_start in range(0, len(prepared_sends), RESEND_BATCH_LIMIT):
-            if _resend_quota_exhausted:
-                for eid in all_entry_ids[chunk_start:]:
-                    try:
-                        release_entry_lock(client, eid)
-                    except Exception:  # noqa: BLE001
-                        pass
-                break
-
-            chunk = prepared_sends[chunk_start : chunk_start + RESEND_BATCH_LIMIT]
-            chunk_payloads = [p for _, _, _, _, _, p in chunk]
-            chunk_idx = chunk_start // RESEND_BATCH_LIMIT
-            chunk_key = idem_base if total_chunks == 1 else f"{idem_base}-{chunk_idx}"
-
-            try:
-                response = _post_json_with_retries(
-                    "https://api.resend.com/emails/batch",
-                    headers={
-                        "Authorization": f"Bearer {resend_key}",
-                        "Content-Type": "application/json",
-                    },
-                    payload=chunk_payloads,
-                    idempotency_key=chunk_key,
-                )
-                if response.status_code >= 400:
-                    _mark_resend_quota_exhausted(response)
-                    raise RuntimeError(
-                        f"Resend batch error (chunk {chunk_idx}): "
-                        f"{response.status_code} {response.text}"
-                    )
-            except Exception as chunk_exc:  # noqa: BLE001
-                print(f"CHUNK {chunk_idx} FAILED for scheduled user {user_id}: {chunk_exc}")
-                for eid in all_entry_ids[chunk_start:]:
-                    try:
-                        release_entry_lock(client, eid)
-                    except Exception:  # noqa: BLE001
-                        pass
-                break
-
-            # Mark entries as sent with per-entry grace_until
-            for entry_id, entry_title, *_ in chunk:
-                marked = False
-                for _mark_attempt in range(3):
-                    try:
-                        if mark_entry_sent(client, entry_id, now):
-                            # Set per-entry grace_until = now + 30 days
-                            grace_until = (now + timedelta(days=30)).isoformat()
-                            gu_ok = False
-                            for _gu_attempt in range(3):
-                                try:
-                                    client.table("vault_entries").update({
-                                        "grace_until": grace_until,
-                                    }).eq("id", entry_id).execute()
-                                    # Double-guard: verify grace_until persisted
-                                    verify = client.table("vault_entries").select("grace_until").eq("id", entry_id).execute()
-                                    if verify.data and verify.data[0].get("grace_until"):
-                                        gu_ok = True
-                                        break
-                                    else:
-                                        print(f"WARNING: grace_until write silently reverted for {entry_id} (attempt {_gu_attempt + 1})")
-                                        _record_warning(f"grace_until write silently reverted for {entry_id} (attempt {_gu_attempt + 1})")
-                                except Exception:  # noqa: BLE001
-                                    if _gu_attempt < 2:
-                                        time.sleep(0.5)
-                            if not gu_ok:
-                                # Email already sent — do NOT revert to active.
-                                # Reverting would cause duplicate emails on next run.
-                                # Missing grace_until just means the entry won't
-                                # auto-cleanup, which is far safer than re-sending.
-                                print(f"WARNING: grace_until failed for scheduled entry {entry_id}, keeping status=sent (no revert)")
-                                _record_warning(f"grace_until failed for scheduled entry {entry_id}, keeping status=sent")
-                            marked = True
-                            break
-                    except Exception as mark_exc:  # noqa: BLE001
-                        if _mark_attempt == 2:
-                            print(f"Failed to mark scheduled entry {entry_id} as sent: {mark_exc}")
-                    if _mark_attempt < 2:
-                        time.sleep(1)
-                if marked:
-                    sent_count += 1
-                    _metrics["scheduled_delivered"] += 1
-
-            if chunk_start + RESEND_BATCH_LIMIT < len(prepared_sends):
-                time.sleep(RESEND_INTER_CHUNK_DELAY)
-
-    if sent_count > 0:
-        try:
-            client.table("profiles").update({
-                "had_vault_activity": True,
-            }).eq("id", user_id).execute()
-        except Exception:  # noqa: BLE001
-            pass
-        print(f"User {user_id} (scheduled): {sent_count} entries delivered")
-
-    # ── Post-loop integrity summary (parity with process_expired_entries) ──
-    if hmac_mismatches > 0 and decryption_failures == 0:
-        print(
-            f"HMAC-INFO: User {user_id} (scheduled): {hmac_mismatches} HMAC "
-            f"mismatch(es) but all AES-GCM decryptions succeeded — likely "
-            f"HMAC key rotation (device change / app reinstall). "
-            f"Entries delivered normally."
-        )
-    elif decryption_failures > 0:
-        print(
-            f"CRITICAL: User {user_id} (scheduled): {decryption_failures} "
-            f"entry decryption failure(s) detected — possible data "
-            f"corruption or tampering. HMAC mismatches: {hmac_mismatches}."
-        )
-        _record_error(f"User {user_id} (scheduled): {decryption_failures} entry decryption failure(s) — possible tampering. HMAC mismatches: {hmac_mismatches}")
-        _try_send_tampering_notification(
-            client=client,
-            profile=profile,
-            resend_key=resend_key,
-            from_email=from_email,
-            decryption_failures=decryption_failures,
-            now=now,
-        )
-
-    return sent_count
-
-
-def process_recurring_entries(
-    client,
-    profile: dict,
-    entries: list[dict],
-    server_secret: str,
-    resend_key: str,
-    from_email: str,
-    viewer_base_url: str,
-    now: datetime,
-) -> int:
-    """Process recurring (Forever Letters) entries whose annual date has arrived.
-
-    Recurring entries are never marked as 'sent'. Instead, last_sent_year is
-    updated so we only send once per calendar year.  Feb 29 entries fire on
-    Feb 28 in non-leap years.
+    Recurring entries are never marked as 'sent'. Instead, last_sent_year is
+    updated so we only send once per calendar year.  Feb 29 entries fire on
+    Feb 28 in non-leap years.
 
     Returns the number of entries successfully sent this run.
     """
-    import calendar
-
     sender_name = profile.get("sender_name") or "Afterword"
     user_id = str(profile.get("id", "?"))
     current_year = now.year
@@ -2284,12 +4045,12 @@ def process_recurring_entries(
 
     due_entries = []
     for entry in entries:
-        if (entry.get("entry_mode") or "standard") != "recurring":
+        if _entry_mode(entry) != "recurring":
             continue
         scheduled_at_str = entry.get("scheduled_at")
         if not scheduled_at_str:
             continue
-        scheduled_at = parse_iso(scheduled_at_str)
+        scheduled_at = _entry_scheduled_at(entry)
         if scheduled_at is None:
             continue
 
@@ -2323,6 +4084,8 @@ def process_recurring_entries(
 
     print(f"User {user_id} (recurring): {len(due_entries)} Forever Letter(s) due today")
 
+    load_entry_ciphertexts(client, due_entries)
+
     for entry in due_entries:
         if _resend_quota_exhausted:
             print(f"Resend quota exhausted, deferring remaining recurring entries for {user_id}")
@@ -2431,7 +4194,7 @@ def process_recurring_entries(
                     time.sleep(1)
 
             sent_count += 1
-            _metrics["recurring_sent"] += 1
+            _incr_metric("recurring_sent")
             print(f"Recurring entry {entry_id} ('{entry_title}') sent for year {current_year}{'' if year_updated else ' (last_sent_year update FAILED — may re-send)'}")
 
         except Exception as exc:  # noqa: BLE001
@@ -2481,24 +4244,13 @@ def cleanup_sent_entries(client) -> None:
     total_tombstoned = 0
     reset_count = 0
 
-    last_profile_id: str | None = None
-    while True:
-        prof_q = (
-            client.table("profiles")
-            .select("id,sender_name,timer_days")
-            .eq("status", "inactive")
-            .lte("protocol_executed_at", cutoff)
-            .order("id")
-            .limit(PROFILE_BATCH_SIZE)
-        )
-        if last_profile_id is not None:
-            prof_q = prof_q.gt("id", last_profile_id)
-        prof_resp = prof_q.execute()
-        profiles = prof_resp.data or []
-        if not profiles:
-            break
-        last_profile_id = str(profiles[-1]["id"])
-
+    for profiles in keyset_pages(
+        client.table("profiles")
+        .select("id,sender_name,timer_days")
+        .eq("status", "inactive")
+        .lte("protocol_executed_at", cutoff),
+        page_size=PROFILE_BATCH_SIZE,
+    ):
         for profile in profiles:
             uid = str(profile["id"])
             sender_name = profile.get("sender_name") or "Afterword"
@@ -2538,24 +4290,12 @@ def cleanup_sent_entries(client) -> None:
                     continue
 
                 # Delete ALL sent entries for this user (grace ended = immediate cleanup)
-                last_entry_id: str | None = None
-                while True:
-                    entry_q = (
-                        client.table("vault_entries")
-                        .select("id,user_id,audio_file_path,sent_at,scheduled_at")
-                        .eq("user_id", uid)
-                        .eq("status", "sent")
-                        .order("id")
-                        .limit(PAGE_SIZE)
-                    )
-                    if last_entry_id is not None:
-                        entry_q = entry_q.gt("id", last_entry_id)
-                    entry_resp = entry_q.execute()
-                    entries = entry_resp.data or []
-                    if not entries:
-                        break
-                    last_entry_id = str(entries[-1]["id"])
-
+                for entries in keyset_pages(
+                    client.table("vault_entries")
+                    .select("id,user_id,audio_file_path,sent_at,scheduled_at")
+                    .eq("user_id", uid)
+                    .eq("status", "sent")
+                ):
                     total_found += len(entries)
                     for entry in entries:
                         # Create tombstone BEFORE deleting (preserves History tab data).
@@ -2639,24 +4379,12 @@ def cleanup_sent_entries(client) -> None:
     per_entry_deleted = 0
     per_entry_tombstoned = 0
     now_iso_pe = datetime.now(timezone.utc).isoformat()
-    last_entry_id_pe: str | None = None
-    while True:
-        eq = (
-            client.table("vault_entries")
-            .select("id,user_id,audio_file_path,sent_at,scheduled_at")
-            .eq("status", "sent")
-            .lte("grace_until", now_iso_pe)
-            .order("id")
-            .limit(PAGE_SIZE)
-        )
-        if last_entry_id_pe is not None:
-            eq = eq.gt("id", last_entry_id_pe)
-        resp = eq.execute()
-        entries_pe = resp.data or []
-        if not entries_pe:
-            break
-        last_entry_id_pe = str(entries_pe[-1]["id"])
-
+    for entries_pe in keyset_pages(
+        client.table("vault_entries")
+        .select("id,user_id,audio_file_path,sent_at,scheduled_at")
+        .eq("status", "sent")
+        .lte("grace_until", now_iso_pe)
+    ):
         for entry in entries_pe:
             eid = entry.get("id", "?")
             uid = entry.get("user_id", "?")
@@ -2706,7 +4434,7 @@ def cleanup_sent_entries(client) -> None:
             f"tombstoned={per_entry_tombstoned} deleted={per_entry_deleted}"
         )
 
-    _metrics["entries_cleaned_up"] += total_deleted + per_entry_deleted
+    _incr_metric("entries_cleaned_up", total_deleted + per_entry_deleted)
 
 
 def cleanup_bot_accounts(client, now: datetime) -> None:
@@ -2726,30 +4454,21 @@ def cleanup_bot_accounts(client, now: datetime) -> None:
     """
     cutoff = (now - timedelta(days=90)).isoformat()
 
-    # Keyset-paginate candidate profiles to avoid loading millions into memory
-    last_seen_id: str | None = None
-    while True:
-        query = (
-            client.table("profiles")
-            .select("id,email,created_at,last_check_in,had_vault_activity")
-            .eq("status", "active")
-            .lt("created_at", cutoff)
-            .order("id")
-            .limit(PROFILE_BATCH_SIZE)
-        )
-        if last_seen_id is not None:
-            query = query.gt("id", last_seen_id)
-        response = query.execute()
-        candidates = response.data or []
-        if not candidates:
-            break
-        last_seen_id = str(candidates[-1]["id"])
-
+    # Keyset-paginate candidate profiles to avoid loading millions into memory;
+    # the next page loads while this one's per-user checks run.
+    for candidates in keyset_pages(
+        client.table("profiles")
+        .select("id,email,created_at,last_check_in,had_vault_activity")
+        .eq("status", "active")
+        .lt("created_at", cutoff),
+        page_size=PROFILE_BATCH_SIZE,
+        prefetch=1,
+    ):
         for profile in candidates:
             try:
                 uid = profile["id"]
                 created_at = parse_iso(profile.get("created_at"))
-                last_check_in = parse_iso(profile.get("last_check_in"))
+                last_check_in = _profile_last_check_in(profile)
 
                 if created_at is None or last_check_in is None:
                     continue
@@ -2786,7 +4505,7 @@ def cleanup_bot_accounts(client, now: datetime) -> None:
                 # No activity at all — delete the auth user (cascades to profile + push_devices)
                 try:
                     client.auth.admin.delete_user(uid)
-                    _metrics["bots_cleaned_up"] += 1
+                    _incr_metric("bots_cleaned_up")
                     print(f"Deleted inactive bot account: {uid}")
                 except Exception as exc:  # noqa: BLE001
                     print(f"Failed to delete bot account {uid}: {exc}")
@@ -2899,14 +4618,15 @@ def verify_subscription_with_revenuecat(
     session = _get_http_session()
     url = f"https://api.revenuecat.com/v1/subscribers/{requests.utils.quote(user_id, safe='')}"
     try:
-        resp = session.get(
-            url,
-            headers={
-                "Authorization": f"Bearer {rc_api_secret}",
-                "Content-Type": "application/json",
-            },
-            timeout=REQUEST_TIMEOUT_SECONDS,
-        )
+        with _timed_op("rc_call"):
+            resp = session.get(
+                url,
+                headers={
+                    "Authorization": f"Bearer {rc_api_secret}",
+                    "Content-Type": "application/json",
+                },
+                timeout=REQUEST_TIMEOUT_SECONDS,
+            )
     except Exception as exc:  # noqa: BLE001
         print(f"RC verify failed for {user_id}: {type(exc).__name__}: {exc}")
         return None
@@ -3075,7 +4795,7 @@ def handle_subscription_downgrade(
 
     # Detect recurring (Forever Letters) entries
     has_recurring = any(
-        (entry.get("entry_mode") or "standard") == "recurring"
+        _entry_mode(entry) == "recurring"
         for entry in active_entries
     )
 
@@ -3122,16 +4842,20 @@ def handle_subscription_downgrade(
     if not needs_revert and downgrade_email_pending:
         if email:
             subject, text, html = _build_downgrade_email(sender_name, had_audio=False)
+            def _retry_sent() -> None:
+                client.table("profiles").update({
+                    "downgrade_email_pending": False,
+                }).eq("id", uid).execute()
+                print(f"Sent deferred downgrade notification to {uid}")
+
             try:
-                send_email(
+                send_notification_email(
                     resend_key, from_email, email, subject, text, html,
                     idempotency_key=f"downgrade-retry-{uid}-{now.date().isoformat()}",
                     preheader=f"Hi {sender_name}, your Afterword subscription has changed — here is what happened to your account.",
+                    on_sent=_retry_sent,
+                    batchable=False,
                 )
-                client.table("profiles").update({
-                    "downgrade_email_pending": False,
-                }).eq("id", uid).execute()
-                print(f"Sent deferred downgrade notification to {uid}")
             except Exception as exc:  # noqa: BLE001
                 print(f"Deferred downgrade email still failing for {uid}: {exc}")
         else:
@@ -3212,8 +4936,16 @@ def handle_subscription_downgrade(
     # 3. Send notification email
     if email_content:
         subject, text, html = email_content
+
+        def _downgrade_sent() -> None:
+            # Email succeeded — clear the pending flag
+            client.table("profiles").update({
+                "downgrade_email_pending": False,
+            }).eq("id", uid).execute()
+            print(f"Sent downgrade notification to {uid}")
+
         try:
-            send_email(
+            send_notification_email(
                 resend_key,
                 from_email,
                 email,
@@ -3222,794 +4954,1537 @@ def handle_subscription_downgrade(
                 html,
                 idempotency_key=f"downgrade-{uid}-{now.date().isoformat()}",
                 preheader=f"Hi {sender_name}, your Afterword subscription has changed — here is what happened to your account.",
+                on_sent=_downgrade_sent,
             )
-            # Email succeeded — clear the pending flag
-            client.table("profiles").update({
-                "downgrade_email_pending": False,
-            }).eq("id", uid).execute()
-            print(f"Sent downgrade notification to {uid}")
         except Exception as exc:  # noqa: BLE001
             # Email failed — downgrade_email_pending stays True for retry
             print(f"Failed to send downgrade email to {uid}: {exc} — will retry next run")
 
-    _metrics["downgrades_processed"] += 1
+    _incr_metric("downgrades_processed")
     return True
 
 
-def main() -> int:
-
-    global _resend_quota_exhausted
-    _resend_quota_exhausted = False  # Reset for each run/retry
-
-    supabase_url = get_env("SUPABASE_URL")
-
-    supabase_key = get_env("SUPABASE_SERVICE_ROLE_KEY")
-
-    server_secret = get_env("SERVER_SECRET")
-
-    resend_key = get_env("RESEND_API_KEY")
-
-    from_email = get_env("RESEND_FROM_EMAIL")
-
-    viewer_base_url = get_env("VIEWER_BASE_URL")
-
-    firebase_sa_json = os.getenv("FIREBASE_SERVICE_ACCOUNT_JSON", "")
+def process_profile(
+    client,
+    profile: dict,
+    active_entries: list[dict],
+    *,
+    server_secret: str,
+    resend_key: str,
+    from_email: str,
+    viewer_base_url: str,
+    fcm_ctx: dict | None,
+    rc_api_secret: str,
+    now: datetime,
+) -> None:
+    """Run every heartbeat pass for a single active profile.
 
-    rc_api_secret = os.getenv("REVENUECAT_API_SECRET", "")
-    if not rc_api_secret:
-        print("WARNING: REVENUECAT_API_SECRET not set — server-side subscription verification disabled")
-        _record_warning("REVENUECAT_API_SECRET not set — server-side subscription verification disabled")
+    Passes for one user always run in this order: RC verification, timer
+    expiry (PASS 1), subscription downgrade (PASS 0), Forever Letters, then
+    the 66% / 33% pushes and the 24h warning email.  Callers may process
+    different users concurrently, but never split one user across threads.
+    """
+    user_id = str(profile["id"])
+
+    # ── Scheduled mode (Time Capsule): process per-entry delivery ──
+    # No global timer, no push notifications, no warnings.
+    app_mode = (profile.get("app_mode") or "vault").lower()
+    if app_mode == "scheduled":
+        sub_status = (profile.get("subscription_status") or "free").lower()
+
+        # RC verification for scheduled mode users — same logic as vault mode:
+        #   - Paid → catch cancellations
+        #   - Free with pro indicators → catch missed webhook upgrades
+        #   - Pending downgrade email → confirm still free
+        if rc_api_secret:
+            _sc_theme = profile.get("selected_theme")
+            _sc_sf = profile.get("selected_soul_fire")
+            sc_has_pro = (
+                int(profile.get("timer_days") or 30) != 30
+                or _sc_theme not in FREE_THEMES
+                or _sc_sf not in FREE_SOUL_FIRES
+            )
+            sc_needs_rc = (
+                sub_status in PAID_STATUSES
+                or sc_has_pro
+                or profile.get("downgrade_email_pending")
+            )
+            # A pending downgrade email is always confirmed; routine
+            # verification may be shed when the run is short on time.
+            if sc_needs_rc and not profile.get("downgrade_email_pending"):
+                sc_needs_rc = not defer_optional_pass("rc_verification")
+            if sc_needs_rc:
+                try:
+                    _throttle_revenuecat()
+                    rc_status = verify_subscription_with_revenuecat(rc_api_secret, user_id)
+                    _incr_metric("rc_verifications")
+                    if rc_status is not None and rc_status != sub_status:
+                        if sub_status in PAID_STATUSES and rc_status == "free":
+                            print(
+                                f"RC DOWNGRADE (scheduled): user {user_id} was {sub_status} "
+                                f"in DB but RC says free — applying downgrade."
+                            )
+                        else:
+                            print(f"RC verify (scheduled): user {user_id} DB={sub_status} RC={rc_status} — updating DB")
+                        try:
+                            client.table("profiles").update({
+                                "subscription_status": rc_status,
+                            }).eq("id", user_id).execute()
+                            sub_status = rc_status
+                            profile["subscription_status"] = rc_status
+                        except Exception as db_exc:  # noqa: BLE001
+                            print(f"Failed to update subscription for scheduled user {user_id}: {db_exc}")
+                except Exception as rc_exc:  # noqa: BLE001
+                    print(f"RC verify error for scheduled user {user_id}: {rc_exc}")
+
+        # Clear stale downgrade flag when user re-subscribes
+        if sub_status in PAID_STATUSES and profile.get("downgrade_email_pending"):
+            try:
+                client.table("profiles").update({
+                    "downgrade_email_pending": False,
+                }).eq("id", user_id).execute()
+                profile["downgrade_email_pending"] = False
+            except Exception:  # noqa: BLE001
+                pass
 
-    client = create_client(supabase_url, supabase_key)
+        # Subscription downgrade for scheduled mode
+        if sub_status == "free":
+            try:
+                reverted = handle_subscription_downgrade(
+                    client, profile, active_entries, resend_key, from_email, now,
+                )
+                if reverted:
+                    return
+            except Exception as dg_exc:  # noqa: BLE001
+                print(f"Downgrade handling failed for scheduled user {user_id}: {dg_exc}")
+
+        if active_entries:
+            # Process recurring (Forever Letters) FIRST — they are time-critical
+            # (birthdays, anniversaries) and must not be blocked by rate limits
+            # from bulk scheduled entries.
+            try:
+                process_recurring_entries(
+                    client, profile, active_entries, server_secret,
+                    resend_key, from_email, viewer_base_url, now,
+                )
+            except Exception as exc:  # noqa: BLE001
+                print(f"Recurring processing failed for {user_id}: {exc}")
 
-    now = datetime.now(timezone.utc)
+            try:
+                process_scheduled_entries(
+                    client, profile, active_entries, server_secret,
+                    resend_key, from_email, viewer_base_url, now,
+                )
+            except Exception as exc:  # noqa: BLE001
+                print(f"Scheduled processing failed for {user_id}: {exc}")
+        return
 
-    fcm_ctx = build_fcm_context(firebase_sa_json)
-    fcm_token_minted_at = now  # track when FCM token was last refreshed
+    last_check_in = _profile_last_check_in(profile)
 
-    requeue_stale_sending_entries(client, now)
+    if last_check_in is None:
+        print(f"WARN: User {user_id} has NULL last_check_in — skipping (timer cannot be computed)")
+        _record_warning(f"User {user_id} has NULL last_check_in — skipping")
+        return
 
-    try:
-        heal_inconsistent_profiles(client, now)
-    except Exception as exc:  # noqa: BLE001
-        print(f"heal_inconsistent_profiles failed: {exc}")
 
-    processed_profiles = 0
 
-    processed_entries = 0
+    timer_state = build_timer_state(last_check_in, profile.get("timer_days"), now)
 
-    start_time = time.monotonic()
-    run_started_at = datetime.now(timezone.utc).isoformat()
-    _reset_metrics()
+    deadline = timer_state.deadline
 
-    # Install stdout tee to capture full log
-    global _log_buffer
-    _log_buffer = _TeeWriter(sys.stdout)
-    sys.stdout = _log_buffer
 
-    for profile_batch in iter_active_profiles(client):
+    entry_summary = EntrySummary(active_entries)
 
-      # Refresh `now` each batch so timestamps stay accurate during multi-hour runs
-      now = datetime.now(timezone.utc)
+    # has_entries excludes recurring — guardian timer logic only cares about standard/scheduled entries
+    has_entries = entry_summary.has_entries
 
-      # Runtime guard: exit gracefully before GH Actions kills the job
-      elapsed = time.monotonic() - start_time
-      if elapsed > MAX_RUNTIME_SECONDS:
-          print(f"Runtime limit reached ({elapsed:.0f}s). Exiting gracefully — "
-                f"remaining users will be processed next run.")
-          break
+    sender_name = profile.get("sender_name") or "Afterword"
+    sub_status = (profile.get("subscription_status") or "free").lower()
+
+    # ── PRE-PASS: Server-side RC subscription verification ──
+    # Query RevenueCat directly to get authoritative status.
+    # This catches upgrades, downgrades, renewals, and cancellations
+    # even when the client is logged out, phone destroyed, or webhook failed.
+    #
+    # SCALABILITY: At ~1.1s per RC call (rate-limited to ~60 req/min),
+    # verifying every user is too slow at scale. We only verify users where a mismatch
+    # is plausible:
+    #   - Paid users → catch cancellations, expirations, refunds
+    #   - Free users with pro indicators → catch missed webhook upgrades
+    #   - Users with pending downgrade email → confirm still free
+    # Free users with NO pro indicators are the vast majority and need no
+    # verification — they were never paid or have already been downgraded.
+    if rc_api_secret:
+        selected_theme = profile.get("selected_theme")
+        selected_soul_fire = profile.get("selected_soul_fire")
+        has_pro_indicators = (
+            int(profile.get("timer_days") or 30) != 30
+            or selected_theme not in FREE_THEMES
+            or selected_soul_fire not in FREE_SOUL_FIRES
+        )
+        needs_rc_verify = (
+            sub_status in PAID_STATUSES  # paid → catch cancellations
+            or has_pro_indicators         # free + pro artifacts → missed webhook
+            or profile.get("downgrade_email_pending")  # pending email → confirm status
+        )
+        if needs_rc_verify and not profile.get("downgrade_email_pending"):
+            needs_rc_verify = not defer_optional_pass("rc_verification")
+        if needs_rc_verify:
+            try:
+                _throttle_revenuecat()
+                rc_status = verify_subscription_with_revenuecat(
+                    rc_api_secret, user_id,
+                )
+                _incr_metric("rc_verifications")
+                if rc_status is not None and rc_status != sub_status:
+                    # Safety audit: log paid→free transitions prominently
+                    if sub_status in PAID_STATUSES and rc_status == "free":
+                        print(
+                            f"RC DOWNGRADE: user {user_id} was {sub_status} "
+                            f"in DB but RC says free — applying downgrade. "
+                            f"Pro indicators: timer={profile.get('timer_days')}, "
+                            f"theme={profile.get('selected_theme')}, "
+                            f"soul_fire={profile.get('selected_soul_fire')}"
+                        )
+                    else:
+                        print(f"RC verify: user {user_id} DB={sub_status} RC={rc_status} — updating DB")
+                    try:
+                        client.table("profiles").update({
+                            "subscription_status": rc_status,
+                        }).eq("id", user_id).execute()
+                        sub_status = rc_status
+                        profile["subscription_status"] = rc_status
+                    except Exception as db_exc:  # noqa: BLE001
+                        print(f"Failed to update subscription for {user_id}: {db_exc}")
+            except Exception as rc_exc:  # noqa: BLE001
+                print(f"RC verify error for {user_id}: {rc_exc}")
+
+    # Clear stale downgrade flag when user re-subscribes
+    if sub_status in PAID_STATUSES and profile.get("downgrade_email_pending"):
+        try:
+            client.table("profiles").update({
+                "downgrade_email_pending": False,
+            }).eq("id", user_id).execute()
+        except Exception:  # noqa: BLE001
+            pass
 
-      # Proactively refresh FCM token every 45 min to avoid expiry during long runs
-      if fcm_ctx is not None:
-          fcm_elapsed = (datetime.now(timezone.utc) - fcm_token_minted_at).total_seconds()
-          if fcm_elapsed > 2700:  # 45 minutes
-              if refresh_fcm_access_token(fcm_ctx):
-                  fcm_token_minted_at = datetime.now(timezone.utc)
-                  print("Proactively refreshed FCM access token")
+    # ── PASS 1: Timer expired → execute protocol ──
+    # IMPORTANT: This MUST run before subscription downgrade (PASS 0).
+    # The downgrade handler resets last_check_in and timer_days, which
+    # would prevent expired entries from ever being sent.  Entry delivery
+    # is the core purpose of the app — it must never be blocked by
+    # subscription state changes.
+
+    if timer_state.remaining_seconds <= 0:
+
+        if not has_entries:
+            # No standard/scheduled entries — timer has no effect. Do NOT mark inactive.
+            # Free users shouldn't keep recurring entries — run downgrade handler
+            # to delete them.  This is safe because has_entries=False means no
+            # standard entries exist, so resetting timer_days/last_check_in
+            # (which the downgrade handler does) cannot block entry delivery.
+            if sub_status == "free" and active_entries:
+                try:
+                    reverted = handle_subscription_downgrade(
+                        client, profile, active_entries, resend_key, from_email, now,
+                    )
+                    if reverted:
+                        return
+                except Exception as exc:  # noqa: BLE001
+                    print(f"Downgrade handling failed for recurring-only user {user_id}: {exc}")
+            # Still process recurring entries (Forever Letters) if any exist.
+            if active_entries:
+                try:
+                    process_recurring_entries(
+                        client, profile, active_entries, server_secret,
+                        resend_key, from_email, viewer_base_url, now,
+                    )
+                except Exception as exc:  # noqa: BLE001
+                    print(f"Recurring processing failed for {user_id}: {exc}")
+            return
 
-      batch_user_ids = [str(p["id"]) for p in profile_batch if p.get("id")]
+        # Process recurring (Forever Letters) FIRST — they are time-critical
+        # (birthdays, anniversaries) and must not be blocked by rate limits
+        # from bulk guardian entry delivery.
+        try:
+            process_recurring_entries(
+                client, profile, active_entries, server_secret,
+                resend_key, from_email, viewer_base_url, now,
+            )
+        except Exception as exc:  # noqa: BLE001
+            print(f"Recurring processing failed for guardian user {user_id}: {exc}")
 
-      batch_entries_by_user: dict[str, list[dict]] = {}
+        had_send, input_send_count = process_expired_entries(
 
-      if batch_user_ids:
+            client,
 
-        batch_entries = fetch_all_rows(
+            profile,
 
-            client.table("vault_entries")
+            active_entries,
 
-            .select(
+            server_secret,
 
-                "id,user_id,title,action_type,data_type,status,payload_encrypted,recipient_email_encrypted,data_key_encrypted,hmac_signature,audio_file_path,is_zero_knowledge,scheduled_at,grace_until,entry_mode,last_sent_year"
+            resend_key,
 
-            )
+            from_email,
 
-            .eq("status", "active")
+            viewer_base_url,
 
-            .in_("user_id", batch_user_ids)
+            fcm_ctx,
 
-            .order("id")
+            now,
 
         )
 
-        processed_entries += len(batch_entries)
-
-        for entry in batch_entries:
-
-            batch_entries_by_user.setdefault(str(entry["user_id"]), []).append(entry)
-
-      for profile in profile_batch:
-
-        processed_profiles += 1
-
+        # Mark user as having had vault activity (prevents bot auto-deletion)
         try:
+            client.table("profiles").update({
+                "had_vault_activity": True,
+            }).eq("id", user_id).execute()
+        except Exception:  # noqa: BLE001
+            pass
 
-          user_id = str(profile["id"])
-
-          # ── Scheduled mode (Time Capsule): process per-entry delivery ──
-          # No global timer, no push notifications, no warnings.
-          app_mode = (profile.get("app_mode") or "vault").lower()
-          if app_mode == "scheduled":
-              active_entries = batch_entries_by_user.get(user_id, [])
-              sub_status = (profile.get("subscription_status") or "free").lower()
-
-              # RC verification for scheduled mode users — same logic as vault mode:
-              #   - Paid → catch cancellations
-              #   - Free with pro indicators → catch missed webhook upgrades
-              #   - Pending downgrade email → confirm still free
-              if rc_api_secret:
-                  _sc_theme = profile.get("selected_theme")
-                  _sc_sf = profile.get("selected_soul_fire")
-                  sc_has_pro = (
-                      int(profile.get("timer_days") or 30) != 30
-                      or _sc_theme not in FREE_THEMES
-                      or _sc_sf not in FREE_SOUL_FIRES
-                  )
-                  sc_needs_rc = (
-                      sub_status in PAID_STATUSES
-                      or sc_has_pro
-                      or profile.get("downgrade_email_pending")
-                  )
-                  if sc_needs_rc:
-                      try:
-                          rc_status = verify_subscription_with_revenuecat(rc_api_secret, user_id)
-                          _metrics["rc_verifications"] += 1
-                          if rc_status is not None and rc_status != sub_status:
-                              if sub_status in PAID_STATUSES and rc_status == "free":
-                                  print(
-                                      f"RC DOWNGRADE (scheduled): user {user_id} was {sub_status} "
-                                      f"in DB but RC says free — applying downgrade."
-                                  )
-                              else:
-                                  print(f"RC verify (scheduled): user {user_id} DB={sub_status} RC={rc_status} — updating DB")
-                              try:
-                                  client.table("profiles").update({
-                                      "subscription_status": rc_status,
-                                  }).eq("id", user_id).execute()
-                                  sub_status = rc_status
-                                  profile["subscription_status"] = rc_status
-                              except Exception as db_exc:  # noqa: BLE001
-                                  print(f"Failed to update subscription for scheduled user {user_id}: {db_exc}")
-                          time.sleep(RC_VERIFY_RATE_LIMIT_DELAY)
-                      except Exception as rc_exc:  # noqa: BLE001
-                          print(f"RC verify error for scheduled user {user_id}: {rc_exc}")
-
-              # Clear stale downgrade flag when user re-subscribes
-              if sub_status in PAID_STATUSES and profile.get("downgrade_email_pending"):
-                  try:
-                      client.table("profiles").update({
-                          "downgrade_email_pending": False,
-                      }).eq("id", user_id).execute()
-                      profile["downgrade_email_pending"] = False
-                  except Exception:  # noqa: BLE001
-                      pass
-
-              # Subscription downgrade for scheduled mode
-              if sub_status == "free":
-                  try:
-                      reverted = handle_subscription_downgrade(
-                          client, profile, active_entries, resend_key, from_email, now,
-                      )
-                      if reverted:
-                          continue
-                  except Exception as dg_exc:  # noqa: BLE001
-                      print(f"Downgrade handling failed for scheduled user {user_id}: {dg_exc}")
-
-              if active_entries:
-                  # Process recurring (Forever Letters) FIRST — they are time-critical
-                  # (birthdays, anniversaries) and must not be blocked by rate limits
-                  # from bulk scheduled entries.
-                  try:
-                      process_recurring_entries(
-                          client, profile, active_entries, server_secret,
-                          resend_key, from_email, viewer_base_url, now,
-                      )
-                  except Exception as exc:  # noqa: BLE001
-                      print(f"Recurring processing failed for {user_id}: {exc}")
-
-                  try:
-                      process_scheduled_entries(
-                          client, profile, active_entries, server_secret,
-                          resend_key, from_email, viewer_base_url, now,
-                      )
-                  except Exception as exc:  # noqa: BLE001
-                      print(f"Scheduled processing failed for {user_id}: {exc}")
-              continue
-
-          last_check_in = parse_iso(profile.get("last_check_in"))
-
-          if last_check_in is None:
-              print(f"WARN: User {user_id} has NULL last_check_in — skipping (timer cannot be computed)")
-              _record_warning(f"User {user_id} has NULL last_check_in — skipping")
-              continue
-
-
-
-          timer_state = build_timer_state(last_check_in, profile.get("timer_days"), now)
-
-          deadline = timer_state.deadline
-
-          active_entries = batch_entries_by_user.get(user_id, [])
-
-          # has_entries excludes recurring — guardian timer logic only cares about standard/scheduled entries
-          has_entries = any(
-              (e.get("entry_mode") or "standard") != "recurring"
-              for e in active_entries
-          )
-
-          sender_name = profile.get("sender_name") or "Afterword"
-          sub_status = (profile.get("subscription_status") or "free").lower()
-
-          # ── PRE-PASS: Server-side RC subscription verification ──
-          # Query RevenueCat directly to get authoritative status.
-          # This catches upgrades, downgrades, renewals, and cancellations
-          # even when the client is logged out, phone destroyed, or webhook failed.
-          #
-          # SCALABILITY: At ~1.1s per RC call (rate-limited to ~60 req/min),
-          # verifying every user is too slow at scale. We only verify users where a mismatch
-          # is plausible:
-          #   - Paid users → catch cancellations, expirations, refunds
-          #   - Free users with pro indicators → catch missed webhook upgrades
-          #   - Users with pending downgrade email → confirm still free
-          # Free users with NO pro indicators are the vast majority and need no
-          # verification — they were never paid or have already been downgraded.
-          if rc_api_secret:
-              selected_theme = profile.get("selected_theme")
-              selected_soul_fire = profile.get("selected_soul_fire")
-              has_pro_indicators = (
-                  int(profile.get("timer_days") or 30) != 30
-                  or selected_theme not in FREE_THEMES
-                  or selected_soul_fire not in FREE_SOUL_FIRES
-              )
-              needs_rc_verify = (
-                  sub_status in PAID_STATUSES  # paid → catch cancellations
-                  or has_pro_indicators         # free + pro artifacts → missed webhook
-                  or profile.get("downgrade_email_pending")  # pending email → confirm status
-              )
-              if needs_rc_verify:
-                  try:
-                      rc_status = verify_subscription_with_revenuecat(
-                          rc_api_secret, user_id,
-                      )
-                      _metrics["rc_verifications"] += 1
-                      if rc_status is not None and rc_status != sub_status:
-                          # Safety audit: log paid→free transitions prominently
-                          if sub_status in PAID_STATUSES and rc_status == "free":
-                              print(
-                                  f"RC DOWNGRADE: user {user_id} was {sub_status} "
-                                  f"in DB but RC says free — applying downgrade. "
-                                  f"Pro indicators: timer={profile.get('timer_days')}, "
-                                  f"theme={profile.get('selected_theme')}, "
-                                  f"soul_fire={profile.get('selected_soul_fire')}"
-                              )
-                          else:
-                              print(f"RC verify: user {user_id} DB={sub_status} RC={rc_status} — updating DB")
-                          try:
-                              client.table("profiles").update({
-                                  "subscription_status": rc_status,
-                              }).eq("id", user_id).execute()
-                              sub_status = rc_status
-                              profile["subscription_status"] = rc_status
-                          except Exception as db_exc:  # noqa: BLE001
-                              print(f"Failed to update subscription for {user_id}: {db_exc}")
-                      time.sleep(RC_VERIFY_RATE_LIMIT_DELAY)
-                  except Exception as rc_exc:  # noqa: BLE001
-                      print(f"RC verify error for {user_id}: {rc_exc}")
-
-          # Clear stale downgrade flag when user re-subscribes
-          if sub_status in PAID_STATUSES and profile.get("downgrade_email_pending"):
-              try:
-                  client.table("profiles").update({
-                      "downgrade_email_pending": False,
-                  }).eq("id", user_id).execute()
-              except Exception:  # noqa: BLE001
-                  pass
-
-          # ── PASS 1: Timer expired → execute protocol ──
-          # IMPORTANT: This MUST run before subscription downgrade (PASS 0).
-          # The downgrade handler resets last_check_in and timer_days, which
-          # would prevent expired entries from ever being sent.  Entry delivery
-          # is the core purpose of the app — it must never be blocked by
-          # subscription state changes.
-
-          if timer_state.remaining_seconds <= 0:
-
-              if not has_entries:
-                  # No standard/scheduled entries — timer has no effect. Do NOT mark inactive.
-                  # Free users shouldn't keep recurring entries — run downgrade handler
-                  # to delete them.  This is safe because has_entries=False means no
-                  # standard entries exist, so resetting timer_days/last_check_in
-                  # (which the downgrade handler does) cannot block entry delivery.
-                  if sub_status == "free" and active_entries:
-                      try:
-                          reverted = handle_subscription_downgrade(
-                              client, profile, active_entries, resend_key, from_email, now,
-                          )
-                          if reverted:
-                              continue
-                      except Exception as exc:  # noqa: BLE001
-                          print(f"Downgrade handling failed for recurring-only user {user_id}: {exc}")
-                  # Still process recurring entries (Forever Letters) if any exist.
-                  if active_entries:
-                      try:
-                          process_recurring_entries(
-                              client, profile, active_entries, server_secret,
-                              resend_key, from_email, viewer_base_url, now,
-                          )
-                      except Exception as exc:  # noqa: BLE001
-                          print(f"Recurring processing failed for {user_id}: {exc}")
-                  continue
-
-              # Process recurring (Forever Letters) FIRST — they are time-critical
-              # (birthdays, anniversaries) and must not be blocked by rate limits
-              # from bulk guardian entry delivery.
-              try:
-                  process_recurring_entries(
-                      client, profile, active_entries, server_secret,
-                      resend_key, from_email, viewer_base_url, now,
-                  )
-              except Exception as exc:  # noqa: BLE001
-                  print(f"Recurring processing failed for guardian user {user_id}: {exc}")
-
-              had_send, input_send_count = process_expired_entries(
-
-                  client,
-
-                  profile,
-
-                  active_entries,
-
-                  server_secret,
-
-                  resend_key,
-
-                  from_email,
-
-                  viewer_base_url,
-
-                  fcm_ctx,
-
-                  now,
-
-              )
-
-              # Mark user as having had vault activity (prevents bot auto-deletion)
-              try:
-                  client.table("profiles").update({
-                      "had_vault_activity": True,
-                  }).eq("id", user_id).execute()
-              except Exception:  # noqa: BLE001
-                  pass
-
-              # Check if any entries still need processing (failed during this run)
-              # Exclude recurring entries — they always stay active (Forever Letters)
-              pending = (
-                  client.table("vault_entries")
-                  .select("id", count="exact")
-                  .eq("user_id", user_id)
-                  .in_("status", ["active", "sending"])
-                  .neq("entry_mode", "recurring")
-                  .execute()
-              )
-              has_pending = (pending.count or 0) > 0
-
-              if has_pending:
-                  print(f"User {user_id}: {pending.count} entries still pending, keeping active for retry")
-              elif had_send:
-                  # Send entries exist → enter grace period (beneficiary can download)
-                  grace_update: dict = {
-                      "status": "inactive",
-                      "timer_days": 30,
-                      "protocol_executed_at": now.isoformat(),
-                      "warning_sent_at": None,
-                      "push_66_sent_at": None,
-                      "push_33_sent_at": None,
-                      "last_entry_at": None,
-                  }
-
-                  # ── Inline downgrade: if user is free, clean pro artifacts NOW ──
-                  # Without this, the profile sits inactive for 30 days (grace) and
-                  # the downgrade handler (PASS 0) never runs because it only
-                  # processes active profiles.  Pro themes/soul_fire would persist
-                  # during grace and the downgrade email would be delayed 30+ days.
-                  if sub_status == "free":
-                      sel_t = profile.get("selected_theme")
-                      sel_s = profile.get("selected_soul_fire")
-                      had_custom_timer_at_start = int(profile.get("timer_days") or 30) != 30
-                      had_audio_at_start = any(
-                          (e.get("data_type") or "").lower() == "audio"
-                          for e in active_entries
-                      )
-                      had_recurring_at_start = any(
-                          (e.get("entry_mode") or "standard") == "recurring"
-                          for e in active_entries
-                      )
-                      # Check for far-scheduled entries (TC entries beyond free 30-day cap)
-                      had_far_scheduled_at_start = False
-                      try:
-                          _fs_max = (now + timedelta(days=30)).isoformat()
-                          _fs_check = (
-                              client.table("vault_entries")
-                              .select("id", count="exact")
-                              .eq("user_id", user_id)
-                              .eq("status", "active")
-                              .neq("entry_mode", "recurring")
-                              .not_.is_("scheduled_at", "null")
-                              .gt("scheduled_at", _fs_max)
-                              .execute()
-                          )
-                          had_far_scheduled_at_start = (_fs_check.count or 0) > 0
-                      except Exception:  # noqa: BLE001
-                          pass
-                      if sel_t not in FREE_THEMES:
-                          grace_update["selected_theme"] = None
-                      if sel_s not in FREE_SOUL_FIRES:
-                          grace_update["selected_soul_fire"] = None
-                      is_genuine_downgrade = had_custom_timer_at_start or had_audio_at_start or had_recurring_at_start or had_far_scheduled_at_start
-                      if is_genuine_downgrade:
-                          grace_update["downgrade_email_pending"] = True
-
-                  client.table("profiles").update(grace_update).eq("id", user_id).execute()
-                  print(f"User {user_id}: protocol executed, grace period started")
-
-                  # ── Inline downgrade: actually delete pro-only entries NOW ──
-                  # Without this, audio/recurring entries persist through the 30-day
-                  # grace period and trigger a SECOND downgrade email after cleanup.
-                  if sub_status == "free":
-                      # Delete audio entries
-                      if had_audio_at_start:
-                          try:
-                              _inline_audio = (
-                                  client.table("vault_entries")
-                                  .select("id,audio_file_path")
-                                  .eq("user_id", user_id)
-                                  .eq("data_type", "audio")
-                                  .eq("status", "active")
-                                  .execute()
-                              ).data or []
-                              for _ae in _inline_audio:
-                                  delete_entry(client, _ae)
-                              if _inline_audio:
-                                  print(f"User {user_id}: inline downgrade deleted {len(_inline_audio)} audio entries")
-                          except Exception as _ae_exc:  # noqa: BLE001
-                              print(f"User {user_id}: inline audio deletion failed ({_ae_exc}), PASS 0 will retry")
-
-                      # Delete recurring (Forever Letters) entries
-                      # No status filter — catch entries in 'sending' too (matches handler)
-                      if had_recurring_at_start:
-                          try:
-                              _inline_recurring = (
-                                  client.table("vault_entries")
-                                  .select("id,audio_file_path")
-                                  .eq("user_id", user_id)
-                                  .eq("entry_mode", "recurring")
-                                  .execute()
-                              ).data or []
-                              for _re in _inline_recurring:
-                                  delete_entry(client, _re)
-                              if _inline_recurring:
-                                  print(f"User {user_id}: inline downgrade deleted {len(_inline_recurring)} recurring entries")
-                          except Exception as _re_exc:  # noqa: BLE001
-                              print(f"User {user_id}: inline recurring deletion failed ({_re_exc}), PASS 0 will retry")
-
-                      # Clamp far-scheduled dates
-                      if had_far_scheduled_at_start:
-                          try:
-                              _clamp_scheduled_dates(client, user_id, max_days=30, now=now)
-                          except Exception as _cs_exc:  # noqa: BLE001
-                              print(f"User {user_id}: inline scheduled clamp failed ({_cs_exc}), PASS 0 will retry")
-
-                  # Try to send downgrade email inline (best-effort)
-                  if sub_status == "free" and grace_update.get("downgrade_email_pending"):
-                      _dg_email = profile.get("email")
-                      if _dg_email:
-                          try:
-                              _dg_sub, _dg_txt, _dg_htm = _build_downgrade_email(
-                                  sender_name,
-                                  had_audio=any(
-                                      (e.get("data_type") or "").lower() == "audio"
-                                      for e in active_entries
-                                  ),
-                                  had_recurring=any(
-                                      (e.get("entry_mode") or "standard") == "recurring"
-                                      for e in active_entries
-                                  ),
-                                  had_scheduled_clamped=had_far_scheduled_at_start,
-                              )
-                              send_email(
-                                  resend_key, from_email, _dg_email,
-                                  _dg_sub, _dg_txt, _dg_htm,
-                                  idempotency_key=f"downgrade-{user_id}-{now.date().isoformat()}",
-                                  preheader=f"Hi {sender_name}, your Afterword subscription has changed.",
-                              )
-                              client.table("profiles").update({
-                                  "downgrade_email_pending": False,
-                              }).eq("id", user_id).execute()
-                              print(f"User {user_id}: sent downgrade notification alongside protocol execution")
-                          except Exception as _dg_exc:  # noqa: BLE001
-                              print(f"User {user_id}: downgrade email deferred ({_dg_exc}), will retry when active")
-              elif input_send_count > 0:
-                  # SAFETY INVARIANT: There were send entries in the input but
-                  # none were successfully sent AND none are pending in DB.
-                  # This means they were lost (catastrophic bug). Do NOT reset
-                  # to fresh — keep active so the issue is visible.
-                  print(
-                      f"CRITICAL: User {user_id}: {input_send_count} send entries existed "
-                      f"but 0 were sent and 0 are pending. Data may have been lost. "
-                      f"Keeping active for investigation — NOT resetting."
-                  )
-              else:
-                  # Truly destroy-only → no grace needed, reset to fresh immediately.
-                  _destroy_update: dict = {
-                      "status": "active",
-                      "timer_days": 30,
-                      "last_check_in": now.isoformat(),
-                      "protocol_executed_at": None,
-                      "warning_sent_at": None,
-                      "push_66_sent_at": None,
-                      "push_33_sent_at": None,
-                      "last_entry_at": None,
-                      "downgrade_email_pending": False,
-                  }
-                  # Only clear theme/soul_fire for free users — paid users keep them
-                  if sub_status == "free":
-                      _destroy_update["selected_theme"] = None
-                      _destroy_update["selected_soul_fire"] = None
-                  client.table("profiles").update(_destroy_update).eq("id", user_id).execute()
-                  print(f"User {user_id}: destroy-only vault cleared, account reset to fresh")
-
-                  # Delete pro-only entries that survive destroy (audio/recurring/far-scheduled)
-                  if sub_status == "free":
-                      try:
-                          _do_audio = (
-                              client.table("vault_entries")
-                              .select("id,audio_file_path")
-                              .eq("user_id", user_id)
-                              .eq("data_type", "audio")
-                              .eq("status", "active")
-                              .execute()
-                          ).data or []
-                          for _ae in _do_audio:
-                              delete_entry(client, _ae)
-                          _do_recurring = (
-                              client.table("vault_entries")
-                              .select("id,audio_file_path")
-                              .eq("user_id", user_id)
-                              .eq("entry_mode", "recurring")
-                              .eq("status", "active")
-                              .execute()
-                          ).data or []
-                          for _re in _do_recurring:
-                              delete_entry(client, _re)
-                          _clamp_scheduled_dates(client, user_id, max_days=30, now=now)
-                          if _do_audio or _do_recurring:
-                              print(f"User {user_id}: destroy-only path cleaned {len(_do_audio)} audio + {len(_do_recurring)} recurring entries")
-                      except Exception as _do_exc:  # noqa: BLE001
-                          print(f"User {user_id}: destroy-only pro cleanup failed ({_do_exc}), PASS 0 will catch on next run")
-
-              continue
-
-          # ── PASS 0: Subscription downgrade → revert to free tier ──
-          # Runs AFTER timer-expiry check so that entry delivery is never
-          # blocked by a subscription status change.
-          if sub_status == "free":
-              try:
-                  reverted = handle_subscription_downgrade(
-                      client, profile, active_entries, resend_key, from_email, now,
-                  )
-                  if reverted:
-                      # Profile was modified in DB (timer reset, theme cleared).
-                      # In-memory profile dict is now stale — skip remaining passes.
-                      # Next heartbeat cycle will use the fresh values.
-                      continue
-              except Exception as exc:  # noqa: BLE001
-                  print(f"Subscription downgrade handling failed for {user_id}: {exc}")
-
-          # Skip users with empty vaults — no warnings needed
-          # But still process recurring entries (Forever Letters) for users with only recurring entries
-
-          has_recurring = any(
-              (e.get("entry_mode") or "standard") == "recurring"
-              for e in active_entries
-          )
-
-          if has_recurring:
-              try:
-                  process_recurring_entries(
-                      client, profile, active_entries, server_secret,
-                      resend_key, from_email, viewer_base_url, now,
-                  )
-              except Exception as exc:  # noqa: BLE001
-                  print(f"Recurring processing failed for guardian user {user_id}: {exc}")
-
-          if not has_entries:
-
-              continue
+        # Check if any entries still need processing (failed during this run)
+        # Exclude recurring entries — they always stay active (Forever Letters)
+        pending = (
+            client.table("vault_entries")
+            .select("id", count="exact")
+            .eq("user_id", user_id)
+            .in_("status", ["active", "sending"])
+            .neq("entry_mode", "recurring")
+            .execute()
+        )
+        has_pending = (pending.count or 0) > 0
+
+        if has_pending:
+            print(f"User {user_id}: {pending.count} entries still pending, keeping active for retry")
+        elif had_send:
+            # Send entries exist → enter grace period (beneficiary can download)
+            grace_update: dict = {
+                "status": "inactive",
+                "timer_days": 30,
+                "protocol_executed_at": now.isoformat(),
+                "warning_sent_at": None,
+                "push_66_sent_at": None,
+                "push_33_sent_at": None,
+                "last_entry_at": None,
+            }
+
+            # ── Inline downgrade: if user is free, clean pro artifacts NOW ──
+            # Without this, the profile sits inactive for 30 days (grace) and
+            # the downgrade handler (PASS 0) never runs because it only
+            # processes active profiles.  Pro themes/soul_fire would persist
+            # during grace and the downgrade email would be delayed 30+ days.
+            if sub_status == "free":
+                sel_t = profile.get("selected_theme")
+                sel_s = profile.get("selected_soul_fire")
+                had_custom_timer_at_start = int(profile.get("timer_days") or 30) != 30
+                had_audio_at_start = entry_summary.has_audio
+                had_recurring_at_start = entry_summary.has_recurring
+                # Check for far-scheduled entries (TC entries beyond free 30-day cap)
+                had_far_scheduled_at_start = False
+                try:
+                    _fs_max = (now + timedelta(days=30)).isoformat()
+                    _fs_check = (
+                        client.table("vault_entries")
+                        .select("id", count="exact")
+                        .eq("user_id", user_id)
+                        .eq("status", "active")
+                        .neq("entry_mode", "recurring")
+                        .not_.is_("scheduled_at", "null")
+                        .gt("scheduled_at", _fs_max)
+                        .execute()
+                    )
+                    had_far_scheduled_at_start = (_fs_check.count or 0) > 0
+                except Exception:  # noqa: BLE001
+                    pass
+                if sel_t not in FREE_THEMES:
+                    grace_update["selected_theme"] = None
+                if sel_s not in FREE_SOUL_FIRES:
+                    grace_update["selected_soul_fire"] = None
+                is_genuine_downgrade = had_custom_timer_at_start or had_audio_at_start or had_recurring_at_start or had_far_scheduled_at_start
+                if is_genuine_downgrade:
+                    grace_update["downgrade_email_pending"] = True
+
+            client.table("profiles").update(grace_update).eq("id", user_id).execute()
+            print(f"User {user_id}: protocol executed, grace period started")
+
+            # ── Inline downgrade: actually delete pro-only entries NOW ──
+            # Without this, audio/recurring entries persist through the 30-day
+            # grace period and trigger a SECOND downgrade email after cleanup.
+            if sub_status == "free":
+                # Delete audio entries
+                if had_audio_at_start:
+                    try:
+                        _inline_audio = (
+                            client.table("vault_entries")
+                            .select("id,audio_file_path")
+                            .eq("user_id", user_id)
+                            .eq("data_type", "audio")
+                            .eq("status", "active")
+                            .execute()
+                        ).data or []
+                        for _ae in _inline_audio:
+                            delete_entry(client, _ae)
+                        if _inline_audio:
+                            print(f"User {user_id}: inline downgrade deleted {len(_inline_audio)} audio entries")
+                    except Exception as _ae_exc:  # noqa: BLE001
+                        print(f"User {user_id}: inline audio deletion failed ({_ae_exc}), PASS 0 will retry")
+
+                # Delete recurring (Forever Letters) entries
+                # No status filter — catch entries in 'sending' too (matches handler)
+                if had_recurring_at_start:
+                    try:
+                        _inline_recurring = (
+                            client.table("vault_entries")
+                            .select("id,audio_file_path")
+                            .eq("user_id", user_id)
+                            .eq("entry_mode", "recurring")
+                            .execute()
+                        ).data or []
+                        for _re in _inline_recurring:
+                            delete_entry(client, _re)
+                        if _inline_recurring:
+                            print(f"User {user_id}: inline downgrade deleted {len(_inline_recurring)} recurring entries")
+                    except Exception as _re_exc:  # noqa: BLE001
+                        print(f"User {user_id}: inline recurring deletion failed ({_re_exc}), PASS 0 will retry")
+
+                # Clamp far-scheduled dates
+                if had_far_scheduled_at_start:
+                    try:
+                        _clamp_scheduled_dates(client, user_id, max_days=30, now=now)
+                    except Exception as _cs_exc:  # noqa: BLE001
+                        print(f"User {user_id}: inline scheduled clamp failed ({_cs_exc}), PASS 0 will retry")
+
+            # Try to send downgrade email inline (best-effort)
+            if sub_status == "free" and grace_update.get("downgrade_email_pending"):
+                _dg_email = profile.get("email")
+                if _dg_email:
+                    try:
+                        _dg_sub, _dg_txt, _dg_htm = _build_downgrade_email(
+                            sender_name,
+                            had_audio=entry_summary.has_audio,
+                            had_recurring=entry_summary.has_recurring,
+                            had_scheduled_clamped=had_far_scheduled_at_start,
+                        )
+
+                        def _dg_sent() -> None:
+                            client.table("profiles").update({
+                                "downgrade_email_pending": False,
+                            }).eq("id", user_id).execute()
+                            print(f"User {user_id}: sent downgrade notification alongside protocol execution")
+
+                        send_notification_email(
+                            resend_key, from_email, _dg_email,
+                            _dg_sub, _dg_txt, _dg_htm,
+                            idempotency_key=f"downgrade-{user_id}-{now.date().isoformat()}",
+                            preheader=f"Hi {sender_name}, your Afterword subscription has changed.",
+                            on_sent=_dg_sent,
+                        )
+                    except Exception as _dg_exc:  # noqa: BLE001
+                        print(f"User {user_id}: downgrade email deferred ({_dg_exc}), will retry when active")
+        elif input_send_count > 0:
+            # SAFETY INVARIANT: There were send entries in the input but
+            # none were successfully sent AND none are pending in DB.
+            # This means they were lost (catastrophic bug). Do NOT reset
+            # to fresh — keep active so the issue is visible.
+            print(
+                f"CRITICAL: User {user_id}: {input_send_count} send entries existed "
+                f"but 0 were sent and 0 are pending. Data may have been lost. "
+                f"Keeping active for investigation — NOT resetting."
+            )
+        else:
+            # Truly destroy-only → no grace needed, reset to fresh immediately.
+            _destroy_update: dict = {
+                "status": "active",
+                "timer_days": 30,
+                "last_check_in": now.isoformat(),
+                "protocol_executed_at": None,
+                "warning_sent_at": None,
+                "push_66_sent_at": None,
+                "push_33_sent_at": None,
+                "last_entry_at": None,
+                "downgrade_email_pending": False,
+            }
+            # Only clear theme/soul_fire for free users — paid users keep them
+            if sub_status == "free":
+                _destroy_update["selected_theme"] = None
+                _destroy_update["selected_soul_fire"] = None
+            client.table("profiles").update(_destroy_update).eq("id", user_id).execute()
+            print(f"User {user_id}: destroy-only vault cleared, account reset to fresh")
+
+            # Delete pro-only entries that survive destroy (audio/recurring/far-scheduled)
+            if sub_status == "free":
+                try:
+                    _do_audio = (
+                        client.table("vault_entries")
+                        .select("id,audio_file_path")
+                        .eq("user_id", user_id)
+                        .eq("data_type", "audio")
+                        .eq("status", "active")
+                        .execute()
+                    ).data or []
+                    for _ae in _do_audio:
+                        delete_entry(client, _ae)
+                    _do_recurring = (
+                        client.table("vault_entries")
+                        .select("id,audio_file_path")
+                        .eq("user_id", user_id)
+                        .eq("entry_mode", "recurring")
+                        .eq("status", "active")
+                        .execute()
+                    ).data or []
+                    for _re in _do_recurring:
+                        delete_entry(client, _re)
+                    _clamp_scheduled_dates(client, user_id, max_days=30, now=now)
+                    if _do_audio or _do_recurring:
+                        print(f"User {user_id}: destroy-only path cleaned {len(_do_audio)} audio + {len(_do_recurring)} recurring entries")
+                except Exception as _do_exc:  # noqa: BLE001
+                    print(f"User {user_id}: destroy-only pro cleanup failed ({_do_exc}), PASS 0 will catch on next run")
+
+        return
+
+    # ── PASS 0: Subscription downgrade → revert to free tier ──
+    # Runs AFTER timer-expiry check so that entry delivery is never
+    # blocked by a subscription status change.
+    if sub_status == "free":
+        try:
+            reverted = handle_subscription_downgrade(
+                client, profile, active_entries, resend_key, from_email, now,
+            )
+            if reverted:
+                # Profile was modified in DB (timer reset, theme cleared).
+                # In-memory profile dict is now stale — skip remaining passes.
+                # Next heartbeat cycle will use the fresh values.
+                return
+        except Exception as exc:  # noqa: BLE001
+            print(f"Subscription downgrade handling failed for {user_id}: {exc}")
+
+    # Skip users with empty vaults — no warnings needed
+    # But still process recurring entries (Forever Letters) for users with only recurring entries
+
+    if entry_summary.has_recurring:
+        try:
+            process_recurring_entries(
+                client, profile, active_entries, server_secret,
+                resend_key, from_email, viewer_base_url, now,
+            )
+        except Exception as exc:  # noqa: BLE001
+            print(f"Recurring processing failed for guardian user {user_id}: {exc}")
+
+    if not has_entries:
+
+        return
+
+    # ── PASS 1b: Process recurring (Forever Letters) for active-timer users ──
+    # Forever Letters fire annually regardless of timer state.
+    # (Already handled above for all users including recurring-only)
+
+
+    # ── PASS 2–4: 66% push, 33% push, 24h email (PAID users only) ──
+    # After an outage several stages can be due at once.  Only the most
+    # urgent one is sent.  When that is a push, the earlier push is marked
+    # as satisfied in the same profile write; the 24h email marks only
+    # itself, so due pushes still go out.
+
+    due_stages = due_notification_stages(profile, timer_state, now)
+    if due_stages == ["warning_66"] and defer_optional_pass("push_66"):
+        due_stages = []
+
+    if due_stages:
+
+        stage = due_stages[-1]
+        satisfied = [stage] if stage == "email_24h" else due_stages
+        stage_marks = {NOTIFICATION_STAGE_COLUMNS[s]: now.isoformat() for s in satisfied}
+
+        def _mark_stages() -> None:
+            # The 24h email may be queued in the batch's NotificationOutbox,
+            # in which case this runs only once the outbox flush succeeds.
+            client.table("profiles").update(stage_marks).eq("id", user_id).execute()
+            for column, value in stage_marks.items():
+                profile[column] = value
+            if len(satisfied) > 1:
+                print(f"User {user_id}: sent {stage}, marked {', '.join(satisfied[:-1])} as satisfied")
+
+        try:
+
+            if stage == "email_24h":
+                send_warning_email(
+                    profile,
+                    deadline,
+                    resend_key,
+                    from_email,
+                    remaining_fraction=timer_state.remaining_fraction,
+                    on_sent=_mark_stages,
+                    batchable=timer_state.email_24h_at > now - NOTIFICATION_BATCH_FRESH_WINDOW,
+                )
+            elif send_warning_push(
+                client,
+                user_id,
+                sender_name,
+                deadline,
+                fcm_ctx,
+                now_utc=now,
+                remaining_fraction=timer_state.remaining_fraction,
+                push_stage=stage,
+            ):
+                _mark_stages()
+
+        except Exception as exc:  # noqa: BLE001
+
+            print(f"{NOTIFICATION_STAGE_LABELS[stage]} failed for user {user_id}: {exc}")
+
+
+def _process_profile_safely(client, profile: dict, active_entries: list[dict], **pass_kwargs) -> bool:
+    """process_profile with its failure logged; True when it completed."""
+    try:
+        process_profile(client, profile, active_entries, **pass_kwargs)
+    except Exception as exc:  # noqa: BLE001
+        print(f"Processing failed for user {profile.get('id', '?')}: {exc}")
+        return False
+    return True
+
+
+def _store_next_action_safely(client, profile: dict, active_entries: list[dict], now: datetime) -> None:
+    # Only rows fetched by `--scan due` carry the due-index column.
+    if NEXT_ACTION_COLUMN not in profile:
+        return
+    try:
+        store_next_action_at(client, profile, compute_next_action_at(profile, active_entries, now))
+    except Exception as exc:  # noqa: BLE001
+        print(f"Failed to store next_action_at for user {profile.get('id', '?')}: {exc}")
+
+
+def process_profile_batch(
+    client,
+    profile_batch: list[dict],
+    entries_by_user: dict[str, list[dict]],
+    *,
+    executor: ThreadPoolExecutor | None = None,
+    **pass_kwargs,
+) -> None:
+    """Process one keyset batch of profiles, concurrently when an executor is given.
+
+    Each user is a single task, so a slow Resend/FCM/RC round trip only stalls
+    that user.  The call returns once every user in the batch has finished,
+    which keeps batches (and the runtime guard between them) sequential.
+
+    Warning, downgrade and tamper emails are collected in a
+    NotificationOutbox while the batch runs and flushed through
+    /emails/batch once every user has finished.  next_action_at is stored
+    only after the flush, once the sent emails' on_sent callbacks have
+    marked their stages: computed earlier, it would still point at a
+    warning that is about to go out (or skip one whose send failed).
+    """
+    global _notification_outbox
+    resend_key = pass_kwargs.get("resend_key")
+    outbox = NotificationOutbox(resend_key) if resend_key else None
+    _notification_outbox = outbox
+    completed: list[dict] = []
+    try:
+        if executor is None:
+            for profile in profile_batch:
+                if _process_profile_safely(
+                    client, profile, entries_by_user.get(str(profile["id"]), []),
+                    **pass_kwargs,
+                ):
+                    completed.append(profile)
+        else:
+            futures = [
+                (
+                    profile,
+                    executor.submit(
+                        _process_profile_safely,
+                        client, profile, entries_by_user.get(str(profile["id"]), []),
+                        **pass_kwargs,
+                    ),
+                )
+                for profile in profile_batch
+            ]
+            for profile, future in futures:
+                if future.result():
+                    completed.append(profile)
+    finally:
+        _notification_outbox = None
+        if outbox is not None:
+            outbox.flush()
+
+    for profile in completed:
+        _store_next_action_safely(
+            client, profile, entries_by_user.get(str(profile["id"]), []), pass_kwargs["now"],
+        )
+
+
+def _resolve_profile_concurrency() -> int:
+    raw = os.getenv("HEARTBEAT_PROFILE_CONCURRENCY", "")
+    try:
+        return max(1, int(raw)) if raw else PROFILE_CONCURRENCY
+    except ValueError:
+        print(f"Invalid HEARTBEAT_PROFILE_CONCURRENCY={raw!r} — using {PROFILE_CONCURRENCY}")
+        return PROFILE_CONCURRENCY
+
+
+def _resolve_prefetch_batches() -> int:
+    raw = os.getenv("HEARTBEAT_PREFETCH_BATCHES", "")
+    try:
+        value = int(raw) if raw else PROFILE_PREFETCH_BATCHES
+    except ValueError:
+        print(f"Invalid HEARTBEAT_PREFETCH_BATCHES={raw!r} — using {PROFILE_PREFETCH_BATCHES}")
+        value = PROFILE_PREFETCH_BATCHES
+    return min(max(0, value), PROFILE_PREFETCH_MAX_BATCHES)
 
-          # ── PASS 1b: Process recurring (Forever Letters) for active-timer users ──
-          # Forever Letters fire annually regardless of timer state.
-          # (Already handled above for all users including recurring-only)
+
+def _resolve_user_entry_cap() -> int:
+    raw = os.getenv("HEARTBEAT_USER_ENTRY_CAP", "")
+    try:
+        return max(0, int(raw)) if raw else USER_ENTRY_CAP
+    except ValueError:
+        print(f"Invalid HEARTBEAT_USER_ENTRY_CAP={raw!r} — using {USER_ENTRY_CAP}")
+        return USER_ENTRY_CAP
 
 
-          # ── PASS 2: Push #1 at 66% remaining (ALL users) ──
+def cap_user_entries(entries: list[dict], user_id: str) -> list[dict]:
+    """The share of a user's due entries this run may deliver.
 
-          if should_send_push_66(profile, timer_state, now):
+    Entries past the cap are left untouched — still 'active' — so the
+    pending-entries check in process_profile keeps the profile active and
+    the next run picks them up.
+    """
+    cap = _resolve_user_entry_cap()
+    if not cap or len(entries) <= cap:
+        return entries
+    print(
+        f"User {user_id}: delivering {cap} of {len(entries)} due entries this run — "
+        f"the rest stay active for the next run"
+    )
+    return entries[:cap]
 
-              push_sent = False
 
-              try:
+def load_profile_batch(client, profile_batch: list[dict], fetch_mode: str):
+    """Turn one fetched profile page into records plus its active entries.
 
-                  push_sent = send_warning_push(
+    Returns (profiles, entries_by_user, entry_count).  In "embedded" mode the
+    entries come from each row's vault_entries key; otherwise one
+    vault_entries request loads them.
+    """
+    entries_by_user: dict[str, list[dict]] = {}
+    entry_count = 0
+
+    if fetch_mode == "embedded":
+        for row in profile_batch:
+            embedded = row.pop("vault_entries", None) or []
+            entry_count += len(embedded)
+            if embedded:
+                entries_by_user[str(row["id"])] = [
+                    EntryRecord(e, ciphertext_loaded=False) for e in embedded
+                ]
+
+    profiles = [ProfileRecord(row, contact_loaded=False) for row in profile_batch]
+
+    user_ids = [str(p["id"]) for p in profiles if p.get("id")]
+
+    if user_ids and fetch_mode != "embedded":
+        # Each user's ids land in exactly one chunk, so per-user entry order
+        # (by id) is unaffected by the split.
+        for id_chunk in split_in_values(user_ids):
+            rows = fetch_all_rows(
+                client.table("vault_entries")
+                .select(ENTRY_METADATA_SELECT_FIELDS)
+                .eq("status", "active")
+                .in_("user_id", id_chunk)
+            )
 
-                      client,
+            entry_count += len(rows)
 
-                      user_id,
+            for row in rows:
+                entries_by_user.setdefault(str(row["user_id"]), []).append(
+                    EntryRecord(row, ciphertext_loaded=False)
+                )
 
-                      sender_name,
+    return profiles, entries_by_user, entry_count
 
-                      deadline,
 
-                      fcm_ctx,
+def prefetch_batches(batches, load, depth: int):
+    """Yield load(batch) for each batch, fetching up to `depth` batches ahead.
 
-                      now_utc=now,
+    A single background thread walks `batches` in order, so keyset ordering
+    is preserved; the bounded queue keeps at most `depth` loaded batches
+    waiting.  Errors in the fetch thread are re-raised to the consumer.
+    depth <= 0 loads inline.  Closing the generator (e.g. `break` in the
+    consumer) stops the fetch thread after its current request.
+    """
+    if depth <= 0:
+        for batch in batches:
+            yield load(batch)
+        return
 
-                      remaining_fraction=timer_state.remaining_fraction,
+    done = object()
+    ready: queue.Queue = queue.Queue(maxsize=depth)
+    stop = threading.Event()
 
-                      push_stage="warning_66",
+    def _put(item) -> bool:
+        while not stop.is_set():
+            try:
+                ready.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
 
-                  )
+    def _produce():
+        try:
+            for batch in batches:
+                if stop.is_set() or not _put((load(batch), None)):
+                    return
+            _put((done, None))
+        except BaseException as exc:  # noqa: BLE001 — handed to the consumer
+            _put((done, exc))
+
+    worker = threading.Thread(target=_produce, name="heartbeat-prefetch", daemon=True)
+    worker.start()
+    try:
+        while True:
+            item, error = ready.get()
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        stop.set()
+        worker.join()
+
+
+def _load_run_config() -> dict:
+    """Read the heartbeat's environment configuration."""
+    return {
+        "supabase_url": get_env("SUPABASE_URL"),
+        "supabase_key": get_env("SUPABASE_SERVICE_ROLE_KEY"),
+        "server_secret": get_env("SERVER_SECRET"),
+        "resend_key": get_env("RESEND_API_KEY"),
+        "from_email": get_env("RESEND_FROM_EMAIL"),
+        "viewer_base_url": get_env("VIEWER_BASE_URL"),
+        "firebase_sa_json": os.getenv("FIREBASE_SERVICE_ACCOUNT_JSON", ""),
+        "rc_api_secret": os.getenv("REVENUECAT_API_SECRET", ""),
+    }
 
-              except Exception as exc:  # noqa: BLE001
 
-                  print(f"Push 66% warning failed for user {user_id}: {exc}")
+def run_profile_pass(
+    client,
+    *,
+    server_secret: str,
+    resend_key: str,
+    from_email: str,
+    viewer_base_url: str,
+    fcm_ctx: dict | None,
+    rc_api_secret: str,
+    id_range: tuple[str | None, str | None] | None = None,
+    runtime_budget: float = MAX_RUNTIME_SECONDS,
+    on_batch=None,
+    scan_mode: str = "full",
+    fetch_mode: str = "separate",
+    checkpoint_ctx: dict | None = None,
+    order: str = "id",
+) -> tuple[int, int]:
+    """Run the per-user passes over every active profile (optionally one id shard).
+
+    scan_mode picks the profile source and order its processing order (see
+    iter_profiles_for_scan).
+    fetch_mode "embedded" loads each batch's active entries in the profile
+    request itself; "separate" makes a second vault_entries request.
+    on_batch, if given, is called before each profile batch and before each
+    group of queued users; returning False stops the pass (used to check
+    shard leases).
+    The next batch (and its entries) is fetched in the background while the
+    current one is processed; HEARTBEAT_PREFETCH_BATCHES sets the depth.
+    Users go through a ProfileWorkQueue: delivery work in each batch runs
+    straight away, while notification, subscription and maintenance work
+    waits (up to WORK_QUEUE_MAX_PENDING users) behind later batches'
+    deliveries.  When the runtime budget runs out, only queued lower-class
+    work is left for the next run.
+    checkpoint_ctx (see build_checkpoint_context) makes the pass resume after
+    the last profile id a previous, unfinished pass completed, wrapping
+    around to the start of the range; the checkpoint is cleared once a pass
+    gets through the whole range.
+
+    Returns (processed_profiles, processed_entries).
+    """
+    global _run_delivery_queue
+    processed_profiles = 0
+    processed_entries = 0
+    start_time = time.monotonic()
+    fcm_token_minted_at = datetime.now(timezone.utc)  # track when FCM token was last refreshed
+
+    # Users are processed concurrently; one task per user keeps each user's
+    # passes in their original order.
+    profile_concurrency = _resolve_profile_concurrency()
+    executor = (
+        ThreadPoolExecutor(
+            max_workers=profile_concurrency,
+            thread_name_prefix="heartbeat-user",
+        )
+        if profile_concurrency > 1
+        else None
+    )
+    # Concurrent users' unlock emails share Resend batches; a lone worker
+    # would only add the linger delay to every delivery.
+    _run_delivery_queue = DeliveryBatchQueue(resend_key) if executor is not None else None
+
+    resume_key: str | None = None
+    resume_after: str | None = None
+    if checkpoint_ctx is not None:
+        if order != "id":
+            print(f"Resume is not supported with --order {order} — starting from the most urgent profile")
+        elif scan_mode in RESUME_SCAN_MODES:
+            resume_key = checkpoint_key(scan_mode, id_range)
+            resume_after = load_checkpoint(checkpoint_ctx, resume_key)
+            if resume_after is not None:
+                print(f"Resuming {resume_key} after profile {resume_after}")
+        else:
+            print(f"Resume is not supported for --scan {scan_mode} — starting from the first id")
+    finished = True
+    work_queue = ProfileWorkQueue()
+
+    def _report_queue() -> None:
+        if _run_planner is not None:
+            _run_planner.set_queued(work_queue.class_counts())
+
+    def _save_completed_checkpoint() -> None:
+        completed_id = work_queue.pop_completed()
+        if resume_key is not None and completed_id is not None:
+            save_checkpoint(checkpoint_ctx, resume_key, completed_id)
+
+    def _drain_work_queue(*, through_class: int, keep: int) -> bool:
+        """Process queued users while any is in <= through_class or more than keep wait.
+
+        Lower-class groups respect the runtime budget; returns False once it
+        stops because of it.
+        """
+        _save_completed_checkpoint()
+        while len(work_queue):
+            top_class = work_queue.peek_class()
+            if top_class > through_class and len(work_queue) <= keep:
+                break
+            if top_class > WORK_DELIVERY and time.monotonic() - start_time > runtime_budget:
+                return False
+            if on_batch is not None and not on_batch():
+                return False
+            group = work_queue.pop_group(PROFILE_BATCH_SIZE)
+            _report_queue()
+            group_started = time.monotonic()
+            process_profile_batch(
+                client,
+                [item[2] for item in group],
+                {str(item[2]["id"]): item[3] for item in group},
+                executor=executor,
+                server_secret=server_secret,
+                resend_key=resend_key,
+                from_email=from_email,
+                viewer_base_url=viewer_base_url,
+                fcm_ctx=fcm_ctx,
+                rc_api_secret=rc_api_secret,
+                now=datetime.now(timezone.utc),
+            )
+            if _run_planner is not None:
+                _run_planner.record(
+                    f"user_{WORK_CLASS_NAMES[top_class]}",
+                    (time.monotonic() - group_started) / len(group),
+                )
+            work_queue.finish(group)
+            _save_completed_checkpoint()
+        return True
 
-              if push_sent:
+    batches = prefetch_batches(
+        iter_profiles_resuming(
+            client,
+            scan_mode,
+            resume_after=resume_after,
+            now=datetime.now(timezone.utc),
+            id_range=id_range,
+            include_rc_candidates=bool(rc_api_secret),
+            embed_entries=fetch_mode == "embedded",
+            sizer=BatchSizer(),
+            order=order,
+        ),
+        lambda page: load_profile_batch(client, page, fetch_mode),
+        _resolve_prefetch_batches(),
+    )
 
-                  client.table("profiles").update(
+    scan_tick = time.monotonic()
+    for profile_batch, batch_entries_by_user, batch_entry_count in batches:
 
-                      {"push_66_sent_at": now.isoformat()}
+        # Refresh `now` each batch so timestamps stay accurate during multi-hour runs
+        now = datetime.now(timezone.utc)
 
-                  ).eq("id", user_id).execute()
+        # Runtime guard: exit gracefully before GH Actions kills the job
+        elapsed = time.monotonic() - start_time
+        if elapsed > runtime_budget:
+            print(f"Runtime limit reached ({elapsed:.0f}s). Exiting gracefully — "
+                  f"remaining users will be processed next run.")
+            finished = False
+            break
 
+        if on_batch is not None and not on_batch():
+            finished = False
+            break
 
+        # Proactively refresh FCM token every 45 min to avoid expiry during long runs
+        if fcm_ctx is not None:
+            fcm_elapsed = (datetime.now(timezone.utc) - fcm_token_minted_at).total_seconds()
+            if fcm_elapsed > 2700:  # 45 minutes
+                if refresh_fcm_access_token(fcm_ctx):
+                    fcm_token_minted_at = datetime.now(timezone.utc)
+                    print("Proactively refreshed FCM access token")
+
+        processed_entries += batch_entry_count
+
+        # Timer checks run once per batch, for both selection and work classes.
+        timer_flags = evaluate_timer_batch(profile_batch, now)
+
+        # Full and candidate scans still fetch idle profiles; skip the ones
+        # with nothing to do.  Due scans process every row so next_action_at
+        # gets rewritten.
+        runnable_batch = (
+            profile_batch
+            if scan_mode == "due"
+            else select_profiles_needing_pass(
+                profile_batch,
+                batch_entries_by_user,
+                now,
+                include_rc_candidates=bool(rc_api_secret),
+                flags=timer_flags,
+            )
+        )
 
-          # ── PASS 3: Push #2 at 33% remaining (ALL users) ──
+        # One bulk request for the contact / key columns of the users we
+        # are about to process; idle profiles never load them.
+        missed_contacts = load_profile_contacts(client, runnable_batch)
+        if missed_contacts:
+            missed_ids = {str(profile["id"]) for profile in missed_contacts}
+            print(
+                f"Contact columns missing for {len(missed_ids)} profile(s) — "
+                f"skipped until the next run: {', '.join(sorted(missed_ids))}"
+            )
+            _record_warning(f"Contact columns missing for {len(missed_ids)} profile(s) — skipped")
+            runnable_batch = [p for p in runnable_batch if str(p["id"]) not in missed_ids]
+
+        if profile_batch:
+            work_classes = classify_profile_work(
+                runnable_batch,
+                batch_entries_by_user,
+                now,
+                include_rc_candidates=bool(rc_api_secret),
+                flags=timer_flags.subset_for(profile_batch, runnable_batch),
+            )
+            work_queue.add_batch(str(profile_batch[-1]["id"]), [
+                (work_class, profile, batch_entries_by_user.get(str(profile["id"]), []))
+                for work_class, profile in zip(work_classes, runnable_batch)
+            ])
+            _report_queue()
+
+        processed_profiles += len(profile_batch)
+
+        # Deliveries never wait; everything else waits behind later batches'
+        # deliveries until the queue fills up.
+        if not _drain_work_queue(through_class=WORK_DELIVERY, keep=WORK_QUEUE_MAX_PENDING):
+            finished = False
+            break
 
-          if should_send_push_33(profile, timer_state, now):
+        if _run_planner is not None:
+            batch_done = time.monotonic()
+            _run_planner.record_scan(len(profile_batch), batch_done - scan_tick)
+            scan_tick = batch_done
 
-              push_sent = False
+    batches.close()
 
-              try:
+    if finished and not _drain_work_queue(through_class=WORK_MAINTENANCE, keep=0):
+        finished = False
+    if len(work_queue):
+        print(f"Deferred {len(work_queue)} lower-priority users to the next run")
 
-                  push_sent = send_warning_push(
+    if resume_key is not None and finished:
+        save_checkpoint(checkpoint_ctx, resume_key, None)
 
-                      client,
+    if executor is not None:
+        executor.shutdown(wait=True)
+    _run_delivery_queue = None
 
-                      user_id,
+    return processed_profiles, processed_entries
 
-                      sender_name,
 
-                      deadline,
+def _profile_id_shards(count: int) -> list[tuple[str | None, str | None]]:
+    """Split the profile UUID keyspace into `count` disjoint [lower, upper) ranges.
 
-                      fcm_ctx,
+    Profile ids are random (v4) UUIDs, so equal slices of the leading 32 bits
+    give evenly sized shards.  Postgres orders uuid values the same way as
+    their lowercase hex text, so the bounds work directly as keyset filters.
+    """
+    bounds: list[str | None] = [None]
+    for i in range(1, count):
+        bounds.append(f"{(i << 32) // count:08x}-0000-0000-0000-000000000000")
+    bounds.append(None)
+    return list(zip(bounds[:-1], bounds[1:]))
 
-                      now_utc=now,
 
-                      remaining_fraction=timer_state.remaining_fraction,
+def build_lease_context(client, shard_count: int, lease_file: str = "") -> dict:
+    """Lease settings for coordinating several heartbeat runners.
 
-                      push_stage="warning_33",
+    Leases live in the heartbeat_leases table (sql_66) unless lease_file is
+    set, in which case a JSON file guarded by flock stands in for it — useful
+    for runners sharing one host or a network filesystem.
+    """
+    return {
+        "backend": "file" if lease_file else "supabase",
+        "client": client,
+        "path": lease_file,
+        "holder": f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}",
+        "shard_count": shard_count,
+    }
 
-                  )
 
-              except Exception as exc:  # noqa: BLE001
+def _file_lease_op(path: str, shard_key: str, holder: str, op: str, seconds: int) -> bool:
+    """Apply claim/renew/release to the file lease store, mirroring the SQL RPCs."""
+    with open(path, "a+", encoding="utf-8") as handle:
+        if fcntl is not None:
+            fcntl.flock(handle, fcntl.LOCK_EX)
+        try:
+            handle.seek(0)
+            raw = handle.read()
+            try:
+                leases = json.loads(raw) if raw.strip() else {}
+            except ValueError:
+                leases = {}
+            now_ts = time.time()
+            current = leases.get(shard_key)
+            held_by_us = current is not None and current.get("holder") == holder
+            live = current is not None and float(current.get("expires_at", 0)) > now_ts
+
+            if op == "claim":
+                ok = not live or held_by_us
+            elif op == "renew":
+                ok = held_by_us and live
+            else:  # release
+                ok = held_by_us
+                seconds = max(seconds, 0)
+            if ok:
+                leases[shard_key] = {"holder": holder, "expires_at": now_ts + seconds}
+                handle.seek(0)
+                handle.truncate()
+                handle.write(json.dumps(leases))
+                handle.flush()
+            return ok
+        finally:
+            if fcntl is not None:
+                fcntl.flock(handle, fcntl.LOCK_UN)
 
-                  print(f"Push 33% warning failed for user {user_id}: {exc}")
 
-              if push_sent:
+def _lease_call(lease_ctx: dict, shard_key: str, op: str, seconds: int) -> bool:
+    if lease_ctx["backend"] == "file":
+        return _file_lease_op(lease_ctx["path"], shard_key, lease_ctx["holder"], op, seconds)
+    params = {"p_shard_key": shard_key, "p_holder": lease_ctx["holder"]}
+    if op == "release":
+        params["p_hold_seconds"] = seconds
+    else:
+        params["p_ttl_seconds"] = seconds
+    result = lease_ctx["client"].rpc(f"heartbeat_{op}_lease", params).execute()
+    return op == "release" or bool(result.data)
 
-                  client.table("profiles").update(
 
-                      {"push_33_sent_at": now.isoformat()}
+def claim_shard_lease(lease_ctx: dict, shard_key: str, ttl_seconds: int = LEASE_TTL_SECONDS) -> bool:
+    """Try to take the lease for a shard.  Errors count as "not claimed"."""
+    try:
+        return _lease_call(lease_ctx, shard_key, "claim", ttl_seconds)
+    except Exception as exc:  # noqa: BLE001
+        print(f"Failed to claim lease {shard_key}: {exc}")
+        _record_warning(f"Failed to claim lease {shard_key}: {exc}")
+        return False
 
-                  ).eq("id", user_id).execute()
 
+def renew_shard_lease(lease_ctx: dict, shard_key: str, ttl_seconds: int = LEASE_TTL_SECONDS) -> bool:
+    """Extend a held lease.  False means it expired or was taken over."""
+    try:
+        return _lease_call(lease_ctx, shard_key, "renew", ttl_seconds)
+    except Exception as exc:  # noqa: BLE001
+        print(f"Failed to renew lease {shard_key}: {exc}")
+        _record_warning(f"Failed to renew lease {shard_key}: {exc}")
+        return False
 
 
-          # ── PASS 4: Email at 24h before expiry (PAID users only) ──
+def release_shard_lease(lease_ctx: dict, shard_key: str, hold_seconds: int = 0) -> None:
+    """Release a lease, optionally keeping it for hold_seconds after completion."""
+    try:
+        _lease_call(lease_ctx, shard_key, "release", hold_seconds)
+    except Exception as exc:  # noqa: BLE001
+        print(f"Failed to release lease {shard_key}: {exc}")
 
-          if should_send_24h_warning_email(profile, timer_state, now):
 
-              try:
+def run_singleton_passes(lease_ctx: dict | None, phase: str, run) -> bool:
+    """Call run() on only one of several leasing runners; True if it ran here.
 
-                  send_warning_email(
-                      profile,
-                      deadline,
-                      resend_key,
-                      from_email,
-                      remaining_fraction=timer_state.remaining_fraction,
-                  )
+    Without leases (lease_ctx None) this runner is the only one.  With them,
+    the phase's lease is kept for LEASE_COMPLETED_HOLD_SECONDS afterwards so
+    peers finishing later in the same cycle skip it too.
+    """
+    if lease_ctx is None:
+        run()
+        return True
+    lease_key = f"maintenance-{phase}"
+    if not claim_shard_lease(lease_ctx, lease_key, ttl_seconds=MAINTENANCE_LEASE_TTL_SECONDS):
+        print(f"{phase.capitalize()} passes are leased by another runner — skipping")
+        return False
+    try:
+        run()
+    finally:
+        release_shard_lease(lease_ctx, lease_key, hold_seconds=LEASE_COMPLETED_HOLD_SECONDS)
+    return True
 
-                  mark_warning_sent(client, user_id, now)
 
-              except Exception as exc:  # noqa: BLE001
+def build_checkpoint_context(client, checkpoint_file: str = "") -> dict:
+    """Where resumable passes keep their last fully processed profile id.
 
-                  print(f"Warning email failed for user {user_id}: {exc}")
+    Checkpoints live in the heartbeat_run_state table (sql_69) unless
+    checkpoint_file is set, in which case a JSON file guarded by flock is
+    used instead.
+    """
+    return {
+        "backend": "file" if checkpoint_file else "supabase",
+        "client": client,
+        "path": checkpoint_file,
+    }
 
 
+def checkpoint_key(scan_mode: str, id_range: tuple[str | None, str | None] | None) -> str:
+    """Checkpoint name for one scan over one id shard."""
+    lower_id, upper_id = id_range or (None, None)
+    return f"profiles:{scan_mode}:{lower_id or 'start'}-{upper_id or 'end'}"
 
-        except Exception as exc:  # noqa: BLE001
-            print(f"Processing failed for user {profile.get('id', '?')}: {exc}")
 
-    elapsed_total = time.monotonic() - start_time
-    print(
-        f"=== Heartbeat complete ===\n"
-        f"  Profiles processed: {processed_profiles}\n"
-        f"  Active entries seen: {processed_entries}\n"
-        f"  Runtime: {elapsed_total:.1f}s"
+def _file_checkpoint_op(path: str, key: str, op: str, last_id: str | None = None) -> str | None:
+    """Load or save one checkpoint in the file store, mirroring heartbeat_run_state."""
+    with open(path, "a+", encoding="utf-8") as handle:
+        if fcntl is not None:
+            fcntl.flock(handle, fcntl.LOCK_EX)
+        try:
+            handle.seek(0)
+            raw = handle.read()
+            try:
+                state = json.loads(raw) if raw.strip() else {}
+            except ValueError:
+                state = {}
+            if op == "load":
+                return (state.get(key) or {}).get("last_profile_id")
+            state[key] = {"last_profile_id": last_id, "updated_at": time.time()}
+            handle.seek(0)
+            handle.truncate()
+            handle.write(json.dumps(state))
+            handle.flush()
+            return last_id
+        finally:
+            if fcntl is not None:
+                fcntl.flock(handle, fcntl.LOCK_UN)
+
+
+def load_checkpoint(checkpoint_ctx: dict, key: str) -> str | None:
+    """Last fully processed profile id for key.  Errors mean "start over"."""
+    try:
+        if checkpoint_ctx["backend"] == "file":
+            return _file_checkpoint_op(checkpoint_ctx["path"], key, "load")
+        rows = (
+            checkpoint_ctx["client"].table("heartbeat_run_state")
+            .select("last_profile_id")
+            .eq("scan_key", key)
+            .limit(1)
+            .execute()
+        ).data or []
+        return rows[0].get("last_profile_id") if rows else None
+    except Exception as exc:  # noqa: BLE001
+        print(f"Failed to load checkpoint {key}: {exc}")
+        _record_warning(f"Failed to load checkpoint {key}: {exc}")
+        return None
+
+
+def save_checkpoint(checkpoint_ctx: dict, key: str, last_id: str | None) -> None:
+    """Record the last fully processed profile id (None once a pass completes)."""
+    try:
+        if checkpoint_ctx["backend"] == "file":
+            _file_checkpoint_op(checkpoint_ctx["path"], key, "save", last_id)
+            return
+        checkpoint_ctx["client"].table("heartbeat_run_state").upsert({
+            "scan_key": key,
+            "last_profile_id": last_id,
+            "updated_at": datetime.now(timezone.utc).isoformat(),
+        }).execute()
+    except Exception as exc:  # noqa: BLE001
+        print(f"Failed to save checkpoint {key}: {exc}")
+        _record_warning(f"Failed to save checkpoint {key}: {exc}")
+
+
+def run_leased_profile_pass(
+    client,
+    lease_ctx: dict,
+    *,
+    runtime_budget: float = MAX_RUNTIME_SECONDS,
+    **pass_kwargs,
+) -> tuple[int, int]:
+    """Process whichever profile-id shards this runner can lease.
+
+    Every runner must use the same shard count.  Shards are tried from a
+    random starting point so concurrent runners spread out; a shard whose
+    lease is lost mid-pass is abandoned at the next batch boundary.
+    """
+    shard_count = lease_ctx["shard_count"]
+    shards = _profile_id_shards(shard_count)
+    first = random.randrange(shard_count)
+    start_time = time.monotonic()
+    processed_profiles = 0
+    processed_entries = 0
+
+    for offset in range(shard_count):
+        shard_idx = (first + offset) % shard_count
+        remaining = runtime_budget - (time.monotonic() - start_time)
+        if remaining <= 0:
+            break
+        shard_key = f"profiles-{shard_idx}-of-{shard_count}"
+        if not claim_shard_lease(lease_ctx, shard_key):
+            print(f"Shard {shard_key} is leased by another runner — skipping")
+            continue
+        print(f"Claimed lease {shard_key}")
+
+        lease_lost = threading.Event()
+        stop_renewing = threading.Event()
+
+        def _renew(key=shard_key) -> bool:
+            if lease_lost.is_set():
+                return False
+            if renew_shard_lease(lease_ctx, key):
+                return True
+            lease_lost.set()
+            print(f"Lost lease {key} — stopping shard")
+            return False
+
+        def _keep_alive() -> None:
+            # Long drains (e.g. hundreds of rate-limited RevenueCat checks)
+            # can outlast LEASE_TTL_SECONDS between two batch boundaries.
+            while not stop_renewing.wait(LEASE_RENEW_INTERVAL_SECONDS):
+                if not _renew():
+                    return
+
+        renewer = threading.Thread(target=_keep_alive, name=f"lease-{shard_key}", daemon=True)
+        renewer.start()
+        try:
+            profiles, entries = run_profile_pass(
+                client,
+                id_range=shards[shard_idx],
+                runtime_budget=remaining,
+                on_batch=lambda: not lease_lost.is_set(),
+                **pass_kwargs,
+            )
+        finally:
+            stop_renewing.set()
+            renewer.join()
+        processed_profiles += profiles
+        processed_entries += entries
+
+        if lease_lost.is_set() or not _renew():
+            continue
+        completed = time.monotonic() - start_time <= runtime_budget
+        release_shard_lease(
+            lease_ctx,
+            shard_key,
+            hold_seconds=LEASE_COMPLETED_HOLD_SECONDS if completed else 0,
+        )
+
+    return processed_profiles, processed_entries
+
+
+def _divide_rate_limits(worker_count: int) -> None:
+    """Give this worker process its 1/worker_count share of the RC and Resend limits.
+
+    Worker processes cannot share a lock, so each one spaces its own calls
+    worker_count times further apart: together they stay at the team-wide
+    rate, even when that leaves a worker below 1 Resend request per second.
+    """
+    global _rc_call_interval, _resend_call_interval, _resend_request_slots
+    _rc_call_interval = RC_VERIFY_RATE_LIMIT_DELAY * worker_count
+    _resend_call_interval = RESEND_MIN_REQUEST_INTERVAL * worker_count
+    _resend_request_slots = threading.BoundedSemaphore(
+        max(1, RESEND_MAX_CONCURRENT_REQUESTS // worker_count)
     )
 
+
+def _run_profile_shard(
+    id_range: tuple[str | None, str | None],
+    worker_count: int,
+    runtime_budget: float,
+    scan_mode: str = "full",
+    fetch_mode: str = "separate",
+    checkpoint_file: str | None = None,
+    order: str = "id",
+    expected_profiles: int = 0,
+) -> dict:
+    """Worker-process entry point for ``--workers N``: run one id shard.
+
+    Each worker builds its own Supabase client, HTTP sessions and FCM token,
+    and divides the shared RevenueCat / Resend rate limits by worker_count.
+    checkpoint_file is None without --resume, "" for the table store.
+    expected_profiles is the whole run's estimate; the shard plans for its share.
+    Returns the worker's metrics and captured log for the parent to merge.
+    """
+    global _log_buffer, _resend_quota_exhausted, _run_planner, _run_decryption
+    _resend_quota_exhausted = False
+    _divide_rate_limits(worker_count)
+    _run_planner = RuntimePlanner(runtime_budget, expected_profiles=expected_profiles // worker_count)
+    _reset_metrics()
+    _log_buffer = _TeeWriter(sys.stdout)
+    sys.stdout = _log_buffer
+    try:
+        config = _load_run_config()
+        _run_decryption = DecryptionContext(config["server_secret"])
+        client = create_client(config["supabase_url"], config["supabase_key"])
+        processed_profiles, processed_entries = run_profile_pass(
+            client,
+            server_secret=config["server_secret"],
+            resend_key=config["resend_key"],
+            from_email=config["from_email"],
+            viewer_base_url=config["viewer_base_url"],
+            fcm_ctx=build_fcm_context(config["firebase_sa_json"]),
+            rc_api_secret=config["rc_api_secret"],
+            id_range=id_range,
+            runtime_budget=runtime_budget,
+            scan_mode=scan_mode,
+            fetch_mode=fetch_mode,
+            checkpoint_ctx=(
+                build_checkpoint_context(client, checkpoint_file)
+                if checkpoint_file is not None
+                else None
+            ),
+            order=order,
+        )
+    finally:
+        sys.stdout = _log_buffer._original
+    return {
+        "processed_profiles": processed_profiles,
+        "processed_entries": processed_entries,
+        "metrics": _metrics_snapshot(),
+        "resend_quota_exhausted": _resend_quota_exhausted,
+        "log": _log_buffer.getvalue(),
+    }
+
+
+def run_sharded_profile_pass(
+    workers: int,
+    *,
+    runtime_budget: float,
+    scan_mode: str = "full",
+    fetch_mode: str = "separate",
+    checkpoint_file: str | None = None,
+    order: str = "id",
+    expected_profiles: int = 0,
+) -> tuple[int, int]:
+    """Run the per-user passes in `workers` processes, one profile-id shard each.
+
+    Worker metrics are merged into this process's ``_metrics`` so the run
+    still produces a single heartbeat_runs row.
+    """
+    global _resend_quota_exhausted
+    shards = _profile_id_shards(workers)
+    print(f"Starting {workers} shard workers")
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(processes=workers) as pool:
+        results = pool.starmap(
+            _run_profile_shard,
+            [
+                (
+                    id_range, workers, runtime_budget, scan_mode, fetch_mode,
+                    checkpoint_file, order, expected_profiles,
+                )
+                for id_range in shards
+            ],
+        )
+
+    processed_profiles = 0
+    processed_entries = 0
+    for shard_idx, result in enumerate(results):
+        processed_profiles += result["processed_profiles"]
+        processed_entries += result["processed_entries"]
+        _merge_metrics(result["metrics"])
+        if result["resend_quota_exhausted"]:
+            _resend_quota_exhausted = True
+        if _log_buffer is not None:
+            _log_buffer.capture(f"--- shard {shard_idx} log ---\n{result['log']}")
+        print(
+            f"Shard {shard_idx}: {result['processed_profiles']} profiles, "
+            f"{result['processed_entries']} active entries"
+        )
+    return processed_profiles, processed_entries
+
+
+def store_run_summary(client, run_row: dict) -> None:
+    """Insert the heartbeat_runs row, dropping deferred_passes if sql_71 is missing."""
+    try:
+        client.table("heartbeat_runs").insert(run_row).execute()
+    except Exception as exc:  # noqa: BLE001
+        if "deferred_passes" not in run_row or "deferred_passes" not in str(exc):
+            raise
+        print(f"heartbeat_runs has no deferred_passes column (apply sql_71): {run_row['deferred_passes']}")
+        client.table("heartbeat_runs").insert(
+            {key: value for key, value in run_row.items() if key != "deferred_passes"}
+        ).execute()
+
+
+def run_closing_passes(
+    client,
+    *,
+    server_secret: str,
+    resend_key: str,
+    from_email: str,
+    viewer_base_url: str,
+) -> None:
+    """Passes that follow the profile pass: grace-period Forever Letters and cleanup."""
     # ── Post-loop: Forever Letters for inactive (grace-period) profiles ──
     # During Guardian grace, profiles are inactive and skipped by the main
     # loop.  But Forever Letters must still fire on their annual date —
     # a birthday letter shouldn't be delayed 30 days because of grace.
+    now = datetime.now(timezone.utc)
     try:
-        now = datetime.now(timezone.utc)
-        _grace_last_id: str | None = None
         _grace_recurring_sent = 0
-        while True:
-            _gq = (
-                client.table("profiles")
-                .select(PROFILE_SELECT_FIELDS)
-                .eq("status", "inactive")
-                .order("id")
-                .limit(PROFILE_BATCH_SIZE)
-            )
-            if _grace_last_id is not None:
-                _gq = _gq.gt("id", _grace_last_id)
-            _grace_batch = _gq.execute().data or []
-            if not _grace_batch:
-                break
+        for _grace_rows in keyset_pages(
+            client.table("profiles")
+            .select(PROFILE_SCAN_SELECT_FIELDS)
+            .eq("status", "inactive"),
+            page_size=PROFILE_BATCH_SIZE,
+        ):
+            _grace_batch = [ProfileRecord(row, contact_loaded=False) for row in _grace_rows]
             _grace_user_ids = [str(p["id"]) for p in _grace_batch]
             # Only fetch recurring entries (no need for all entry types)
-            _grace_entries = fetch_all_rows(
-                client.table("vault_entries")
-                .select(
-                    "id,user_id,title,action_type,data_type,status,"
-                    "payload_encrypted,recipient_email_encrypted,"
-                    "data_key_encrypted,hmac_signature,audio_file_path,"
-                    "is_zero_knowledge,scheduled_at,grace_until,"
-                    "entry_mode,last_sent_year"
+            _grace_entries = [
+                _ge
+                for _id_chunk in split_in_values(_grace_user_ids)
+                for _ge in fetch_all_rows(
+                    client.table("vault_entries")
+                    .select(ENTRY_SELECT_FIELDS)
+                    .eq("status", "active")
+                    .eq("entry_mode", "recurring")
+                    .in_("user_id", _id_chunk)
                 )
-                .eq("status", "active")
-                .eq("entry_mode", "recurring")
-                .in_("user_id", _grace_user_ids)
-                .order("id")
-            )
+            ]
             if _grace_entries:
                 _ge_by_user: dict[str, list[dict]] = {}
                 for _ge in _grace_entries:
                     _ge_by_user.setdefault(str(_ge["user_id"]), []).append(_ge)
+                _gp_missed = {
+                    str(_gp["id"])
+                    for _gp in load_profile_contacts(client, [
+                        _gp for _gp in _grace_batch
+                        if str(_gp["id"]) in _ge_by_user
+                        and (_gp.get("subscription_status") or "free").lower() != "free"
+                    ])
+                }
                 for _gp in _grace_batch:
                     _gp_uid = str(_gp["id"])
+                    if _gp_uid in _gp_missed:
+                        # Contact row vanished since the scan; retried next run.
+                        continue
                     # Skip free users — their recurring entries should have been
                     # deleted by inline downgrade.  If deletion failed, do NOT
                     # send pro-only content for a free user; PASS 0 will clean up
@@ -4028,7 +6503,6 @@ def main() -> int:
                         _grace_recurring_sent += _gs
                     except Exception as _gr_exc:  # noqa: BLE001
                         print(f"Recurring processing failed for inactive user {_gp_uid}: {_gr_exc}")
-            _grace_last_id = str(_grace_batch[-1]["id"])
         if _grace_recurring_sent:
             print(f"Grace-period recurring: sent {_grace_recurring_sent} Forever Letter(s) for inactive profiles")
     except Exception as exc:  # noqa: BLE001
@@ -4039,41 +6513,197 @@ def main() -> int:
     except Exception as exc:  # noqa: BLE001
         print(f"cleanup_sent_entries failed: {exc}")
 
-    try:
-        cleanup_bot_accounts(client, now)
-    except Exception as exc:  # noqa: BLE001
-        print(f"cleanup_bot_accounts failed: {exc}")
+    if not defer_optional_pass("bot_cleanup"):
+        try:
+            cleanup_bot_accounts(client, now)
+        except Exception as exc:  # noqa: BLE001
+            print(f"cleanup_bot_accounts failed: {exc}")
+
+
+def main(
+    workers: int = 1,
+    lease_shards: int = 0,
+    lease_file: str = "",
+    scan_mode: str = "full",
+    fetch_mode: str = "separate",
+    resume: bool = False,
+    checkpoint_file: str = "",
+    order: str = "id",
+) -> int:
+
+    global _resend_quota_exhausted, _run_planner, _run_decryption
+    _resend_quota_exhausted = False  # Reset for each run/retry
+
+    config = _load_run_config()
+    _run_decryption = DecryptionContext(config["server_secret"])
+
+    server_secret = config["server_secret"]
+
+    resend_key = config["resend_key"]
+
+    from_email = config["from_email"]
+
+    viewer_base_url = config["viewer_base_url"]
+
+    rc_api_secret = config["rc_api_secret"]
+    if not rc_api_secret:
+        print("WARNING: REVENUECAT_API_SECRET not set — server-side subscription verification disabled")
+        _record_warning("REVENUECAT_API_SECRET not set — server-side subscription verification disabled")
+
+    client = create_client(config["supabase_url"], config["supabase_key"])
+
+    now = datetime.now(timezone.utc)
+
+    # Shard workers mint their own FCM token; the parent only needs one
+    # for the single-process pass.
+    fcm_ctx = (
+        build_fcm_context(config["firebase_sa_json"])
+        if workers <= 1 or lease_shards > 0
+        else None
+    )
+
+    # With --lease-shards several runners share the work; the requeue, heal
+    # and closing passes run on only one of them.
+    lease_ctx = build_lease_context(client, lease_shards, lease_file) if lease_shards > 0 else None
+
+    # Optional passes (heal guards, routine RC checks, 66% pushes, bot
+    # cleanup) are shed when the planner projects the run will overrun.
+    previous_run = _load_previous_run(client)
+    _run_planner = RuntimePlanner(
+        MAX_RUNTIME_SECONDS,
+        pressure=_previous_run_was_tight(previous_run),
+        expected_profiles=int(previous_run.get("profiles_processed") or 0),
+    )
+    heal_deferred = False
+
+    def _startup_passes() -> None:
+        nonlocal heal_deferred
+        requeue_stale_sending_entries(client, now)
+        heal_deferred = _run_planner.should_defer("heal_guards")
+        if not heal_deferred:
+            try:
+                heal_inconsistent_profiles(client, now)
+            except Exception as exc:  # noqa: BLE001
+                print(f"heal_inconsistent_profiles failed: {exc}")
+
+    run_singleton_passes(lease_ctx, "startup", _startup_passes)
+
+    start_time = time.monotonic()
+    run_started_at = datetime.now(timezone.utc).isoformat()
+    _reset_metrics()
+    if heal_deferred:
+        _incr_metric("deferred_heal_guards")
+
+    # Install stdout tee to capture full log
+    global _log_buffer
+    _log_buffer = _TeeWriter(sys.stdout)
+    sys.stdout = _log_buffer
+
+    # --resume: continue after the last profile a previous (time-boxed or
+    # crashed) pass finished, instead of restarting at the lowest id.
+    checkpoint_ctx = build_checkpoint_context(client, checkpoint_file) if resume else None
+
+    if lease_shards > 0:
+        processed_profiles, processed_entries = run_leased_profile_pass(
+            client,
+            lease_ctx,
+            runtime_budget=MAX_RUNTIME_SECONDS,
+            server_secret=server_secret,
+            resend_key=resend_key,
+            from_email=from_email,
+            viewer_base_url=viewer_base_url,
+            fcm_ctx=fcm_ctx,
+            rc_api_secret=rc_api_secret,
+            scan_mode=scan_mode,
+            fetch_mode=fetch_mode,
+            checkpoint_ctx=checkpoint_ctx,
+            order=order,
+        )
+    elif workers > 1:
+        processed_profiles, processed_entries = run_sharded_profile_pass(
+            workers,
+            runtime_budget=MAX_RUNTIME_SECONDS,
+            scan_mode=scan_mode,
+            fetch_mode=fetch_mode,
+            checkpoint_file=checkpoint_file if resume else None,
+            order=order,
+            expected_profiles=_run_planner.expected_profiles,
+        )
+    else:
+        processed_profiles, processed_entries = run_profile_pass(
+            client,
+            server_secret=server_secret,
+            resend_key=resend_key,
+            from_email=from_email,
+            viewer_base_url=viewer_base_url,
+            fcm_ctx=fcm_ctx,
+            rc_api_secret=rc_api_secret,
+            runtime_budget=MAX_RUNTIME_SECONDS,
+            scan_mode=scan_mode,
+            fetch_mode=fetch_mode,
+            checkpoint_ctx=checkpoint_ctx,
+            order=order,
+        )
+
+    elapsed_total = time.monotonic() - start_time
+    print(
+        f"=== Heartbeat complete ===\n"
+        f"  Profiles processed: {processed_profiles}\n"
+        f"  Active entries seen: {processed_entries}\n"
+        f"  Runtime: {elapsed_total:.1f}s"
+    )
+
+    run_singleton_passes(
+        lease_ctx,
+        "closing",
+        lambda: run_closing_passes(
+            client,
+            server_secret=server_secret,
+            resend_key=resend_key,
+            from_email=from_email,
+            viewer_base_url=viewer_base_url,
+        ),
+    )
 
     # ── Store heartbeat run summary in DB ──
-    try:
-        client.table("heartbeat_runs").insert({
-            "started_at": run_started_at,
-            "completed_at": datetime.now(timezone.utc).isoformat(),
-            "runtime_seconds": round(elapsed_total, 1),
-            "profiles_processed": processed_profiles,
-            "entries_seen": processed_entries,
-            "emails_sent": _metrics["emails_sent"],
-            "emails_failed": _metrics["emails_failed"],
-            "pushes_sent": _metrics["pushes_sent"],
-            "pushes_failed": _metrics["pushes_failed"],
-            "entries_delivered": _metrics["entries_delivered"],
-            "entries_destroyed": _metrics["entries_destroyed"],
+    run_row = {
+        "started_at": run_started_at,
+        "completed_at": datetime.now(timezone.utc).isoformat(),
+        "runtime_seconds": round(elapsed_total, 1),
+        "profiles_processed": processed_profiles,
+        "entries_seen": processed_entries,
+        "emails_sent": _metrics["emails_sent"],
+        "emails_failed": _metrics["emails_failed"],
+        "pushes_sent": _metrics["pushes_sent"],
+        "pushes_failed": _metrics["pushes_failed"],
+        "entries_delivered": _metrics["entries_delivered"],
+        "entries_destroyed": _metrics["entries_destroyed"],
+        "entries_cleaned_up": _metrics["entries_cleaned_up"],
+        "bots_cleaned_up": _metrics["bots_cleaned_up"],
+        "recurring_sent": _metrics["recurring_sent"],
+        "scheduled_delivered": _metrics["scheduled_delivered"],
+        "downgrades_processed": _metrics["downgrades_processed"],
+        "rc_verifications": _metrics["rc_verifications"],
+        "errors": json.dumps(_metrics["errors"][-50:]),
+        "warnings": json.dumps(_metrics["warnings"][-50:]),
+        "cleanup_stats": json.dumps({
             "entries_cleaned_up": _metrics["entries_cleaned_up"],
             "bots_cleaned_up": _metrics["bots_cleaned_up"],
-            "recurring_sent": _metrics["recurring_sent"],
-            "scheduled_delivered": _metrics["scheduled_delivered"],
-            "downgrades_processed": _metrics["downgrades_processed"],
-            "rc_verifications": _metrics["rc_verifications"],
-            "errors": json.dumps(_metrics["errors"][-50:]),
-            "warnings": json.dumps(_metrics["warnings"][-50:]),
-            "cleanup_stats": json.dumps({
-                "entries_cleaned_up": _metrics["entries_cleaned_up"],
-                "bots_cleaned_up": _metrics["bots_cleaned_up"],
-            }),
-            "resend_quota_exhausted": _resend_quota_exhausted,
-            "exit_reason": "completed",
-            "stdout_log": _log_buffer.getvalue()[-100000:] if _log_buffer else "",
-        }).execute()
+        }),
+        "resend_quota_exhausted": _resend_quota_exhausted,
+        "exit_reason": "completed",
+        "stdout_log": _log_buffer.getvalue()[-100000:] if _log_buffer else "",
+    }
+    deferred_passes = {
+        name: _metrics[f"deferred_{name}"]
+        for name in OPTIONAL_PASSES
+        if _metrics[f"deferred_{name}"]
+    }
+    if deferred_passes:
+        # Needs sql_71; store_run_summary retries without it where that is missing.
+        run_row["deferred_passes"] = json.dumps(deferred_passes)
+    try:
+        store_run_summary(client, run_row)
     except Exception as _db_exc:
         print(f"Failed to store heartbeat run summary: {_db_exc}")
 
@@ -4132,13 +6762,75 @@ def is_transient_error_message(message: str) -> bool:
 
 if __name__ == "__main__":
 
+    _parser = argparse.ArgumentParser(description="Afterword heartbeat automation")
+    _parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="split active profiles across N worker processes (default: 1)",
+    )
+    _parser.add_argument(
+        "--lease-shards",
+        type=int,
+        default=0,
+        help="share the run with other runners by leasing one of N profile shards at a time",
+    )
+    _parser.add_argument(
+        "--scan",
+        choices=PROFILE_SCAN_MODES,
+        default="full",
+        help="'due' fetches only profiles whose next_action_at has arrived (needs sql_67); "
+             "'candidates' filters timers server-side (needs sql_68); "
+             "'owners' starts from users that own active entries",
+    )
+    _parser.add_argument(
+        "--fetch",
+        choices=("separate", "embedded"),
+        default="separate",
+        help="'embedded' loads profiles and their active entries in one request",
+    )
+    _parser.add_argument(
+        "--order",
+        choices=PROFILE_ORDER_MODES,
+        default="id",
+        help="'urgency' processes the most overdue profiles first (needs --scan due and sql_70)",
+    )
+    _parser.add_argument(
+        "--lease-file",
+        default="",
+        help="JSON file to hold shard leases instead of the heartbeat_leases table",
+    )
+    _parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="continue after the last profile an unfinished pass completed, wrapping "
+             "around (needs sql_69 or --checkpoint-file; not for --scan owners)",
+    )
+    _parser.add_argument(
+        "--checkpoint-file",
+        default="",
+        help="JSON file to hold resume checkpoints instead of the heartbeat_run_state table",
+    )
+    _args = _parser.parse_args()
+    if _args.order == "urgency" and _args.scan != "due":
+        _parser.error("--order urgency requires --scan due")
+
     _RETRY_DELAYS = [15, 45]
 
     for _attempt in range(3):
 
         try:
 
-            sys.exit(main())
+            sys.exit(main(
+                workers=max(1, _args.workers),
+                lease_shards=max(0, _args.lease_shards),
+                lease_file=_args.lease_file,
+                scan_mode=_args.scan,
+                fetch_mode=_args.fetch,
+                resume=_args.resume,
+                checkpoint_file=_args.checkpoint_file,
+                order=_args.order,
+            ))
 
         except Exception as exc:  # noqa: BLE001
 
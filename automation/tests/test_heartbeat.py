@@ -1,4 +1,5 @@
 import sys
+import time
 import types
 import unittest
 from datetime import datetime, timedelta, timezone
@@ -2564,6 +2565,2122 @@ class HeartbeatTests(unittest.TestCase):
         self.assertFalse(reverted)
         self.assertIsNone(client.profiles.updated_payload)
 
+    # ── Concurrent per-user processing ──
+
+    def test_process_profile_batch_runs_every_user_once_with_executor(self):
+        """Each user is one task; a failing user does not abort the batch."""
+        from concurrent.futures import ThreadPoolExecutor
+        import threading
+
+        seen = []
+        seen_lock = threading.Lock()
+
+        def _fake_process(client, profile, active_entries, **kwargs):
+            with seen_lock:
+                seen.append((profile["id"], [e["id"] for e in active_entries]))
+            if profile["id"] == "u-bad":
+                raise RuntimeError("boom")
+
+        batch = [{"id": "u-1"}, {"id": "u-bad"}, {"id": "u-2"}]
+        entries_by_user = {"u-1": [{"id": "e-1"}], "u-2": [{"id": "e-2"}, {"id": "e-3"}]}
+
+        with (
+            patch.object(heartbeat, "process_profile", side_effect=_fake_process),
+            ThreadPoolExecutor(max_workers=3) as executor,
+        ):
+            heartbeat.process_profile_batch(
+                object(), batch, entries_by_user, executor=executor,
+                now=datetime(2026, 2, 7, tzinfo=timezone.utc),
+            )
+
+        self.assertEqual(
+            sorted(seen),
+            [("u-1", ["e-1"]), ("u-2", ["e-2", "e-3"]), ("u-bad", [])],
+        )
+
+    def test_incr_metric_is_thread_safe(self):
+        import threading
+
+        heartbeat._reset_metrics()
+
+        def _bump():
+            for _ in range(2000):
+                heartbeat._incr_metric("pushes_sent")
+
+        threads = [threading.Thread(target=_bump) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(heartbeat._metrics["pushes_sent"], 16000)
+        heartbeat._reset_metrics()
+
+    def test_throttle_revenuecat_spaces_calls_across_threads(self):
+        sleeps = []
+        clock = {"t": 1000.0}
+
+        with (
+            patch.object(heartbeat, "_rc_next_call_at", 0.0),
+            patch.object(heartbeat.time, "monotonic", side_effect=lambda: clock["t"]),
+            patch.object(heartbeat.time, "sleep", side_effect=sleeps.append),
+        ):
+            for _ in range(3):
+                heartbeat._throttle_revenuecat()
+
+        delay = heartbeat.RC_VERIFY_RATE_LIMIT_DELAY
+        self.assertEqual(len(sleeps), 2)
+        self.assertAlmostEqual(sleeps[0], delay)
+        self.assertAlmostEqual(sleeps[1], 2 * delay)
+
+
+    def test_profile_id_shards_cover_keyspace_without_overlap(self):
+        shards = heartbeat._profile_id_shards(4)
+
+        self.assertEqual(len(shards), 4)
+        self.assertIsNone(shards[0][0])
+        self.assertIsNone(shards[-1][1])
+        for (_, upper), (lower, _) in zip(shards, shards[1:]):
+            self.assertEqual(upper, lower)
+        self.assertEqual(shards[1][0], "40000000-0000-0000-0000-000000000000")
+        self.assertEqual(heartbeat._profile_id_shards(1), [(None, None)])
+
+    def test_iter_active_profiles_applies_id_range_bounds(self):
+        filters = []
+
+        class _Query:
+            def select(self, *_a, **_k):
+                return self
+
+            def eq(self, *_a, **_k):
+                return self
+
+            def order(self, *_a, **_k):
+                return self
+
+            def limit(self, *_a, **_k):
+                return self
+
+            def gte(self, column, value):
+                filters.append(("gte", column, value))
+                return self
+
+            def lt(self, column, value):
+                filters.append(("lt", column, value))
+                return self
+
+            def gt(self, column, value):
+                filters.append(("gt", column, value))
+                return self
+
+            def execute(self):
+                return types.SimpleNamespace(data=[])
+
+        client = types.SimpleNamespace(table=lambda _name: _Query())
+        batches = list(heartbeat.iter_active_profiles(client, id_range=("4", "8")))
+
+        self.assertEqual(batches, [])
+        self.assertEqual(filters, [("gte", "id", "4"), ("lt", "id", "8")])
+
+    def test_merge_metrics_adds_counters_and_extends_lists(self):
+        heartbeat._reset_metrics()
+        heartbeat._incr_metric("emails_sent", 2)
+        heartbeat._record_error("parent error")
+        snapshot = heartbeat._metrics_snapshot()
+
+        heartbeat._merge_metrics(snapshot)
+
+        self.assertEqual(heartbeat._metrics["emails_sent"], 4)
+        self.assertEqual(heartbeat._metrics["errors"], ["parent error", "parent error"])
+        heartbeat._reset_metrics()
+
+
+    def test_file_lease_store_blocks_other_holders_until_released(self):
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = str(Path(tmp) / "leases.json")
+            runner_a = heartbeat.build_lease_context(None, 2, path)
+            runner_b = heartbeat.build_lease_context(None, 2, path)
+
+            self.assertTrue(heartbeat.claim_shard_lease(runner_a, "profiles-0-of-2"))
+            self.assertFalse(heartbeat.claim_shard_lease(runner_b, "profiles-0-of-2"))
+            self.assertTrue(heartbeat.renew_shard_lease(runner_a, "profiles-0-of-2"))
+            self.assertFalse(heartbeat.renew_shard_lease(runner_b, "profiles-0-of-2"))
+
+            heartbeat.release_shard_lease(runner_a, "profiles-0-of-2")
+            self.assertTrue(heartbeat.claim_shard_lease(runner_b, "profiles-0-of-2"))
+
+            heartbeat.release_shard_lease(runner_b, "profiles-0-of-2", hold_seconds=600)
+            self.assertFalse(heartbeat.claim_shard_lease(runner_a, "profiles-0-of-2"))
+
+    def test_run_leased_profile_pass_skips_shards_held_elsewhere(self):
+        import tempfile
+
+        ranges = []
+
+        def _fake_pass(_client, *, id_range, on_batch, **_kwargs):
+            self.assertTrue(on_batch())
+            ranges.append(id_range)
+            return 3, 5
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = str(Path(tmp) / "leases.json")
+            other = heartbeat.build_lease_context(None, 2, path)
+            ours = heartbeat.build_lease_context(None, 2, path)
+            heartbeat.claim_shard_lease(other, "profiles-1-of-2")
+
+            with patch.object(heartbeat, "run_profile_pass", side_effect=_fake_pass):
+                result = heartbeat.run_leased_profile_pass(object(), ours)
+
+            self.assertEqual(result, (3, 5))
+            self.assertEqual(ranges, [heartbeat._profile_id_shards(2)[0]])
+            # The finished shard stays leased so peers skip it this cycle.
+            self.assertFalse(heartbeat.claim_shard_lease(other, "profiles-0-of-2"))
+
+
+    def test_run_leased_profile_pass_stops_once_background_renewal_fails(self):
+        import tempfile
+
+        groups = []
+
+        def _fake_pass(_client, *, on_batch, **_kwargs):
+            # Stand-in for a long drain: keep processing groups until the
+            # lease check says stop.
+            deadline = time.monotonic() + 5
+            while on_batch() and time.monotonic() < deadline:
+                groups.append(1)
+                time.sleep(0.01)
+            return len(groups), 0
+
+        with tempfile.TemporaryDirectory() as tmp:
+            ctx = heartbeat.build_lease_context(None, 1, str(Path(tmp) / "leases.json"))
+            with (
+                patch.object(heartbeat, "LEASE_RENEW_INTERVAL_SECONDS", 0.02),
+                patch.object(heartbeat, "renew_shard_lease", return_value=False) as renew,
+                patch.object(heartbeat, "release_shard_lease") as release,
+                patch.object(heartbeat, "run_profile_pass", side_effect=_fake_pass),
+            ):
+                heartbeat.run_leased_profile_pass(object(), ctx)
+
+        self.assertTrue(renew.called)
+        self.assertLess(len(groups), 100)
+        # A lost shard is never released: a peer may already hold it.
+        release.assert_not_called()
+
+    def test_run_profile_pass_checks_the_lease_before_each_drained_group(self):
+        profiles = [{"id": f"u{i}"} for i in range(3)]
+        processed = []
+        checks = iter([True, True, False])
+
+        with (
+            patch.dict("os.environ", {"HEARTBEAT_PROFILE_CONCURRENCY": "1", "HEARTBEAT_PREFETCH_BATCHES": "0"}),
+            patch.object(heartbeat, "PROFILE_BATCH_SIZE", 1),
+            patch.object(heartbeat, "iter_profiles_for_scan", return_value=iter([profiles])),
+            patch.object(heartbeat, "load_profile_batch", side_effect=lambda _c, page, _m: (page, {}, 0)),
+            patch.object(heartbeat, "select_profiles_needing_pass", side_effect=lambda batch, *_a, **_k: batch),
+            patch.object(heartbeat, "load_profile_contacts"),
+            patch.object(
+                heartbeat,
+                "process_profile_batch",
+                side_effect=lambda _c, batch, *_a, **_k: processed.extend(p["id"] for p in batch) or (len(batch), 0),
+            ),
+        ):
+            heartbeat.run_profile_pass(
+                types.SimpleNamespace(),
+                server_secret="s",
+                resend_key="r",
+                from_email="f",
+                viewer_base_url="v",
+                fcm_ctx=None,
+                rc_api_secret="",
+                on_batch=lambda: next(checks),
+            )
+
+        # One check before the page, one before the first group; the failed
+        # third check stops the drain with two users still queued.
+        self.assertEqual(len(processed), 1)
+
+    def test_run_profile_pass_skips_profiles_whose_contact_row_is_missing(self):
+        rows = [{"id": "u0"}, {"id": "u1"}]
+        processed = []
+
+        def _load_batch(_client, page, _mode):
+            return [heartbeat.ProfileRecord(dict(row), contact_loaded=False) for row in page], {}, 0
+
+        def _bulk_load(_client, _table, pending, columns):
+            # u1 was deleted between the slim scan and the contact load.
+            record = pending["u0"]
+            for column in columns:
+                record[column] = "u0@example.com" if column == "email" else None
+            return [record]
+
+        with (
+            patch.dict("os.environ", {"HEARTBEAT_PROFILE_CONCURRENCY": "1", "HEARTBEAT_PREFETCH_BATCHES": "0"}),
+            patch.object(heartbeat, "iter_profiles_for_scan", return_value=iter([rows])),
+            patch.object(heartbeat, "load_profile_batch", side_effect=_load_batch),
+            patch.object(heartbeat, "select_profiles_needing_pass", side_effect=lambda batch, *_a, **_k: batch),
+            patch.object(heartbeat, "_bulk_load_columns", side_effect=_bulk_load),
+            patch.object(
+                heartbeat,
+                "process_profile_batch",
+                side_effect=lambda _c, batch, *_a, **_k: processed.extend(batch),
+            ),
+        ):
+            heartbeat.run_profile_pass(
+                types.SimpleNamespace(),
+                server_secret="s",
+                resend_key="r",
+                from_email="f",
+                viewer_base_url="v",
+                fcm_ctx=None,
+                rc_api_secret="",
+            )
+
+        self.assertEqual([p["id"] for p in processed], ["u0"])
+        self.assertEqual(processed[0]["email"], "u0@example.com")
+
+    def test_compute_next_action_at_tracks_earliest_pending_timer_step(self):
+        now = datetime(2026, 3, 1, tzinfo=timezone.utc)
+        last_check_in = now - timedelta(hours=36)
+        profile = {
+            "id": "user-1",
+            "subscription_status": "pro",
+            "last_check_in": last_check_in.isoformat(),
+            "timer_days": 30,
+            "selected_theme": None,
+            "selected_soul_fire": None,
+        }
+        entries = [{"id": "e1", "entry_mode": "standard"}]
+
+        self.assertEqual(heartbeat.compute_next_action_at(profile, entries, now), now + heartbeat.NEXT_ACTION_MAX_DEFER)
+
+        profile["timer_days"] = 3
+        timer_state = heartbeat.build_timer_state(last_check_in, 3, now)
+        self.assertEqual(heartbeat.compute_next_action_at(profile, entries, now), timer_state.push_66_at)
+
+        profile["push_66_sent_at"] = now.isoformat()
+        self.assertEqual(heartbeat.compute_next_action_at(profile, entries, now), timer_state.email_24h_at)
+
+        profile["warning_sent_at"] = now.isoformat()
+        self.assertEqual(heartbeat.compute_next_action_at(profile, entries, now), timer_state.push_33_at)
+
+        profile["downgrade_email_pending"] = True
+        self.assertEqual(heartbeat.compute_next_action_at(profile, entries, now), now)
+
+    def test_compute_next_action_at_uses_next_forever_letter_date(self):
+        now = datetime(2027, 3, 10, 12, tzinfo=timezone.utc)
+        profile = {"id": "user-1", "subscription_status": "lifetime", "timer_days": 30}
+        entries = [{
+            "id": "r1",
+            "entry_mode": "recurring",
+            "scheduled_at": "2024-03-11T09:00:00+00:00",
+            "last_sent_year": 2026,
+        }]
+
+        self.assertEqual(
+            heartbeat.compute_next_action_at(profile, entries, now),
+            datetime(2027, 3, 11, tzinfo=timezone.utc),
+        )
+
+        entries[0]["scheduled_at"] = "2024-02-29T09:00:00+00:00"
+        entries[0]["last_sent_year"] = 2027
+        self.assertEqual(
+            heartbeat._next_recurring_send_at(entries[0], now),
+            datetime(2028, 2, 29, tzinfo=timezone.utc),
+        )
+
+    def test_store_next_action_at_only_overwrites_the_value_it_read(self):
+        filters = []
+
+        class _Query:
+            def update(self, payload):
+                filters.append(("update", payload))
+                return self
+
+            def eq(self, column, value):
+                filters.append(("eq", column, value))
+                return self
+
+            def is_(self, column, value):
+                filters.append(("is", column, value))
+                return self
+
+            def execute(self):
+                return types.SimpleNamespace(data=[])
+
+        client = types.SimpleNamespace(table=lambda _name: _Query())
+        when = datetime(2026, 3, 1, tzinfo=timezone.utc)
+
+        heartbeat.store_next_action_at(
+            client, {"id": "u1", "next_action_at": "2026-02-28T00:00:00+00:00"}, when,
+        )
+        heartbeat.store_next_action_at(client, {"id": "u2", "next_action_at": None}, when)
+
+        self.assertEqual(filters[2], ("eq", "next_action_at", "2026-02-28T00:00:00+00:00"))
+        self.assertEqual(filters[5], ("is", "next_action_at", "null"))
+
+
+    def test_is_timer_candidate_matches_scalar_timer_checks(self):
+        import random
+
+        rng = random.Random(20260301)
+        base = datetime(2026, 3, 1, tzinfo=timezone.utc)
+        entries = [{"id": "e1", "entry_mode": "standard"}]
+
+        for _ in range(5000):
+            timer_days = rng.choice([1, 2, 7, 30, 30, 30, 90, 365, 3650])
+            last_check_in = base + timedelta(seconds=rng.randrange(0, 10**6), microseconds=rng.randrange(10**6))
+            total = timer_days * 86400
+            anchor = rng.choice([0.0, 0.34, 0.67, 1.0, rng.random(), 1.0 - 86400 / total])
+            now = last_check_in + timedelta(seconds=anchor * total + rng.uniform(-2, 2))
+
+            def _sent_at():
+                return rng.choice([
+                    None,
+                    (last_check_in - timedelta(hours=1)).isoformat(),
+                    last_check_in.isoformat(),
+                    (last_check_in + timedelta(hours=1)).isoformat(),
+                ])
+
+            profile = {
+                "id": "user-1",
+                "subscription_status": rng.choice(["free", "pro", "lifetime"]),
+                "last_check_in": last_check_in.isoformat(),
+                "timer_days": timer_days,
+                "push_66_sent_at": _sent_at(),
+                "push_33_sent_at": _sent_at(),
+                "warning_sent_at": _sent_at(),
+            }
+
+            timer_state = heartbeat.build_timer_state(last_check_in, timer_days, now)
+            expected = (
+                # free user with a custom timer still needs the downgrade pass
+                (profile["subscription_status"] == "free" and timer_days != 30)
+                or timer_state.remaining_seconds <= 0
+                or heartbeat.should_send_push_66(profile, timer_state, now)
+                or heartbeat.should_send_push_33(profile, timer_state, now)
+                or heartbeat.should_send_24h_warning_email(profile, timer_state, now)
+            )
+            self.assertEqual(
+                heartbeat.is_timer_candidate(profile, entries, now, include_rc_candidates=False),
+                expected,
+                (profile, now),
+            )
+
+    def test_is_timer_candidate_agrees_with_the_sql_predicate_fixtures(self):
+        import json
+        import re
+
+        script = (AUTOMATION_DIR.parent / "supabase" / "test_timer_candidates.sql").read_text()
+
+        # The SQL script calls heartbeat_is_timer_candidate with the same
+        # constants the heartbeat passes to the RPC.
+        params = dict(re.findall(r"(p_\w+) => '?([^',\n]+)'?", script))
+        now = datetime.fromisoformat(params["p_now"])
+        self.assertEqual(float(params["p_push_66_fraction"]), heartbeat.PUSH_66_REMAINING_FRACTION)
+        self.assertEqual(float(params["p_push_33_fraction"]), heartbeat.PUSH_33_REMAINING_FRACTION)
+        self.assertEqual(int(params["p_warning_window_seconds"]), heartbeat.WARNING_WINDOW.total_seconds())
+        self.assertEqual(params["p_include_rc_candidates"], "false")
+
+        block = script.split("-- fixtures:begin", 1)[1].split("-- fixtures:end", 1)[0]
+        fixtures = re.findall(r"\('([^']+)', '(\{.*?\})', '(\[.*?\])', (true|false)\)", block)
+        self.assertEqual(len(fixtures), block.count("\n") - 1)
+        self.assertGreater(len(fixtures), 20)
+
+        for label, profile_json, entries_json, expected in fixtures:
+            with self.subTest(fixture=label):
+                profile = {"id": label, **json.loads(profile_json)}
+                self.assertEqual(
+                    heartbeat.is_timer_candidate(
+                        profile, json.loads(entries_json), now, include_rc_candidates=False,
+                    ),
+                    expected == "true",
+                )
+
+    def test_is_timer_candidate_keeps_non_timer_work(self):
+        now = datetime(2026, 3, 1, tzinfo=timezone.utc)
+        idle = {
+            "id": "user-1",
+            "subscription_status": "free",
+            "last_check_in": now.isoformat(),
+            "timer_days": 30,
+        }
+
+        self.assertFalse(heartbeat.is_timer_candidate(idle, [{"entry_mode": "standard"}], now))
+        self.assertTrue(heartbeat.is_timer_candidate(idle, [{"entry_mode": "recurring"}], now))
+        self.assertTrue(heartbeat.is_timer_candidate({**idle, "app_mode": "scheduled"}, [], now))
+        self.assertTrue(heartbeat.is_timer_candidate({**idle, "subscription_status": "pro"}, [], now))
+        self.assertFalse(heartbeat.is_timer_candidate(
+            {**idle, "subscription_status": "pro"}, [], now, include_rc_candidates=False,
+        ))
+
+
+    def test_evaluate_timer_batch_matches_scalar_checks(self):
+        import random
+
+        rng = random.Random(6)
+        base = datetime(2026, 3, 1, tzinfo=timezone.utc)
+        profiles = []
+        for index in range(4000):
+            timer_days = rng.choice([None, "abc", 0, 1, 7, 30, 30, 45, 365, 3650])
+            total = heartbeat._normalize_timer_days(timer_days) * 86400
+            last_check_in = base + timedelta(seconds=rng.randrange(0, 10**6), microseconds=rng.randrange(10**6))
+            profiles.append({
+                "id": f"user-{index}",
+                "subscription_status": rng.choice([None, "free", "pro", "Lifetime"]),
+                "last_check_in": rng.choice([last_check_in.isoformat()] * 20 + [None]),
+                "timer_days": timer_days,
+                "push_66_sent_at": rng.choice([None, (last_check_in + timedelta(microseconds=rng.randrange(-5, 5))).isoformat()]),
+                "push_33_sent_at": rng.choice([None, last_check_in.isoformat(), (last_check_in - timedelta(days=1)).isoformat()]),
+                "warning_sent_at": rng.choice([None, (last_check_in + timedelta(hours=1)).isoformat()]),
+                "_anchor": last_check_in + timedelta(
+                    seconds=rng.choice([0.34, 0.67, 1.0, rng.random(), 1.0 - 86400 / total]) * total
+                ),
+            })
+
+        for _ in range(20):
+            now = rng.choice(profiles)["_anchor"] + timedelta(microseconds=rng.randrange(-2_000_000, 2_000_000))
+            flags = heartbeat.evaluate_timer_batch(profiles, now)
+            for index, profile in enumerate(profiles):
+                last_check_in = heartbeat.parse_iso(profile["last_check_in"])
+                if last_check_in is None:
+                    self.assertFalse(flags.any_due(index))
+                    continue
+                state = heartbeat.build_timer_state(last_check_in, profile["timer_days"], now)
+                self.assertEqual(flags.expired[index], state.remaining_seconds <= 0, profile)
+                self.assertEqual(flags.push_66[index], heartbeat.should_send_push_66(profile, state, now), profile)
+                self.assertEqual(flags.push_33[index], heartbeat.should_send_push_33(profile, state, now), profile)
+                self.assertEqual(
+                    flags.email_24h[index],
+                    heartbeat.should_send_24h_warning_email(profile, state, now),
+                    profile,
+                )
+
+    def test_select_profiles_needing_pass_drops_idle_profiles(self):
+        now = datetime(2026, 3, 1, tzinfo=timezone.utc)
+        idle = {"id": "idle", "subscription_status": "free", "last_check_in": now.isoformat(), "timer_days": 30}
+        expired = {**idle, "id": "expired", "last_check_in": (now - timedelta(days=31)).isoformat()}
+        no_entries = {**expired, "id": "no-entries"}
+        paid = {**idle, "id": "paid", "subscription_status": "pro"}
+        entries_by_user = {
+            "idle": [{"entry_mode": "standard"}],
+            "expired": [{"entry_mode": "standard"}],
+            "paid": [{"entry_mode": "standard"}],
+        }
+
+        selected = heartbeat.select_profiles_needing_pass(
+            [idle, expired, no_entries, paid], entries_by_user, now,
+        )
+        self.assertEqual([p["id"] for p in selected], ["expired", "paid"])
+
+        selected = heartbeat.select_profiles_needing_pass(
+            [idle, expired, no_entries, paid], entries_by_user, now, include_rc_candidates=False,
+        )
+        self.assertEqual([p["id"] for p in selected], ["expired"])
+
+
+    def test_iter_entry_owner_profiles_streams_owners_then_subscription_work(self):
+        entry_owner_rows = [{"user_id": uid} for uid in ["a", "a", "b", "c", "c", "c"]]
+        profiles = {
+            "a": {"id": "a"},
+            "b": {"id": "b"},
+            "c": {"id": "c"},
+            "paid": {"id": "paid"},
+        }
+        calls = []
+
+        class _Query:
+            def __init__(self, table):
+                self.table = table
+                self.filters = {}
+
+            def select(self, *_a, **_k):
+                return self
+
+            def eq(self, *_a, **_k):
+                return self
+
+            def order(self, *_a, **_k):
+                return self
+
+            def limit(self, *_a, **_k):
+                return self
+
+            def gt(self, column, value):
+                self.filters["gt"] = value
+                return self
+
+            def in_(self, column, values):
+                self.filters["in"] = list(values)
+                return self
+
+            def or_(self, expression):
+                self.filters["or"] = expression
+                return self
+
+            def execute(self):
+                calls.append((self.table, dict(self.filters)))
+                after = self.filters.get("gt")
+                if self.table == "vault_entries":
+                    rows = [r for r in entry_owner_rows if after is None or r["user_id"] > after]
+                    return types.SimpleNamespace(data=rows[:3])
+                if "in" in self.filters:
+                    return types.SimpleNamespace(data=[profiles[i] for i in self.filters["in"]])
+                if after is None:
+                    # Second pass: subscription-work profiles, including an owner.
+                    return types.SimpleNamespace(data=[profiles["b"], profiles["paid"]])
+                return types.SimpleNamespace(data=[])
+
+        client = types.SimpleNamespace(table=lambda name: _Query(name))
+        with patch.object(heartbeat, "PAGE_SIZE", 3):
+            batches = list(heartbeat.iter_entry_owner_profiles(client))
+
+        self.assertEqual(
+            [[p["id"] for p in batch] for batch in batches],
+            [["a", "b"], ["c"], ["paid"]],
+        )
+        entry_calls = [f for table, f in calls if table == "vault_entries"]
+        self.assertEqual([f.get("gt") for f in entry_calls], [None, "b", "c"])
+        self.assertIn("downgrade_email_pending.is.true", calls[-1][1]["or"])
+
+    def test_iter_profiles_for_scan_rejects_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            heartbeat.iter_profiles_for_scan(object(), "everything", now=datetime.now(timezone.utc))
+
+
+    def test_slot_records_behave_like_row_dicts(self):
+        profile = heartbeat.ProfileRecord({
+            "id": "user-1",
+            "last_check_in": "2026-03-01T00:00:00Z",
+            "subscription_status": "pro",
+        })
+
+        self.assertFalse(hasattr(profile, "__dict__"))
+        self.assertEqual(profile["id"], "user-1")
+        self.assertEqual(profile.get("email", "missing"), "missing")
+        self.assertNotIn("next_action_at", profile)
+        self.assertEqual(heartbeat._profile_last_check_in(profile), datetime(2026, 3, 1, tzinfo=timezone.utc))
+
+        profile["last_check_in"] = "2026-04-01T00:00:00+00:00"
+        profile["rc_checked"] = True
+        self.assertEqual(profile.last_check_in_at, datetime(2026, 4, 1, tzinfo=timezone.utc))
+        self.assertTrue(profile["rc_checked"])
+        with self.assertRaises(KeyError):
+            profile["warning_sent_at"]
+
+        entry = heartbeat.EntryRecord({"id": "e1", "entry_mode": None, "scheduled_at": "2026-05-01T00:00:00Z"})
+        self.assertEqual(heartbeat._entry_mode(entry), "standard")
+        entry["entry_mode"] = "recurring"
+        self.assertEqual(heartbeat._entry_mode(entry), "recurring")
+        self.assertEqual(heartbeat._entry_scheduled_at(entry), datetime(2026, 5, 1, tzinfo=timezone.utc))
+
+    def test_entry_summary_counts_in_one_pass(self):
+        summary = heartbeat.EntrySummary([
+            heartbeat.EntryRecord({"id": "1", "entry_mode": "recurring", "data_type": "text"}),
+            {"id": "2", "action_type": "destroy", "data_type": "audio"},
+            {"id": "3", "action_type": "send"},
+            {"id": "4"},
+        ])
+
+        self.assertTrue(summary.has_entries)
+        self.assertTrue(summary.has_recurring)
+        self.assertTrue(summary.has_audio)
+        self.assertEqual(summary.send_count, 2)
+        self.assertFalse(heartbeat.EntrySummary([]).has_entries)
+
+
+    def test_run_profile_pass_embedded_fetch_uses_one_request_per_batch(self):
+        requests_made = []
+        rows = [
+            {"id": "a", "status": "active", "vault_entries": [{"id": "e1", "user_id": "a"}]},
+            {"id": "b", "status": "active", "vault_entries": []},
+        ]
+
+        class _Query:
+            def __init__(self, table):
+                import httpx
+
+                self.table = table
+                self.selected = None
+                self.filters = []
+                self.params = httpx.QueryParams()
+
+            def select(self, fields, *_a, **_k):
+                self.selected = fields
+                return self
+
+            def eq(self, column, value):
+                self.filters.append((column, value))
+                return self
+
+            def order(self, *_a, **_k):
+                return self
+
+            def limit(self, *_a, **_k):
+                return self
+
+            def gt(self, *_a, **_k):
+                self.filters.append(("after", _a[1]))
+                return self
+
+            def lte(self, *_a, **_k):
+                return self
+
+            def execute(self):
+                requests_made.append((self.table, self.selected, list(self.filters)))
+                if ("after", "b") in self.filters:
+                    return types.SimpleNamespace(data=[])
+                return types.SimpleNamespace(data=[dict(r) for r in rows])
+
+        captured = {}
+
+        def _fake_batch(_client, profile_batch, entries_by_user, **_kwargs):
+            captured.setdefault("profiles", []).extend(p["id"] for p in profile_batch)
+            captured.setdefault("entries", {}).update(
+                {uid: [e["id"] for e in es] for uid, es in entries_by_user.items() if es}
+            )
+
+        client = types.SimpleNamespace(table=lambda name: _Query(name))
+        with (
+            patch.dict("os.environ", {"HEARTBEAT_PROFILE_CONCURRENCY": "1"}),
+            patch.object(heartbeat, "process_profile_batch", side_effect=_fake_batch),
+            patch.object(heartbeat, "load_profile_contacts"),
+        ):
+            result = heartbeat.run_profile_pass(
+                client,
+                server_secret="s",
+                resend_key="r",
+                from_email="f",
+                viewer_base_url="v",
+                fcm_ctx=None,
+                rc_api_secret="",
+                scan_mode="due",
+                fetch_mode="embedded",
+            )
+
+        self.assertEqual(result, (2, 1))
+        self.assertEqual({table for table, _, _ in requests_made}, {"profiles"})
+        self.assertIn("vault_entries(", requests_made[0][1])
+        self.assertIn(("vault_entries.status", "active"), requests_made[0][2])
+        self.assertEqual(sorted(captured["profiles"]), ["a", "b"])
+        self.assertEqual(captured["entries"], {"a": ["e1"]})
+
+
+    def test_load_entry_ciphertexts_fills_metadata_only_records_in_chunks(self):
+        requested = []
+
+        class _Query:
+            def select(self, fields):
+                self.fields = fields
+                return self
+
+            def in_(self, column, values):
+                self.ids = list(values)
+                return self
+
+            def execute(self):
+                requested.append((self.fields, self.ids))
+                return types.SimpleNamespace(data=[
+                    {"id": i, "payload_encrypted": f"p-{i}", "recipient_email_encrypted": f"r-{i}",
+                     "data_key_encrypted": f"k-{i}", "hmac_signature": f"h-{i}"}
+                    for i in self.ids
+                ])
+
+        client = types.SimpleNamespace(table=lambda _name: _Query())
+        records = [
+            heartbeat.EntryRecord({"id": f"e{i}", "user_id": "u1"}, ciphertext_loaded=False)
+            for i in range(3)
+        ]
+        loaded = heartbeat.EntryRecord({"id": "full", "payload_encrypted": "x"})
+        plain = {"id": "dict-entry"}
+
+        with patch.object(heartbeat, "ENTRY_CIPHERTEXT_CHUNK_SIZE", 2):
+            heartbeat.load_entry_ciphertexts(client, records + [loaded, plain])
+
+        self.assertEqual([ids for _, ids in requested], [["e0", "e1"], ["e2"]])
+        self.assertNotIn("title", requested[0][0])
+        self.assertTrue(all(r.ciphertext_loaded for r in records))
+        self.assertEqual(records[2]["hmac_signature"], "h-e2")
+        self.assertNotIn("payload_encrypted", heartbeat.ENTRY_METADATA_SELECT_FIELDS)
+
+        requested.clear()
+        heartbeat.load_entry_ciphertexts(client, records)
+        self.assertEqual(requested, [])
+
+    def test_load_profile_contacts_fills_only_slim_profiles(self):
+        requested = []
+
+        class _Query:
+            def __init__(self, table):
+                self.table = table
+
+            def select(self, fields):
+                self.fields = fields
+                return self
+
+            def in_(self, column, values):
+                self.ids = list(values)
+                return self
+
+            def execute(self):
+                requested.append((self.table, self.fields, self.ids))
+                return types.SimpleNamespace(data=[
+                    {"id": i, "email": f"{i}@x", "sender_name": f"S-{i}", "hmac_key_encrypted": f"k-{i}"}
+                    for i in self.ids
+                ])
+
+        client = types.SimpleNamespace(table=lambda name: _Query(name))
+        slim = heartbeat.ProfileRecord({"id": "u1", "status": "active"}, contact_loaded=False)
+        full = heartbeat.ProfileRecord({"id": "u2", "email": "u2@x"})
+        plain = {"id": "u3"}
+
+        heartbeat.load_profile_contacts(client, [slim, full, plain])
+
+        self.assertEqual(len(requested), 1)
+        self.assertEqual(requested[0][0], "profiles")
+        self.assertEqual(requested[0][2], ["u1"])
+        self.assertTrue(slim.contact_loaded)
+        self.assertEqual(slim["sender_name"], "S-u1")
+        self.assertEqual(slim["hmac_key_encrypted"], "k-u1")
+        for column in heartbeat.PROFILE_CONTACT_FIELDS:
+            self.assertNotIn(column, heartbeat.PROFILE_SCAN_SELECT_FIELDS.split(","))
+        self.assertNotIn("hmac_key_encrypted", heartbeat.PROFILE_WITH_ENTRIES_SELECT_FIELDS)
+
+    def test_prefetch_batches_keeps_order_and_bounds_lookahead(self):
+        loaded = []
+
+        def _load(batch):
+            loaded.append(batch)
+            return batch * 10
+
+        pages = iter(range(6))
+        gen = heartbeat.prefetch_batches(pages, _load, 1)
+        self.assertEqual(next(gen), 0)
+        time.sleep(0.3)
+        # One batch handed out, one queued, at most one more being loaded.
+        self.assertLessEqual(len(loaded), 3)
+        self.assertEqual(list(gen), [10, 20, 30, 40, 50])
+
+        self.assertEqual(list(heartbeat.prefetch_batches(iter([1, 2]), _load, 0)), [10, 20])
+
+    def test_prefetch_batches_reraises_fetch_errors_and_stops_on_close(self):
+        def _pages():
+            yield 1
+            raise RuntimeError("page 2 failed")
+
+        gen = heartbeat.prefetch_batches(_pages(), lambda b: b, 2)
+        self.assertEqual(next(gen), 1)
+        with self.assertRaises(RuntimeError):
+            next(gen)
+
+        fetched = []
+
+        def _endless():
+            n = 0
+            while True:
+                fetched.append(n)
+                yield n
+                n += 1
+
+        gen = heartbeat.prefetch_batches(_endless(), lambda b: b, 1)
+        self.assertEqual(next(gen), 0)
+        gen.close()
+        count = len(fetched)
+        time.sleep(0.2)
+        self.assertEqual(len(fetched), count)
+
+    def test_split_in_values_keeps_encoded_lists_under_limit(self):
+        ids = [f"{i:08d}-0000-0000-0000-000000000000" for i in range(200)]
+        chunks = heartbeat.split_in_values(ids, max_chars=1000)
+
+        self.assertEqual([v for chunk in chunks for v in chunk], ids)
+        self.assertGreater(len(chunks), 1)
+        for chunk in chunks:
+            encoded = "%2C".join(chunk)
+            self.assertLessEqual(len(encoded), 1000)
+        self.assertEqual(heartbeat.split_in_values(["a", "b"]), [["a", "b"]])
+        self.assertEqual(heartbeat.split_in_values([]), [])
+
+    def test_batch_sizer_grows_on_fast_full_pages_and_shrinks_on_slow_ones(self):
+        sizer = heartbeat.BatchSizer(200, min_size=50, max_size=1000, target_seconds=1.0)
+        rows = [{"id": str(i)} for i in range(200)]
+
+        sizer.record(rows, 0.1)
+        self.assertEqual(sizer.size, 300)
+        sizer.record(rows, 0.1)  # partial page: no growth
+        self.assertEqual(sizer.size, 300)
+        sizer.record(rows, 2.0)
+        self.assertEqual(sizer.size, 150)
+        for _ in range(5):
+            sizer.record(rows, 5.0)
+        self.assertEqual(sizer.size, 50)
+
+        sizer = heartbeat.BatchSizer(200, max_payload_bytes=100)
+        sizer.record(rows, 0.1)
+        self.assertEqual(sizer.size, 100)
+
+    def test_iter_active_profiles_uses_sizer_page_size(self):
+        limits = []
+
+        class _Query:
+            def select(self, *_a, **_k):
+                return self
+
+            def eq(self, *_a, **_k):
+                return self
+
+            def order(self, *_a, **_k):
+                return self
+
+            def limit(self, n):
+                self.n = n
+                limits.append(n)
+                return self
+
+            def gt(self, _column, value):
+                self.after = int(value)
+                return self
+
+            def execute(self):
+                start = getattr(self, "after", -1) + 1
+                stop = min(start + self.n, 700)
+                return types.SimpleNamespace(data=[{"id": str(i)} for i in range(start, stop)])
+
+        client = types.SimpleNamespace(table=lambda _name: _Query())
+        sizer = heartbeat.BatchSizer(100, min_size=50, max_size=400, target_seconds=60.0)
+        batches = list(heartbeat.iter_active_profiles(client, sizer=sizer))
+
+        self.assertEqual(limits[:4], [100, 150, 225, 337])
+        self.assertEqual(sum(len(b) for b in batches), 700)
+
+    def test_keyset_pages_seeks_past_last_key_on_a_copy_of_the_query(self):
+        from postgrest import SyncPostgrestClient
+
+        table = [{"id": f"{i:03d}"} for i in range(7)]
+        seen_params = []
+
+        def _execute(builder):
+            params = dict(builder.params)
+            seen_params.append(params)
+            after = params.get("id", "gt.")[3:]
+            rows = [r for r in table if r["id"] > after][: int(params["limit"])]
+            return types.SimpleNamespace(data=rows)
+
+        base = SyncPostgrestClient("http://localhost:1").from_("profiles").select("id").eq("status", "active")
+        with patch.object(type(base), "execute", _execute):
+            pages = list(heartbeat.keyset_pages(base, page_size=3))
+            resumed = [
+                r["id"]
+                for rows in heartbeat.keyset_pages(base, page_size=3, start_after="004", prefetch=1)
+                for r in rows
+            ]
+
+        self.assertEqual(
+            [[r["id"] for r in rows] for rows in pages],
+            [["000", "001", "002"], ["003", "004", "005"], ["006"]],
+        )
+        self.assertEqual([p.get("id") for p in seen_params[:3]], [None, "gt.002", "gt.005"])
+        self.assertTrue(all(p["order"] == "id" and p["limit"] == "3" for p in seen_params))
+        self.assertNotIn("offset", seen_params[0])
+        self.assertEqual(dict(base.params), {"select": "id", "status": "eq.active"})
+        self.assertEqual(resumed, ["005", "006"])
+
+    def test_iter_profiles_resuming_wraps_around_to_ids_before_checkpoint(self):
+        calls = []
+
+        def _scan(_client, scan_mode, *, id_range=None, start_after=None, **_kwargs):
+            calls.append((scan_mode, id_range, start_after))
+            return iter([[{"id": f"{scan_mode}-{len(calls)}"}]])
+
+        now = datetime.now(timezone.utc)
+        with patch.object(heartbeat, "iter_profiles_for_scan", side_effect=_scan):
+            batches = list(heartbeat.iter_profiles_resuming(
+                object(), "due", resume_after="m", id_range=("a", "z"), now=now,
+            ))
+            fresh = list(heartbeat.iter_profiles_resuming(object(), "full", resume_after=None, now=now))
+
+        self.assertEqual(calls[:2], [("due", ("a", "z"), "m"), ("due", ("a", "m"), None)])
+        self.assertEqual(len(batches), 2)
+        self.assertEqual(calls[2:], [("full", None, None)])
+        self.assertEqual(len(fresh), 1)
+        with self.assertRaises(ValueError):
+            heartbeat.iter_profiles_for_scan(object(), "owners", now=now, start_after="m")
+
+    def test_run_profile_pass_saves_checkpoint_per_batch_and_clears_it_when_done(self):
+        import tempfile
+
+        pages = [[{"id": "a"}, {"id": "b"}], [{"id": "c"}]]
+        starts = []
+
+        def _scan(_client, _mode, *, start_after=None, id_range=None, **_kwargs):
+            starts.append((start_after, id_range))
+            return iter(pages if start_after is None and id_range is None else [])
+
+        def _run(ctx, on_batch=None):
+            return heartbeat.run_profile_pass(
+                types.SimpleNamespace(),
+                server_secret="s",
+                resend_key="r",
+                from_email="f",
+                viewer_base_url="v",
+                fcm_ctx=None,
+                rc_api_secret="",
+                on_batch=on_batch,
+                checkpoint_ctx=ctx,
+            )
+
+        with (
+            tempfile.TemporaryDirectory() as tmp,
+            patch.dict("os.environ", {"HEARTBEAT_PROFILE_CONCURRENCY": "1", "HEARTBEAT_PREFETCH_BATCHES": "0"}),
+            patch.object(heartbeat, "iter_profiles_for_scan", side_effect=_scan),
+            patch.object(heartbeat, "load_profile_batch", side_effect=lambda _c, page, _m: (page, {}, 0)),
+            patch.object(heartbeat, "select_profiles_needing_pass", return_value=[]),
+            patch.object(heartbeat, "load_profile_contacts"),
+            patch.object(heartbeat, "process_profile_batch"),
+        ):
+            ctx = heartbeat.build_checkpoint_context(None, str(Path(tmp) / "state.json"))
+            key = heartbeat.checkpoint_key("full", None)
+
+            stop_after_first = iter([True, False])
+            with patch.object(heartbeat, "save_checkpoint", wraps=heartbeat.save_checkpoint) as saved:
+                _run(ctx, on_batch=lambda: next(stop_after_first))
+            self.assertEqual([c.args[2] for c in saved.call_args_list], ["b"])
+            self.assertEqual(heartbeat.load_checkpoint(ctx, key), "b")
+
+            _run(ctx)
+            self.assertEqual(starts[-2:], [("b", None), (None, (None, "b"))])
+            self.assertIsNone(heartbeat.load_checkpoint(ctx, key))
+
+    def test_keyset_pages_seeks_on_composite_urgency_key(self):
+        from postgrest import SyncPostgrestClient
+
+        seen_params = []
+        pages = iter([
+            [{"id": "b", "next_action_at": "2026-03-01T00:00:00+00:00"},
+             {"id": "a", "next_action_at": "2026-03-02T00:00:00+00:00"}],
+            [{"id": "c", "next_action_at": "2026-03-02T00:00:00+00:00"}],
+        ])
+
+        def _execute(builder):
+            seen_params.append(builder.params)
+            return types.SimpleNamespace(data=next(pages))
+
+        client = SyncPostgrestClient("http://localhost:1")
+        now = datetime(2026, 3, 5, tzinfo=timezone.utc)
+        with patch.object(type(client.from_("profiles").select("id")), "execute", _execute):
+            batches = list(heartbeat.iter_profiles_for_scan(
+                types.SimpleNamespace(table=client.from_),
+                "due",
+                now=now,
+                order="urgency",
+                sizer=heartbeat.BatchSizer(2, min_size=2, max_size=2),
+            ))
+
+        self.assertEqual([[p["id"] for p in b] for b in batches], [["b", "a"], ["c"]])
+        self.assertEqual(seen_params[0]["order"], "next_action_at,id")
+        self.assertNotIn("or", seen_params[0])
+        self.assertEqual(
+            seen_params[1].get_list("next_action_at"),
+            ["lte.2026-03-05T00:00:00+00:00", "gte.2026-03-02T00:00:00+00:00"],
+        )
+        self.assertEqual(
+            seen_params[1]["or"],
+            '(next_action_at.gt."2026-03-02T00:00:00+00:00",'
+            'and(next_action_at.eq."2026-03-02T00:00:00+00:00",id.gt."a"))',
+        )
+
+        with self.assertRaises(ValueError):
+            heartbeat.iter_profiles_for_scan(object(), "full", now=now, order="urgency")
+
+    def _work_queue_fixture(self, now):
+        iso = lambda dt: dt.isoformat()
+        profiles = {
+            "notify": {"id": "notify", "last_check_in": iso(now - timedelta(days=25)), "timer_days": 30,
+                       "subscription_status": "free"},
+            "paid": {"id": "paid", "last_check_in": iso(now), "timer_days": 30, "subscription_status": "pro"},
+            "expired": {"id": "expired", "last_check_in": iso(now - timedelta(days=40)), "timer_days": 30,
+                        "subscription_status": "free"},
+            "idle": {"id": "idle", "last_check_in": iso(now), "timer_days": 30, "subscription_status": "free"},
+            "letter": {"id": "letter", "last_check_in": iso(now), "timer_days": 30, "subscription_status": "pro"},
+        }
+        entries = {
+            "notify": [{"id": "n1", "user_id": "notify", "entry_mode": "standard"}],
+            "expired": [{"id": "x1", "user_id": "expired", "entry_mode": "standard"}],
+            "letter": [{"id": "l1", "user_id": "letter", "entry_mode": "recurring",
+                        "scheduled_at": iso(now - timedelta(days=365))}],
+        }
+        return profiles, entries
+
+    def test_classify_profile_work_ranks_delivery_first(self):
+        now = datetime(2026, 3, 10, 12, 0, tzinfo=timezone.utc)
+        profiles, entries = self._work_queue_fixture(now)
+        batch = [profiles[k] for k in ("notify", "paid", "expired", "idle", "letter")]
+
+        classes = heartbeat.classify_profile_work(batch, entries, now, include_rc_candidates=True)
+        self.assertEqual(classes, [
+            heartbeat.WORK_NOTIFICATION,
+            heartbeat.WORK_SUBSCRIPTION,
+            heartbeat.WORK_DELIVERY,
+            heartbeat.WORK_MAINTENANCE,
+            heartbeat.WORK_DELIVERY,
+        ])
+        without_rc = heartbeat.classify_profile_work(batch, entries, now, include_rc_candidates=False)
+        self.assertEqual(without_rc[1], heartbeat.WORK_MAINTENANCE)
+
+    def test_run_profile_pass_runs_later_deliveries_before_earlier_notifications(self):
+        now = datetime.now(timezone.utc)
+        profiles, entries = self._work_queue_fixture(now)
+        pages = [
+            [profiles["notify"], profiles["paid"], profiles["idle"]],
+            [profiles["expired"], profiles["letter"]],
+        ]
+        calls = []
+        clock = [0.0]
+
+        def _fake_batch(_client, profile_batch, entries_by_user, **_kwargs):
+            calls.append([p["id"] for p in profile_batch])
+            clock[0] += 10.0
+
+        def _pass(budget):
+            return heartbeat.run_profile_pass(
+                types.SimpleNamespace(),
+                server_secret="s",
+                resend_key="r",
+                from_email="f",
+                viewer_base_url="v",
+                fcm_ctx=None,
+                rc_api_secret="rc",
+                runtime_budget=budget,
+                scan_mode="due",
+            )
+
+        with (
+            patch.dict("os.environ", {"HEARTBEAT_PROFILE_CONCURRENCY": "1", "HEARTBEAT_PREFETCH_BATCHES": "0"}),
+            patch.object(heartbeat, "iter_profiles_for_scan", side_effect=lambda *_a, **_k: iter(pages)),
+            patch.object(
+                heartbeat, "load_profile_batch",
+                side_effect=lambda _c, page, _m: (page, {str(p["id"]): entries.get(p["id"], []) for p in page}, 0),
+            ),
+            patch.object(heartbeat, "process_profile_batch", side_effect=_fake_batch),
+        ):
+            _pass(heartbeat.MAX_RUNTIME_SECONDS)
+            self.assertEqual(calls, [["expired", "letter"], ["notify"], ["paid"], ["idle"]])
+
+            # Budget runs out after the first group: deliveries still go out,
+            # queued lower-class users wait for the next run.
+            calls.clear()
+            with patch.object(heartbeat.time, "monotonic", side_effect=lambda: clock[0]):
+                clock[0] = 0.0
+                _pass(5.0)
+            self.assertEqual(calls, [["expired", "letter"]])
+
+
+    def test_runtime_planner_projects_queued_work_and_defers_when_over(self):
+        planner = heartbeat.RuntimePlanner(1000)
+        planner.record("db_write", 0.1)
+        planner.record("db_write", 0.2)
+        self.assertAlmostEqual(planner.cost("db_write"), 0.1 + heartbeat.PLANNER_EWMA_ALPHA * 0.1)
+        planner.record("user_delivery", 2.0)
+
+        planner.set_queued({heartbeat.WORK_DELIVERY: 100, heartbeat.WORK_MAINTENANCE: 1000})
+        self.assertAlmostEqual(
+            planner.projected_seconds(),
+            heartbeat.PLANNER_POST_PASS_RESERVE_SECONDS + 100 * 2.0 + 1000 * planner.cost("db_write"),
+        )
+        self.assertFalse(planner.should_defer("push_66"))
+
+        planner.set_queued({heartbeat.WORK_DELIVERY: 500})
+        self.assertTrue(planner.should_defer("push_66"))
+
+        tight = heartbeat.RuntimePlanner(1000, pressure=True)
+        self.assertTrue(tight.should_defer("heal_guards"))
+        self.assertFalse(tight.should_defer("bot_cleanup"))
+
+    def test_defer_optional_pass_counts_shed_passes(self):
+        heartbeat._reset_metrics()
+        planner = heartbeat.RuntimePlanner(100)
+        planner.set_queued({heartbeat.WORK_SUBSCRIPTION: 1})
+        with patch.object(heartbeat, "_run_planner", None):
+            self.assertFalse(heartbeat.defer_optional_pass("bot_cleanup"))
+        with patch.object(heartbeat, "_run_planner", planner):
+            self.assertTrue(heartbeat.defer_optional_pass("bot_cleanup"))
+            self.assertTrue(heartbeat.defer_optional_pass("rc_verification"))
+            self.assertTrue(heartbeat.defer_optional_pass("rc_verification"))
+
+        self.assertEqual(heartbeat._metrics["deferred_bot_cleanup"], 1)
+        self.assertEqual(heartbeat._metrics["deferred_rc_verification"], 2)
+        self.assertEqual(heartbeat._metrics["deferred_push_66"], 0)
+        heartbeat._reset_metrics()
+
+
+    def test_user_entry_cap_leaves_remainder_pending_until_a_later_run(self):
+        now = datetime(2026, 2, 20, 10, 0, tzinfo=timezone.utc)
+        statuses = {"s0": "active", "s1": "active", "s2": "active", "d0": "active"}
+        entries = [
+            {"id": f"s{i}", "action_type": "send", "title": f"Send {i}",
+             "payload_encrypted": "p", "recipient_email_encrypted": "r",
+             "data_key_encrypted": "dk", "hmac_signature": "sig"}
+            for i in range(3)
+        ] + [{"id": "d0", "action_type": "destroy", "title": "Destroy"}]
+        profile = {
+            "id": "user-capped",
+            "sender_name": "Cap",
+            "hmac_key_encrypted": "enc-hmac",
+            "subscription_status": "premium",
+            "timer_days": 7,
+            "last_check_in": datetime(2026, 2, 1, tzinfo=timezone.utc).isoformat(),
+        }
+        profile_updates = []
+
+        class _Query:
+            def __init__(self, table):
+                self.table = table
+                self.statuses = ()
+
+            def update(self, payload):
+                if self.table == "profiles":
+                    profile_updates.append(payload)
+                return self
+
+            def select(self, *_args, **_kwargs):
+                return self
+
+            def eq(self, *_args):
+                return self
+
+            def neq(self, *_args):
+                return self
+
+            def in_(self, column, values):
+                if column == "status":
+                    self.statuses = values
+                return self
+
+            def execute(self):
+                pending = sum(1 for status in statuses.values() if status in self.statuses)
+                return types.SimpleNamespace(data=[], count=pending)
+
+        client = types.SimpleNamespace(table=_Query)
+
+        def _claim(_client, entry_id):
+            statuses[entry_id] = "sending"
+            return True
+
+        def _mark_sent(_client, entry_id, _now):
+            statuses[entry_id] = "sent"
+            return True
+
+        def _run_once():
+            heartbeat.process_profile(
+                client, profile,
+                [e for e in entries if statuses.get(e["id"]) == "active"],
+                server_secret="s", resend_key="rk", from_email="f@x.com",
+                viewer_base_url="https://v.x", fcm_ctx=None, rc_api_secret="", now=now,
+            )
+
+        with (
+            patch.object(heartbeat, "USER_ENTRY_CAP", 2),
+            patch.dict("os.environ", {"HEARTBEAT_USER_ENTRY_CAP": ""}),
+            patch.object(heartbeat, "claim_entry_for_sending", side_effect=_claim),
+            patch.object(heartbeat, "extract_server_ciphertext", side_effect=lambda v: v),
+            patch.object(heartbeat, "decrypt_with_server_secret", return_value=b"ben@example.com"),
+            patch.object(heartbeat, "compute_hmac_signature", return_value="sig"),
+            patch.object(heartbeat, "build_unlock_email_payload", return_value={"mock": True}),
+            patch.object(heartbeat, "_post_json_with_retries", return_value=_DummyResponse(200, "{}")) as mock_post,
+            patch.object(heartbeat, "mark_entry_sent", side_effect=_mark_sent),
+            patch.object(heartbeat, "delete_entry", side_effect=lambda _c, e: statuses.pop(e["id"])),
+            patch.object(heartbeat, "send_executed_push", return_value=True),
+            patch.object(heartbeat, "process_recurring_entries", return_value=0),
+        ):
+            _run_once()
+            # Destroy entry first, then one send; two sends stay active and
+            # the profile stays active for the next run.
+            self.assertEqual(statuses, {"s0": "sent", "s1": "active", "s2": "active"})
+            self.assertFalse(any(u.get("status") == "inactive" for u in profile_updates))
+
+            _run_once()
+
+        self.assertEqual(statuses, {"s0": "sent", "s1": "sent", "s2": "sent"})
+        self.assertEqual(mock_post.call_count, 2)
+        self.assertTrue(any(u.get("status") == "inactive" for u in profile_updates))
+
+
+    def test_due_notification_stages_collapse_to_most_urgent_after_outage(self):
+        last_check_in = datetime(2026, 2, 1, tzinfo=timezone.utc)
+        now = datetime(2026, 2, 7, 6, 0, tzinfo=timezone.utc)  # past the 24h-email point of a 7-day timer
+        state = heartbeat.build_timer_state(last_check_in, 7, now)
+
+        self.assertEqual(
+            heartbeat.due_notification_stages({"subscription_status": "pro"}, state, now),
+            ["warning_66", "warning_33", "email_24h"],
+        )
+        self.assertEqual(
+            heartbeat.due_notification_stages(
+                {"subscription_status": "free", "push_66_sent_at": (last_check_in + timedelta(days=3)).isoformat()},
+                state,
+                now,
+            ),
+            ["warning_33"],
+        )
+
+    def test_process_profile_sends_only_latest_stage_and_marks_earlier_in_one_write(self):
+        now = datetime(2026, 2, 6, 2, 0, tzinfo=timezone.utc)  # 66% and 33% both due
+        profile = heartbeat.ProfileRecord({
+            "id": "user-outage",
+            "sender_name": "Ada",
+            "subscription_status": "free",
+            "timer_days": 7,
+            "last_check_in": datetime(2026, 2, 1, tzinfo=timezone.utc).isoformat(),
+        })
+        entries = [{"id": "e1", "action_type": "send", "status": "active"}]
+        updates = []
+
+        class _Profiles:
+            def update(self, payload):
+                updates.append(payload)
+                return self
+
+            def eq(self, *_args):
+                return self
+
+            def execute(self):
+                return types.SimpleNamespace(data=[], count=0)
+
+        client = types.SimpleNamespace(table=lambda _name: _Profiles())
+
+        with (
+            patch.object(heartbeat, "send_warning_push", return_value=True) as mock_push,
+            patch.object(heartbeat, "send_warning_email") as mock_email,
+            patch.object(heartbeat, "process_recurring_entries", return_value=0),
+            patch.object(heartbeat, "handle_subscription_downgrade", return_value=False),
+        ):
+            heartbeat.process_profile(
+                client, profile, entries,
+                server_secret="s", resend_key="rk", from_email="f@x.com",
+                viewer_base_url="https://v.x", fcm_ctx={"project_id": "p"},
+                rc_api_secret="", now=now,
+            )
+
+        mock_push.assert_called_once()
+        self.assertEqual(mock_push.call_args.kwargs["push_stage"], "warning_33")
+        mock_email.assert_not_called()
+        stage_writes = [u for u in updates if "push_33_sent_at" in u or "push_66_sent_at" in u]
+        self.assertEqual(stage_writes, [{
+            "push_66_sent_at": now.isoformat(),
+            "push_33_sent_at": now.isoformat(),
+        }])
+        self.assertEqual(profile["push_66_sent_at"], now.isoformat())
+        self.assertEqual(profile["push_33_sent_at"], now.isoformat())
+
+
+    def test_warning_email_marks_nothing_when_the_contact_load_missed(self):
+        now = datetime(2026, 2, 7, 6, 0, tzinfo=timezone.utc)  # every stage of a 7-day timer due
+        row = {
+            "id": "user-miss",
+            "subscription_status": "pro",
+            "timer_days": 7,
+            "last_check_in": datetime(2026, 2, 1, tzinfo=timezone.utc).isoformat(),
+        }
+        entries = [{"id": "e1", "action_type": "send", "status": "active"}]
+
+        def _run(profile):
+            updates = []
+
+            class _Profiles:
+                def update(self, payload):
+                    updates.append(payload)
+                    return self
+
+                def eq(self, *_args):
+                    return self
+
+                def execute(self):
+                    return types.SimpleNamespace(data=[], count=0)
+
+            with (
+                patch.object(heartbeat, "_bulk_load_columns", return_value=[]),
+                patch.object(heartbeat, "send_warning_push") as mock_push,
+                patch.object(heartbeat, "send_notification_email") as mock_send,
+                patch.object(heartbeat, "process_recurring_entries", return_value=0),
+            ):
+                client = types.SimpleNamespace(table=lambda _name: _Profiles())
+                heartbeat.load_profile_contacts(client, [profile])
+                heartbeat.process_profile(
+                    client, profile, entries,
+                    server_secret="s", resend_key="rk", from_email="f@x.com",
+                    viewer_base_url="https://v.x", fcm_ctx={"project_id": "p"},
+                    rc_api_secret="", now=now,
+                )
+            mock_push.assert_not_called()
+            return updates, mock_send
+
+        # The bulk contact load came back without this row: the address is
+        # unknown, so no stage is marked and nothing is sent.
+        missed = heartbeat.ProfileRecord(dict(row), contact_loaded=False)
+        updates, mock_send = _run(missed)
+        mock_send.assert_not_called()
+        self.assertEqual([u for u in updates if any(k.endswith("_sent_at") for k in u)], [])
+        self.assertIsNone(missed.get("warning_sent_at"))
+
+        # A loaded row with no address marks the email stage only; the push
+        # stages were never attempted, so they stay due.
+        empty = heartbeat.ProfileRecord({**row, "email": "", "sender_name": "Ada", "hmac_key_encrypted": None})
+        updates, mock_send = _run(empty)
+        mock_send.assert_not_called()
+        self.assertEqual(
+            [u for u in updates if any(k.endswith("_sent_at") for k in u)],
+            [{"warning_sent_at": now.isoformat()}],
+        )
+        self.assertIsNone(empty.get("push_66_sent_at"))
+
+    def test_decryption_context_decrypts_wrapped_and_plain_boxes(self):
+        import base64
+        import hashlib
+        import json
+        import os
+
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+        def _box(plaintext: bytes) -> str:
+            nonce = os.urandom(12)
+            sealed = AESGCM(hashlib.sha256(b"server-secret").digest()).encrypt(nonce, plaintext, None)
+            return ".".join(
+                base64.b64encode(part).decode() for part in (nonce, sealed[:-16], sealed[-16:])
+            )
+
+        plain = _box(b"ben@example.com")
+        wrapped = json.dumps({"server": _box(b"data-key"), "client": "ignored"})
+        ctx = heartbeat.DecryptionContext("server-secret")
+
+        with patch.object(heartbeat.json, "loads", wraps=json.loads) as mock_loads:
+            self.assertEqual(heartbeat.extract_server_ciphertext(plain), plain)
+            mock_loads.assert_not_called()
+            results = ctx.decrypt_many([plain, wrapped, "not-a-box"])
+
+        self.assertEqual(results[:2], [b"ben@example.com", b"data-key"])
+        self.assertIsInstance(results[2], ValueError)
+        self.assertEqual(heartbeat.decrypt_with_server_secret(plain, "server-secret"), b"ben@example.com")
+
+    def test_run_decryption_context_memoizes_user_hmac_keys(self):
+        ctx = heartbeat.DecryptionContext("s")
+        ctx._cipher = types.SimpleNamespace(decrypt=lambda *_args: b"h" * 32)
+        with (
+            patch.object(heartbeat, "_run_decryption", ctx),
+            patch.object(heartbeat, "decode_secret_box", return_value=(b"n" * 12, b"c", b"m")) as mock_box,
+        ):
+            first = heartbeat.decrypt_user_hmac_key("enc-hmac", "s")
+            second = heartbeat.decrypt_user_hmac_key("enc-hmac", "s")
+
+        self.assertEqual(first, b"h" * 32)
+        self.assertIs(second, first)
+        mock_box.assert_called_once_with("enc-hmac")
+
+
+    def test_process_expired_entries_pools_decryption_for_large_vaults(self):
+        import base64
+        import hashlib
+        import os
+
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+        def _box(plaintext: bytes) -> str:
+            nonce = os.urandom(12)
+            sealed = AESGCM(hashlib.sha256(b"server-secret").digest()).encrypt(nonce, plaintext, None)
+            return ".".join(
+                base64.b64encode(part).decode() for part in (nonce, sealed[:-16], sealed[-16:])
+            )
+
+        now = datetime(2026, 2, 7, 10, 0, tzinfo=timezone.utc)
+        entries = [
+            {"id": f"e-{i}", "action_type": "send", "title": f"Entry {i}",
+             "payload_encrypted": "p", "recipient_email_encrypted": _box(f"ben{i}@example.com".encode()),
+             "data_key_encrypted": _box(b"k" * 32), "hmac_signature": "sig"}
+            for i in range(heartbeat.DECRYPT_POOL_MIN_VALUES // 2)
+        ]
+        entries[5]["data_key_encrypted"] = "AAAA.AAAA.AAAA"  # fails AES-GCM
+        recipients = []
+        released = []
+
+        with (
+            patch.object(heartbeat, "decrypt_with_server_secret", side_effect=AssertionError("decrypted inline")),
+            patch.object(heartbeat, "claim_entry_for_sending", return_value=True),
+            patch.object(heartbeat, "release_entry_lock", side_effect=lambda _c, eid: released.append(eid)),
+            patch.object(
+                heartbeat, "build_unlock_email_payload",
+                side_effect=lambda recipient, *_args: recipients.append(recipient) or {"to": recipient},
+            ),
+            patch.object(heartbeat, "_post_json_with_retries", return_value=_DummyResponse(200, "{}")),
+            patch.object(heartbeat, "mark_entry_sent", return_value=True),
+            patch.object(heartbeat, "send_executed_push", return_value=True),
+            patch.object(heartbeat, "_try_send_tampering_notification") as mock_tamper,
+        ):
+            had_send, _ = heartbeat.process_expired_entries(
+                client=object(), profile={"id": "u-big", "hmac_key_encrypted": None}, entries=entries,
+                server_secret="server-secret", resend_key="rk", from_email="f@x.com",
+                viewer_base_url="https://v.x", fcm_ctx=None, now=now,
+            )
+
+        self.assertTrue(had_send)
+        self.assertEqual(released, ["e-5"])
+        self.assertEqual(
+            recipients,
+            [f"ben{i}@example.com" for i in range(len(entries)) if i != 5],
+        )
+        self.assertEqual(mock_tamper.call_args.kwargs["decryption_failures"], 1)
+
+
+    def _streaming_entries(self, count):
+        return [
+            {"id": f"e-{i}", "action_type": "send", "title": f"Entry {i}",
+             "payload_encrypted": "p", "recipient_email_encrypted": "r",
+             "data_key_encrypted": "dk", "hmac_signature": "sig"}
+            for i in range(count)
+        ]
+
+    def test_deliver_due_entries_prepares_next_chunk_while_previous_is_sent(self):
+        import threading
+
+        now = datetime(2026, 2, 7, 10, 0, tzinfo=timezone.utc)
+        entries = self._streaming_entries(5)
+        third_prepared = threading.Event()
+        overlapped = []
+        posts = []
+
+        def _build(recipient, entry_id, *_args):
+            if entry_id == "e-2":
+                third_prepared.set()
+            return {"entry": entry_id}
+
+        def _post(url, *, headers, payload, idempotency_key=None):
+            if not posts:
+                # Chunk 0 is in flight; chunk 1 must get prepared meanwhile.
+                overlapped.append(third_prepared.wait(timeout=5))
+            posts.append(([p["entry"] for p in payload], idempotency_key))
+            return _DummyResponse(200, "{}")
+
+        with (
+            patch.object(heartbeat, "RESEND_BATCH_LIMIT", 2),
+            patch.object(heartbeat, "RESEND_INTER_CHUNK_DELAY", 0),
+            patch.object(heartbeat, "claim_entry_for_sending", return_value=True),
+            patch.object(heartbeat, "decrypt_with_server_secret", return_value=b"ben@example.com"),
+            patch.object(heartbeat, "build_unlock_email_payload", side_effect=_build),
+            patch.object(heartbeat, "_post_json_with_retries", side_effect=_post),
+            patch.object(heartbeat, "mark_entry_sent", return_value=True) as mock_mark,
+            patch.object(heartbeat, "send_executed_push", return_value=True),
+        ):
+            had_send, _ = heartbeat.process_expired_entries(
+                client=object(), profile={"id": "u-stream", "hmac_key_encrypted": None}, entries=entries,
+                server_secret="s", resend_key="rk", from_email="f@x.com",
+                viewer_base_url="https://v.x", fcm_ctx=None, now=now,
+            )
+
+        self.assertTrue(had_send)
+        self.assertEqual(overlapped, [True])
+        self.assertEqual([ids for ids, _ in posts], [["e-0", "e-1"], ["e-2", "e-3"], ["e-4"]])
+        keys = [key for _, key in posts]
+        self.assertEqual(len(set(keys)), 3)
+        self.assertTrue(all(key.startswith("unlock-batch-u-stream-") for key in keys))
+        self.assertEqual(mock_mark.call_count, 5)
+
+    def test_deliver_due_entries_stops_claiming_after_a_failed_chunk(self):
+        now = datetime(2026, 6, 15, 12, 0, tzinfo=timezone.utc)
+        entries = self._streaming_entries(7)
+        for entry in entries:
+            entry["scheduled_at"] = (now - timedelta(hours=1)).isoformat()
+        claimed = []
+        released = []
+
+        with (
+            patch.object(heartbeat, "RESEND_BATCH_LIMIT", 2),
+            patch.object(heartbeat, "RESEND_INTER_CHUNK_DELAY", 0),
+            patch.object(heartbeat, "claim_entry_for_sending",
+                         side_effect=lambda _c, eid: claimed.append(eid) or True),
+            patch.object(heartbeat, "release_entry_lock",
+                         side_effect=lambda _c, eid: released.append(eid)),
+            patch.object(heartbeat, "decrypt_with_server_secret", return_value=b"ben@example.com"),
+            patch.object(heartbeat, "build_unlock_email_payload", return_value={"mock": True}),
+            patch.object(heartbeat, "_post_json_with_retries", return_value=_DummyResponse(500, "boom")),
+            patch.object(heartbeat, "mark_entry_sent") as mock_mark,
+        ):
+            sent = heartbeat.process_scheduled_entries(
+                client=object(), profile={"id": "u-fail", "hmac_key_encrypted": None}, entries=entries,
+                server_secret="s", resend_key="rk", from_email="f@x.com",
+                viewer_base_url="https://v.x", now=now,
+            )
+
+        self.assertEqual(sent, 0)
+        mock_mark.assert_not_called()
+        # Chunk 0 failed; chunk 1 was already prepared and is released too.
+        self.assertEqual(sorted(released), ["e-0", "e-1", "e-2", "e-3"])
+        self.assertEqual(sorted(claimed), sorted(released))
+
+
+    def test_delivery_batch_queue_fills_batches_across_users_and_maps_ids_back(self):
+        import json
+        from concurrent.futures import ThreadPoolExecutor
+
+        posts = []
+
+        def _post(url, *, headers, payload, idempotency_key=None):
+            posts.append((list(payload), idempotency_key))
+            data = [{"id": f"r-{p['entry']}"} for p in payload]
+            return _DummyResponse(200, json.dumps({"data": data}))
+
+        queue = heartbeat.DeliveryBatchQueue("rk", linger_seconds=5)
+        chunks = {
+            "u1": [("a1", {"entry": "a1"}), ("a2", {"entry": "a2"})],
+            "u2": [("b1", {"entry": "b1"})],
+            "u3": [("c1", {"entry": "c1"})],
+        }
+        with (
+            patch.object(heartbeat, "RESEND_BATCH_LIMIT", 4),
+            patch.object(heartbeat, "_post_json_with_retries", side_effect=_post),
+            ThreadPoolExecutor(max_workers=3) as pool,
+        ):
+            futures = {user: pool.submit(queue.send, items) for user, items in chunks.items()}
+            results = {user: future.result(timeout=5) for user, future in futures.items()}
+
+        self.assertEqual(len(posts), 1)
+        self.assertEqual(sorted(p["entry"] for p in posts[0][0]), ["a1", "a2", "b1", "c1"])
+        self.assertEqual(
+            results,
+            {"u1": (["r-a1", "r-a2"], False), "u2": (["r-b1"], False), "u3": (["r-c1"], False)},
+        )
+        expected_hash = heartbeat.hashlib.md5(b"a1|a2|b1|c1").hexdigest()[:16]
+        self.assertEqual(posts[0][1], f"unlock-batch-{expected_hash}")
+
+    def test_delivery_batch_queue_flushes_after_linger_and_reports_failures(self):
+        queue = heartbeat.DeliveryBatchQueue("rk", linger_seconds=0.01)
+        with patch.object(heartbeat, "_post_json_with_retries", return_value=_DummyResponse(500, "down")) as mock_post:
+            self.assertEqual(queue.send([("e1", {"entry": "e1"})]), (None, False))
+        mock_post.assert_called_once()
+
+        released = []
+        marked = []
+        now = datetime(2026, 2, 7, 10, 0, tzinfo=timezone.utc)
+        with (
+            patch.object(heartbeat, "_run_delivery_queue", queue),
+            patch.object(heartbeat, "claim_entry_for_sending", return_value=True),
+            patch.object(heartbeat, "release_entry_lock", side_effect=lambda _c, eid: released.append(eid)),
+            patch.object(heartbeat, "decrypt_with_server_secret", return_value=b"ben@example.com"),
+            patch.object(heartbeat, "build_unlock_email_payload", return_value={"mock": True}),
+            patch.object(heartbeat, "mark_entry_sent", side_effect=lambda _c, eid, _n: marked.append(eid) or True),
+            patch.object(heartbeat, "send_executed_push", return_value=True),
+            patch.object(heartbeat, "_post_json_with_retries", return_value=_DummyResponse(500, "down")),
+        ):
+            had_send, _ = heartbeat.process_expired_entries(
+                client=object(), profile={"id": "u-q", "hmac_key_encrypted": None},
+                entries=self._streaming_entries(2),
+                server_secret="s", resend_key="rk", from_email="f@x.com",
+                viewer_base_url="https://v.x", fcm_ctx=None, now=now,
+            )
+
+        self.assertFalse(had_send)
+        self.assertEqual(marked, [])
+        self.assertEqual(sorted(released), ["e-0", "e-1"])
+
+    def test_process_profile_batch_flushes_notification_emails_in_one_batch(self):
+        posts = []
+        marked = []
+
+        def _post(url, *, headers, payload, idempotency_key=None):
+            posts.append((url, list(payload), idempotency_key, list(marked)))
+            return _DummyResponse(200, '{"data": [{"id": "r1"}, {"id": "r2"}]}')
+
+        def _fake_process(client, profile, active_entries, **kwargs):
+            uid = profile["id"]
+            heartbeat.send_notification_email(
+                kwargs["resend_key"], "f@x.com", f"{uid}@example.com", "s", "t", "<p>h</p>",
+                idempotency_key=f"warning-{uid}-2026-02-07",
+                on_sent=lambda: marked.append(uid),
+            )
+
+        with (
+            patch.object(heartbeat, "process_profile", side_effect=_fake_process),
+            patch.object(heartbeat, "_post_json_with_retries", side_effect=_post),
+        ):
+            heartbeat.process_profile_batch(
+                object(), [{"id": "u-1"}, {"id": "u-2"}], {},
+                now=datetime(2026, 2, 7, tzinfo=timezone.utc), resend_key="rk",
+            )
+
+        self.assertEqual(len(posts), 1)
+        url, payload, key, marked_before_post = posts[0]
+        self.assertEqual(url, "https://api.resend.com/emails/batch")
+        self.assertEqual([p["to"] for p in payload], [["u-1@example.com"], ["u-2@example.com"]])
+        self.assertEqual(payload[0]["tags"], [{"name": "dedupe_key", "value": "warning-u-1-2026-02-07"}])
+        expected_hash = heartbeat.hashlib.md5(b"warning-u-1-2026-02-07|warning-u-2-2026-02-07").hexdigest()[:16]
+        self.assertEqual(key, f"notify-batch-{expected_hash}")
+        # Columns are only updated once the batch request has succeeded.
+        self.assertEqual(marked_before_post, [])
+        self.assertEqual(marked, ["u-1", "u-2"])
+        self.assertIsNone(heartbeat._notification_outbox)
+
+    def test_notification_outbox_failure_leaves_messages_unmarked(self):
+        marked = []
+        outbox = heartbeat.NotificationOutbox("rk")
+        payload = heartbeat.build_email_payload("f@x.com", "a@example.com", "s", "t", "<p>h</p>")
+        outbox.add(payload, "downgrade-u-1-2026-02-07", lambda: marked.append("u-1"))
+        outbox.add(payload, "downgrade-u-1-2026-02-07", lambda: marked.append("dup"))
+        self.assertEqual(len(outbox), 1)
+
+        with patch.object(heartbeat, "_post_json_with_retries", return_value=_DummyResponse(500, "down")) as mock_post:
+            outbox.flush()
+
+        mock_post.assert_called_once()
+        self.assertEqual(mock_post.call_args.kwargs["idempotency_key"], "downgrade-u-1-2026-02-07")
+        self.assertEqual(marked, [])
+        self.assertEqual(len(outbox), 0)
+
+        # Outside a profile batch the email is sent immediately.
+        with patch.object(heartbeat, "send_email") as mock_send:
+            heartbeat.send_notification_email(
+                "rk", "f@x.com", "a@example.com", "s", "t", "<p>h</p>",
+                idempotency_key="tamper-u-1-2026-02-07", on_sent=lambda: marked.append("now"),
+            )
+        mock_send.assert_called_once()
+        self.assertEqual(marked, ["now"])
+
+    def test_only_the_due_scan_reads_and_writes_next_action_at(self):
+        from postgrest import SyncPostgrestClient
+
+        seen_params = []
+
+        def _execute(builder):
+            seen_params.append(builder.params)
+            return types.SimpleNamespace(data=[])
+
+        client = SyncPostgrestClient("http://localhost:1")
+        now = datetime(2026, 3, 5, tzinfo=timezone.utc)
+        with patch.object(type(client.from_("profiles").select("id")), "execute", _execute):
+            for scan in ("full", "due"):
+                list(heartbeat.iter_profiles_for_scan(types.SimpleNamespace(table=client.from_), scan, now=now))
+
+        self.assertNotIn("next_action_at", seen_params[0]["select"].split(","))
+        self.assertIn("next_action_at", seen_params[1]["select"].split(","))
+        self.assertNotIn("next_action_at", heartbeat.PROFILE_SELECT_FIELDS)
+
+        with (
+            patch.object(heartbeat, "process_profile"),
+            patch.object(heartbeat, "store_next_action_at") as mock_store,
+        ):
+            heartbeat.process_profile_batch(object(), [heartbeat.ProfileRecord({"id": "u-full"})], {}, now=now)
+            mock_store.assert_not_called()
+            heartbeat.process_profile_batch(
+                object(), [heartbeat.ProfileRecord({"id": "u-due", "next_action_at": None})], {}, now=now,
+            )
+            mock_store.assert_called_once()
+
+    def test_next_action_at_is_stored_after_the_outbox_flush(self):
+        now = datetime(2026, 2, 7, tzinfo=timezone.utc)
+        events = []
+
+        def _fake_process(client, profile, active_entries, **kwargs):
+            heartbeat.send_notification_email(
+                kwargs["resend_key"], "f@x.com", "u@example.com", "s", "t", "<p>h</p>",
+                idempotency_key="warning-u-1-2026-02-07",
+                on_sent=lambda: profile.__setitem__("warning_sent_at", now.isoformat()),
+            )
+
+        def _post(url, *, headers, payload, idempotency_key=None):
+            events.append("send")
+            return _DummyResponse(200, '{"id": "r1"}')
+
+        profile = heartbeat.ProfileRecord({"id": "u-1", "next_action_at": None, "warning_sent_at": None})
+        with (
+            patch.object(heartbeat, "process_profile", side_effect=_fake_process),
+            patch.object(heartbeat, "_post_json_with_retries", side_effect=_post),
+            patch.object(
+                heartbeat,
+                "compute_next_action_at",
+                side_effect=lambda p, _e, _n: events.append(("compute", p["warning_sent_at"])) or now,
+            ),
+            patch.object(heartbeat, "store_next_action_at"),
+        ):
+            heartbeat.process_profile_batch(object(), [profile], {}, now=now, resend_key="rk")
+
+        # Computed from the profile as marked by the flushed email's on_sent.
+        self.assertEqual(events, ["send", ("compute", now.isoformat())])
+
+    def test_notification_outbox_isolates_rejected_messages_and_falls_back_to_single_sends(self):
+        def _outbox(marked):
+            outbox = heartbeat.NotificationOutbox("rk")
+            for uid in ("u-1", "u-2", "u-3"):
+                outbox.add(
+                    heartbeat.build_email_payload("f@x.com", f"{uid}@example.com", "s", "t", "<p>h</p>"),
+                    f"warning-{uid}-2026-02-07",
+                    lambda uid=uid: marked.append(uid),
+                )
+            return outbox
+
+        marked = []
+        rejected = '{"data": [{"id": "r1"}, {"id": "r3"}], "errors": [{"index": 1, "message": "Invalid `to` field"}]}'
+        with patch.object(heartbeat, "_post_json_with_retries", return_value=_DummyResponse(200, rejected)) as mock_post:
+            _outbox(marked).flush()
+        mock_post.assert_called_once()
+        self.assertEqual(mock_post.call_args.kwargs["headers"]["x-batch-validation"], "permissive")
+        self.assertEqual(marked, ["u-1", "u-3"])
+
+        marked = []
+        posts = []
+
+        def _post(url, *, headers, payload, idempotency_key=None):
+            posts.append((url, idempotency_key))
+            if url.endswith("/batch"):
+                return _DummyResponse(400, "validation_error")
+            if payload["to"] == ["u-2@example.com"]:
+                return _DummyResponse(422, "bad address")
+            return _DummyResponse(200, '{"id": "r"}')
+
+        with patch.object(heartbeat, "_post_json_with_retries", side_effect=_post):
+            _outbox(marked).flush()
+        self.assertEqual(posts[1:], [
+            ("https://api.resend.com/emails", f"warning-{uid}-2026-02-07") for uid in ("u-1", "u-2", "u-3")
+        ])
+        self.assertEqual(marked, ["u-1", "u-3"])
+
+        # An ambiguous batch failure may have delivered the batch: nothing is
+        # resent under another key and nothing is marked, so the next run retries.
+        marked = []
+        with patch.object(heartbeat, "_post_json_with_retries", return_value=_DummyResponse(503, "down")) as mock_post:
+            _outbox(marked).flush()
+        mock_post.assert_called_once()
+        self.assertEqual(marked, [])
+
+        # Retries bypass the outbox and go out under their own key.
+        outbox = heartbeat.NotificationOutbox("rk")
+        with (
+            patch.object(heartbeat, "_notification_outbox", outbox),
+            patch.object(heartbeat, "send_email") as mock_send,
+        ):
+            heartbeat.send_notification_email(
+                "rk", "f@x.com", "a@example.com", "s", "t", "<p>h</p>",
+                idempotency_key="downgrade-retry-u-1-2026-02-07", batchable=False,
+            )
+        mock_send.assert_called_once()
+        self.assertEqual(len(outbox), 0)
+
+    def test_delivery_batch_queue_rejected_email_does_not_block_other_users(self):
+        import json
+        from concurrent.futures import ThreadPoolExecutor
+
+        posts = []
+
+        def _post(url, *, headers, payload, idempotency_key=None):
+            posts.append((headers, list(payload)))
+            bad = [i for i, p in enumerate(payload) if p["entry"] == "a1"]
+            data = [{"id": f"r-{p['entry']}"} for p in payload if p["entry"] != "a1"]
+            errors = [{"index": i, "message": "Invalid `to` field"} for i in bad]
+            return _DummyResponse(200, json.dumps({"data": data, "errors": errors}))
+
+        queue = heartbeat.DeliveryBatchQueue("rk", linger_seconds=5)
+        chunks = {
+            "u1": [("a1", {"entry": "a1"}), ("a2", {"entry": "a2"})],
+            "u2": [("b1", {"entry": "b1"}), ("b2", {"entry": "b2"})],
+        }
+        with (
+            patch.object(heartbeat, "RESEND_BATCH_LIMIT", 4),
+            patch.object(heartbeat, "_post_json_with_retries", side_effect=_post),
+            ThreadPoolExecutor(max_workers=2) as pool,
+        ):
+            futures = {user: pool.submit(queue.send, items) for user, items in chunks.items()}
+            results = {user: future.result(timeout=5) for user, future in futures.items()}
+
+        self.assertEqual(len(posts), 1)
+        self.assertEqual(posts[0][0]["x-batch-validation"], "permissive")
+        self.assertEqual(results, {"u1": ([None, "r-a2"], False), "u2": (["r-b1", "r-b2"], False)})
+
+        # Inside the pipeline only the rejected entry is released.
+        released, marked = [], []
+        now = datetime(2026, 2, 7, 10, 0, tzinfo=timezone.utc)
+        rejecting_queue = types.SimpleNamespace(send=lambda items: ([None] + ["r"] * (len(items) - 1), False))
+        with (
+            patch.object(heartbeat, "_run_delivery_queue", rejecting_queue),
+            patch.object(heartbeat, "claim_entry_for_sending", return_value=True),
+            patch.object(heartbeat, "release_entry_lock", side_effect=lambda _c, eid: released.append(eid)),
+            patch.object(heartbeat, "decrypt_with_server_secret", return_value=b"ben@example.com"),
+            patch.object(heartbeat, "build_unlock_email_payload", return_value={"mock": True}),
+            patch.object(heartbeat, "mark_entry_sent", side_effect=lambda _c, eid, _n: marked.append(eid) or True),
+            patch.object(heartbeat, "send_executed_push", return_value=True),
+        ):
+            heartbeat.process_expired_entries(
+                client=object(), profile={"id": "u-q", "hmac_key_encrypted": None},
+                entries=self._streaming_entries(2),
+                server_secret="s", resend_key="rk", from_email="f@x.com",
+                viewer_base_url="https://v.x", fcm_ctx=None, now=now,
+            )
+        self.assertEqual(released, ["e-0"])
+        self.assertEqual(marked, ["e-1"])
+
+    def test_rejected_shared_batch_falls_back_to_the_users_own_batch(self):
+        posts = []
+
+        def _post(url, *, headers, payload, idempotency_key=None):
+            posts.append(idempotency_key)
+            return _DummyResponse(422 if len(posts) == 1 else 200, '{"data": []}')
+
+        marked = []
+        now = datetime(2026, 2, 7, 10, 0, tzinfo=timezone.utc)
+        with (
+            patch.object(heartbeat, "_run_delivery_queue", heartbeat.DeliveryBatchQueue("rk", linger_seconds=0.01)),
+            patch.object(heartbeat, "claim_entry_for_sending", return_value=True),
+            patch.object(heartbeat, "release_entry_lock"),
+            patch.object(heartbeat, "decrypt_with_server_secret", return_value=b"ben@example.com"),
+            patch.object(heartbeat, "build_unlock_email_payload", return_value={"mock": True}),
+            patch.object(heartbeat, "mark_entry_sent", side_effect=lambda _c, eid, _n: marked.append(eid) or True),
+            patch.object(heartbeat, "send_executed_push", return_value=True),
+            patch.object(heartbeat, "_post_json_with_retries", side_effect=_post),
+        ):
+            heartbeat.process_expired_entries(
+                client=object(), profile={"id": "u-q", "hmac_key_encrypted": None},
+                entries=self._streaming_entries(2),
+                server_secret="s", resend_key="rk", from_email="f@x.com",
+                viewer_base_url="https://v.x", fcm_ctx=None, now=now,
+            )
+
+        self.assertEqual(len(posts), 2)
+        self.assertTrue(posts[1].startswith("unlock-batch-u-q-"))
+        self.assertEqual(marked, ["e-0", "e-1"])
+
+    def test_ambiguous_shared_batch_failure_releases_instead_of_resending(self):
+        for failure in (_DummyResponse(503, "unavailable"), heartbeat.requests.Timeout("read timed out")):
+            with self.subTest(failure=failure):
+                posts, marked, released = [], [], []
+
+                def _post(url, *, headers, payload, idempotency_key=None):
+                    posts.append(idempotency_key)
+                    if isinstance(failure, Exception):
+                        raise failure
+                    return failure
+
+                now = datetime(2026, 2, 7, 10, 0, tzinfo=timezone.utc)
+                with (
+                    patch.object(heartbeat, "_run_delivery_queue", heartbeat.DeliveryBatchQueue("rk", linger_seconds=0.01)),
+                    patch.object(heartbeat, "claim_entry_for_sending", return_value=True),
+                    patch.object(heartbeat, "release_entry_lock", side_effect=lambda _c, eid: released.append(eid)),
+                    patch.object(heartbeat, "decrypt_with_server_secret", return_value=b"ben@example.com"),
+                    patch.object(heartbeat, "build_unlock_email_payload", return_value={"mock": True}),
+                    patch.object(heartbeat, "mark_entry_sent", side_effect=lambda _c, eid, _n: marked.append(eid) or True),
+                    patch.object(heartbeat, "send_executed_push", return_value=True),
+                    patch.object(heartbeat, "_post_json_with_retries", side_effect=_post),
+                ):
+                    heartbeat.process_expired_entries(
+                        client=object(), profile={"id": "u-q", "hmac_key_encrypted": None},
+                        entries=self._streaming_entries(2),
+                        server_secret="s", resend_key="rk", from_email="f@x.com",
+                        viewer_base_url="https://v.x", fcm_ctx=None, now=now,
+                    )
+
+                # Only the shared key was tried; the next run retries the entries.
+                self.assertEqual(len(posts), 1)
+                self.assertTrue(posts[0].startswith("unlock-batch-"))
+                self.assertEqual(marked, [])
+                self.assertEqual(sorted(released), ["e-0", "e-1"])
+
+    def test_resend_throttle_spaces_calls_across_threads(self):
+        clock = {"now": 100.0}
+        sleeps = []
+
+        def _sleep(seconds):
+            sleeps.append(round(seconds, 3))
+            clock["now"] += seconds
+
+        with (
+            patch.object(heartbeat, "_resend_next_call_at", 0.0),
+            patch.object(heartbeat, "_resend_call_interval", 0.5),
+            patch.object(heartbeat.time, "monotonic", side_effect=lambda: clock["now"]),
+            patch.object(heartbeat.time, "sleep", side_effect=_sleep),
+        ):
+            heartbeat._throttle_resend()  # first call goes straight out
+            heartbeat._throttle_resend()  # fast response: waits out the interval
+            clock["now"] += 2.0           # idle long enough: no wait
+            heartbeat._throttle_resend()
+            heartbeat._throttle_resend()
+
+        self.assertEqual(sleeps, [0.5, 0.5])
+
+    def test_shard_workers_split_the_resend_rate_between_them(self):
+        with (
+            patch.object(heartbeat, "_rc_call_interval", heartbeat.RC_VERIFY_RATE_LIMIT_DELAY),
+            patch.object(heartbeat, "_resend_call_interval", heartbeat.RESEND_MIN_REQUEST_INTERVAL),
+            patch.object(heartbeat, "_resend_request_slots", heartbeat._resend_request_slots),
+        ):
+            heartbeat._divide_rate_limits(4)
+            # Four workers at one call every 2s each stay at 2 req/s in total.
+            self.assertEqual(heartbeat._resend_call_interval, 2.0)
+            self.assertAlmostEqual(4 / heartbeat._resend_call_interval, 1 / heartbeat.RESEND_MIN_REQUEST_INTERVAL)
+            self.assertAlmostEqual(heartbeat._rc_call_interval, heartbeat.RC_VERIFY_RATE_LIMIT_DELAY * 4)
+
+    def test_second_leasing_runner_skips_startup_and_closing_passes(self):
+        import tempfile
+
+        ran = []
+        with tempfile.TemporaryDirectory() as tmp:
+            path = str(Path(tmp) / "leases.json")
+            first = heartbeat.build_lease_context(None, 2, path)
+            second = heartbeat.build_lease_context(None, 2, path)
+
+            for phase in ("startup", "closing"):
+                self.assertTrue(heartbeat.run_singleton_passes(first, phase, lambda p=phase: ran.append(("first", p))))
+                # Held for the rest of the cycle after the first runner finished.
+                self.assertFalse(heartbeat.run_singleton_passes(second, phase, lambda p=phase: ran.append(("second", p))))
+
+            with (
+                patch.object(heartbeat, "cleanup_sent_entries") as mock_cleanup,
+                patch.object(heartbeat, "cleanup_bot_accounts") as mock_bots,
+            ):
+                self.assertFalse(heartbeat.run_singleton_passes(
+                    second, "closing",
+                    lambda: heartbeat.run_closing_passes(
+                        object(), server_secret="s", resend_key="rk",
+                        from_email="f@x.com", viewer_base_url="https://v.x",
+                    ),
+                ))
+            mock_cleanup.assert_not_called()
+            mock_bots.assert_not_called()
+
+        self.assertEqual(ran, [("first", "startup"), ("first", "closing")])
+        # A runner without leases is the only runner.
+        self.assertTrue(heartbeat.run_singleton_passes(None, "closing", lambda: ran.append(("solo", "closing"))))
+        self.assertEqual(ran[-1], ("solo", "closing"))
+
+    def test_runtime_planner_projects_the_unscanned_rest_of_the_run(self):
+        planner = heartbeat.RuntimePlanner(1000, expected_profiles=10000)
+        self.assertEqual(planner.remaining_scan_seconds(), 0.0)
+        self.assertFalse(planner.should_defer("push_66"))
+
+        planner.record_scan(200, 30.0)  # 0.15s per scanned profile
+        self.assertAlmostEqual(planner.remaining_scan_seconds(), 9800 * 0.15)
+        self.assertAlmostEqual(
+            planner.projected_seconds(),
+            heartbeat.PLANNER_POST_PASS_RESERVE_SECONDS + 9800 * 0.15,
+        )
+        self.assertTrue(planner.should_defer("push_66"))
+
+        self.assertEqual(heartbeat._planner_op_for_url("https://api.resend.com/emails/batch"), "email_chunk")
+        self.assertEqual(heartbeat._planner_op_for_url("https://api.resend.com/emails"), "email")
+        self.assertEqual(
+            heartbeat._planner_op_for_url("https://fcm.googleapis.com/v1/projects/p/messages:send"), "push",
+        )
+        self.assertEqual(heartbeat._planner_op_for_url("https://example.com/hook"), "http_post")
+
+    def test_store_run_summary_drops_deferred_passes_without_sql_71(self):
+        inserted = []
+        outage = []
+
+        class _Runs:
+            def insert(self, row):
+                self.row = row
+                return self
+
+            def execute(self):
+                if outage:
+                    raise RuntimeError("connection reset")
+                if "deferred_passes" in self.row:
+                    raise RuntimeError("Could not find the 'deferred_passes' column of 'heartbeat_runs'")
+                inserted.append(self.row)
+
+        client = types.SimpleNamespace(table=lambda _name: _Runs())
+        heartbeat.store_run_summary(client, {"exit_reason": "completed", "deferred_passes": '{"push_66": 3}'})
+        self.assertEqual(inserted, [{"exit_reason": "completed"}])
+
+        # Other failures still surface to the caller.
+        outage.append(True)
+        with self.assertRaises(RuntimeError):
+            heartbeat.store_run_summary(client, {"exit_reason": "completed", "deferred_passes": "{}"})
+
+    def test_run_profile_pass_evaluates_timers_once_per_batch(self):
+        now = datetime.now(timezone.utc)
+        overdue = (now - timedelta(days=40)).isoformat()
+        page = [
+            {"id": "idle", "last_check_in": now.isoformat(), "timer_days": 30, "status": "active"},
+            {"id": "late", "last_check_in": overdue, "timer_days": 30, "status": "active"},
+        ]
+        entries = {"late": [{"id": "e1", "status": "active"}], "idle": [{"id": "e2", "status": "active"}]}
+        classified = []
+
+        def _classify(batch, _entries, _now, **kwargs):
+            classified.append(([p["id"] for p in batch], kwargs["flags"].expired))
+            return [heartbeat.WORK_DELIVERY] * len(batch)
+
+        with (
+            patch.dict("os.environ", {"HEARTBEAT_PROFILE_CONCURRENCY": "1", "HEARTBEAT_PREFETCH_BATCHES": "0"}),
+            patch.object(heartbeat, "iter_profiles_for_scan", return_value=iter([page])),
+            patch.object(heartbeat, "load_profile_batch", side_effect=lambda _c, p, _m: (p, entries, 2)),
+            patch.object(heartbeat, "load_profile_contacts"),
+            patch.object(heartbeat, "process_profile_batch"),
+            patch.object(heartbeat, "classify_profile_work", side_effect=_classify),
+            patch.object(heartbeat, "evaluate_timer_batch", wraps=heartbeat.evaluate_timer_batch) as mock_eval,
+        ):
+            heartbeat.run_profile_pass(
+                types.SimpleNamespace(), server_secret="s", resend_key="r", from_email="f",
+                viewer_base_url="v", fcm_ctx=None, rc_api_secret="",
+            )
+
+        mock_eval.assert_called_once()
+        self.assertEqual(classified, [(["late"], [True])])
+
+    def test_ciphertext_load_failure_leaves_window_active_and_keeps_going(self):
+        heartbeat._reset_metrics()
+        loads = []
+        claimed = []
+
+        def _load(_client, entries):
+            loads.append([e["id"] for e in entries])
+            if len(loads) == 1:
+                raise RuntimeError("statement timeout")
+
+        now = datetime(2026, 2, 7, 10, 0, tzinfo=timezone.utc)
+        with (
+            patch.object(heartbeat, "RESEND_BATCH_LIMIT", 2),
+            patch.object(heartbeat, "RESEND_INTER_CHUNK_DELAY", 0),
+            patch.object(heartbeat, "load_entry_ciphertexts", side_effect=_load),
+            patch.object(heartbeat, "claim_entry_for_sending", side_effect=lambda _c, eid: claimed.append(eid) or True),
+            patch.object(heartbeat, "release_entry_lock"),
+            patch.object(heartbeat, "decrypt_with_server_secret", return_value=b"ben@example.com"),
+            patch.object(heartbeat, "build_unlock_email_payload", return_value={"mock": True}),
+            patch.object(heartbeat, "_post_json_with_retries", return_value=_DummyResponse(200, '{"data": []}')),
+            patch.object(heartbeat, "mark_entry_sent", return_value=True),
+            patch.object(heartbeat, "send_executed_push", return_value=True),
+        ):
+            had_send, _ = heartbeat.process_expired_entries(
+                client=object(), profile={"id": "u-load", "hmac_key_encrypted": None},
+                entries=self._streaming_entries(4),
+                server_secret="s", resend_key="rk", from_email="f@x.com",
+                viewer_base_url="https://v.x", fcm_ctx=None, now=now,
+            )
+
+        self.assertTrue(had_send)
+        self.assertEqual(loads, [["e-0", "e-1"], ["e-2", "e-3"]])
+        # The failed window was never claimed, so it stays active.
+        self.assertEqual(claimed, ["e-2", "e-3"])
+        self.assertTrue(any("statement timeout" in e for e in heartbeat._metrics["errors"]))
+        heartbeat._reset_metrics()
+
+    def test_embedded_profile_scan_orders_entries_without_touching_the_profile_order(self):
+        from postgrest import SyncPostgrestClient
+
+        seen_params = []
+
+        def _execute(builder):
+            seen_params.append(builder.params)
+            return types.SimpleNamespace(data=[])
+
+        client = SyncPostgrestClient("http://localhost:1")
+        with patch.object(type(client.from_("profiles").select("id")), "execute", _execute):
+            list(heartbeat.iter_profiles_for_scan(
+                types.SimpleNamespace(table=client.from_), "full",
+                now=datetime(2026, 3, 5, tzinfo=timezone.utc), embed_entries=True, start_after="m",
+            ))
+
+        params = seen_params[0]
+        self.assertEqual(params.get_list("order"), ["id"])
+        self.assertEqual(params["vault_entries.order"], "id")
+        self.assertEqual(params["vault_entries.status"], "eq.active")
+        self.assertEqual(params["id"], "gt.m")
+
+
 
 if __name__ == "__main__":
     unittest.main()
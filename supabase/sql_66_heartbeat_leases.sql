@@ -0,0 +1,96 @@
+-- ╔══════════════════════════════════════════════════════════════════════════╗
+-- ║  sql_66 — Heartbeat shard leases                                       ║
+-- ║  Lets several heartbeat runners share one run: each runner claims a    ║
+-- ║  profile-id shard with an expiry, renews it between batches, and       ║
+-- ║  holds it briefly after finishing so the shard is not reprocessed in   ║
+-- ║  the same cycle.  Safe to re-run (idempotent).                         ║
+-- ╚══════════════════════════════════════════════════════════════════════════╝
+
+-- 1. Lease table (service_role only)
+CREATE TABLE IF NOT EXISTS heartbeat_leases (
+  shard_key   text        PRIMARY KEY,
+  holder      text        NOT NULL,
+  expires_at  timestamptz NOT NULL,
+  updated_at  timestamptz NOT NULL DEFAULT now()
+);
+
+ALTER TABLE heartbeat_leases ENABLE ROW LEVEL SECURITY;
+REVOKE ALL ON TABLE heartbeat_leases FROM anon, authenticated;
+
+-- 2. heartbeat_claim_lease() — take a free/expired lease (or re-take our own)
+CREATE OR REPLACE FUNCTION public.heartbeat_claim_lease(
+  p_shard_key   text,
+  p_holder      text,
+  p_ttl_seconds int
+)
+RETURNS boolean
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public
+AS $$
+DECLARE
+  claimed_key text;
+BEGIN
+  INSERT INTO heartbeat_leases AS l (shard_key, holder, expires_at, updated_at)
+    VALUES (p_shard_key, p_holder, now() + make_interval(secs => p_ttl_seconds), now())
+  ON CONFLICT (shard_key) DO UPDATE
+    SET holder     = EXCLUDED.holder,
+        expires_at = EXCLUDED.expires_at,
+        updated_at = now()
+    WHERE l.expires_at <= now() OR l.holder = p_holder
+  RETURNING l.shard_key INTO claimed_key;
+
+  RETURN claimed_key IS NOT NULL;
+END;
+$$;
+
+-- 3. heartbeat_renew_lease() — extend a lease we still hold
+CREATE OR REPLACE FUNCTION public.heartbeat_renew_lease(
+  p_shard_key   text,
+  p_holder      text,
+  p_ttl_seconds int
+)
+RETURNS boolean
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public
+AS $$
+BEGIN
+  UPDATE heartbeat_leases
+    SET expires_at = now() + make_interval(secs => p_ttl_seconds),
+        updated_at = now()
+    WHERE shard_key = p_shard_key
+      AND holder = p_holder
+      AND expires_at > now();
+
+  RETURN FOUND;
+END;
+$$;
+
+-- 4. heartbeat_release_lease() — free a lease, or keep it for p_hold_seconds
+--    after a completed shard so other runners skip it this cycle
+CREATE OR REPLACE FUNCTION public.heartbeat_release_lease(
+  p_shard_key    text,
+  p_holder       text,
+  p_hold_seconds int DEFAULT 0
+)
+RETURNS void
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public
+AS $$
+BEGIN
+  UPDATE heartbeat_leases
+    SET expires_at = now() + make_interval(secs => GREATEST(p_hold_seconds, 0)),
+        updated_at = now()
+    WHERE shard_key = p_shard_key
+      AND holder = p_holder;
+END;
+$$;
+
+REVOKE ALL ON FUNCTION public.heartbeat_claim_lease(text, text, int) FROM public, anon, authenticated;
+REVOKE ALL ON FUNCTION public.heartbeat_renew_lease(text, text, int) FROM public, anon, authenticated;
+REVOKE ALL ON FUNCTION public.heartbeat_release_lease(text, text, int) FROM public, anon, authenticated;
+GRANT EXECUTE ON FUNCTION public.heartbeat_claim_lease(text, text, int) TO service_role;
+GRANT EXECUTE ON FUNCTION public.heartbeat_renew_lease(text, text, int) TO service_role;
+GRANT EXECUTE ON FUNCTION public.heartbeat_release_lease(text, text, int) TO service_role;
@@ -0,0 +1,64 @@
+-- ╔══════════════════════════════════════════════════════════════════════════╗
+-- ║  sql_67 — profiles.next_action_at due index                            ║
+-- ║  The heartbeat stores the earliest time each profile next has work     ║
+-- ║  (push, warning email, expiry, scheduled / Forever Letter delivery).   ║
+-- ║  `heartbeat.py --scan due` then fetches only rows where                ║
+-- ║  next_action_at <= now(), so run cost tracks due work, not user count. ║
+-- ║  Safe to re-run (idempotent).                                          ║
+-- ╚══════════════════════════════════════════════════════════════════════════╝
+
+-- 1. Column: new and existing profiles start out due
+ALTER TABLE profiles ADD COLUMN IF NOT EXISTS next_action_at timestamptz DEFAULT now();
+UPDATE profiles SET next_action_at = now() WHERE next_action_at IS NULL;
+ALTER TABLE profiles ALTER COLUMN next_action_at SET NOT NULL;
+
+-- 2. Due index (active profiles only — the heartbeat never scans others by due time)
+CREATE INDEX IF NOT EXISTS idx_profiles_active_next_action
+  ON profiles (next_action_at) WHERE status = 'active';
+
+-- 3. Make a profile due again whenever a user-driven change could create
+--    earlier work.  Heartbeat-owned columns (push_*_sent_at, warning_sent_at)
+--    are deliberately excluded.  The heartbeat writes next_action_at only if
+--    it still holds the value it read, so these resets are never lost.
+CREATE OR REPLACE FUNCTION public.reset_next_action_on_profile_change()
+RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+  IF new.last_check_in IS DISTINCT FROM old.last_check_in
+     OR new.timer_days IS DISTINCT FROM old.timer_days
+     OR new.status IS DISTINCT FROM old.status
+     OR new.subscription_status IS DISTINCT FROM old.subscription_status
+     OR new.app_mode IS DISTINCT FROM old.app_mode
+     OR new.selected_theme IS DISTINCT FROM old.selected_theme
+     OR new.selected_soul_fire IS DISTINCT FROM old.selected_soul_fire
+     OR new.downgrade_email_pending IS DISTINCT FROM old.downgrade_email_pending
+     OR new.last_entry_at IS DISTINCT FROM old.last_entry_at THEN
+    new.next_action_at := now();
+  END IF;
+  RETURN new;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS profiles_reset_next_action ON profiles;
+CREATE TRIGGER profiles_reset_next_action
+BEFORE UPDATE ON profiles
+FOR EACH ROW EXECUTE FUNCTION public.reset_next_action_on_profile_change();
+
+-- 4. Entry changes that move a delivery date (new entries, edited
+--    scheduled_at / entry_mode, entries returned to 'active')
+CREATE OR REPLACE FUNCTION public.reset_next_action_on_entry_change()
+RETURNS trigger LANGUAGE plpgsql SECURITY DEFINER SET search_path = public AS $$
+BEGIN
+  IF tg_op = 'INSERT'
+     OR new.scheduled_at IS DISTINCT FROM old.scheduled_at
+     OR new.entry_mode IS DISTINCT FROM old.entry_mode
+     OR (new.status = 'active' AND old.status IS DISTINCT FROM 'active') THEN
+    UPDATE profiles SET next_action_at = now() WHERE id = new.user_id;
+  END IF;
+  RETURN new;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS vault_entries_reset_next_action ON vault_entries;
+CREATE TRIGGER vault_entries_reset_next_action
+AFTER INSERT OR UPDATE ON vault_entries
+FOR EACH ROW EXECUTE FUNCTION public.reset_next_action_on_entry_change();
@@ -0,0 +1,94 @@
+-- ╔══════════════════════════════════════════════════════════════════════════╗
+-- ║  sql_68 — heartbeat_timer_candidates() RPC                             ║
+-- ║  Server-side candidate filter for `heartbeat.py --scan candidates`.    ║
+-- ║  Returns active profiles that may have something actionable at p_now: ║
+-- ║  a due 66% / 33% push, a due 24h warning email, an expired timer, or   ║
+-- ║  non-timer work (Time Capsule mode, RevenueCat check, pending          ║
+-- ║  downgrade, Forever Letters).  Mirrors is_timer_candidate() in         ║
+-- ║  automation/heartbeat.py — change both together.  The heartbeat's      ║
+-- ║  should_send_* checks stay the source of truth for what is sent.       ║
+-- ║  Safe to re-run (idempotent).                                          ║
+-- ╚══════════════════════════════════════════════════════════════════════════╝
+
+CREATE OR REPLACE FUNCTION public.heartbeat_timer_candidates(
+  p_now                    timestamptz,
+  p_push_66_fraction       float8,
+  p_push_33_fraction       float8,
+  p_warning_window_seconds int,
+  p_include_rc_candidates  boolean DEFAULT true
+)
+RETURNS SETOF profiles
+LANGUAGE sql
+STABLE
+SECURITY DEFINER
+SET search_path = public
+AS $$
+  SELECT p.*
+  FROM profiles p
+  CROSS JOIN LATERAL (
+    SELECT greatest(1, COALESCE(p.timer_days, 30)) * 86400 AS total_seconds
+  ) t
+  CROSS JOIN LATERAL (
+    SELECT p.last_check_in + make_interval(secs => t.total_seconds) AS deadline
+  ) d
+  CROSS JOIN LATERAL (
+    SELECT (COALESCE(NULLIF(p.timer_days, 0), 30) <> 30
+            OR p.selected_theme NOT IN ('oledVoid', 'midnightFrost', 'shadowRose')
+            OR p.selected_soul_fire NOT IN ('etherealOrb', 'goldenPulse', 'nebulaHeart')
+           ) IS TRUE AS has_pro_indicators
+  ) pi
+  WHERE p.status = 'active'
+    AND (
+      -- Non-timer work: always hand these to the heartbeat
+      lower(COALESCE(p.app_mode, 'vault')) = 'scheduled'
+      OR p.last_check_in IS NULL
+      OR COALESCE(p.downgrade_email_pending, false)
+      -- RevenueCat verification (paid or pro indicators)
+      OR (p_include_rc_candidates
+          AND (lower(COALESCE(p.subscription_status, 'free')) IN ('pro', 'lifetime', 'premium')
+               OR pi.has_pro_indicators))
+      -- Downgrade still has pro artifacts to revert
+      OR (lower(COALESCE(p.subscription_status, 'free')) = 'free'
+          AND (pi.has_pro_indicators
+               OR EXISTS (
+                 SELECT 1 FROM vault_entries e
+                 WHERE e.user_id = p.id AND e.status = 'active'
+                   AND (e.data_type = 'audio'
+                        OR (COALESCE(e.entry_mode, 'standard') <> 'recurring'
+                            AND e.scheduled_at > p_now + interval '30 days'))
+               )))
+      -- Forever Letters
+      OR EXISTS (
+        SELECT 1 FROM vault_entries e
+        WHERE e.user_id = p.id AND e.status = 'active' AND e.entry_mode = 'recurring'
+      )
+      -- Timer work: only users with standard entries have a live timer
+      OR (
+        EXISTS (
+          SELECT 1 FROM vault_entries e
+          WHERE e.user_id = p.id AND e.status = 'active'
+            AND COALESCE(e.entry_mode, 'standard') <> 'recurring'
+        )
+        AND (
+          -- expired (remaining whole seconds <= 0)
+          d.deadline - p_now < interval '1 second'
+          -- 66% push
+          OR (p_now >= p.last_check_in + make_interval(
+                secs => greatest(0, least(1, 1 - p_push_66_fraction)) * t.total_seconds)
+              AND NOT COALESCE(p.push_66_sent_at >= p.last_check_in, false))
+          -- 33% push
+          OR (p_now >= p.last_check_in + make_interval(
+                secs => greatest(0, least(1, 1 - p_push_33_fraction)) * t.total_seconds)
+              AND NOT COALESCE(p.push_33_sent_at >= p.last_check_in, false))
+          -- 24h warning email (paid only)
+          OR (lower(COALESCE(p.subscription_status, 'free')) IN ('pro', 'lifetime', 'premium')
+              AND p_now >= greatest(d.deadline - make_interval(secs => p_warning_window_seconds),
+                                    p.last_check_in)
+              AND NOT COALESCE(p.warning_sent_at >= p.last_check_in, false))
+        )
+      )
+    );
+$$;
+
+REVOKE ALL ON FUNCTION public.heartbeat_timer_candidates(timestamptz, float8, float8, int, boolean) FROM public, anon, authenticated;
+GRANT EXECUTE ON FUNCTION public.heartbeat_timer_candidates(timestamptz, float8, float8, int, boolean) TO service_role;
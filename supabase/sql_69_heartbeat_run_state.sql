@@ -0,0 +1,19 @@
+-- ╔══════════════════════════════════════════════════════════════════════════╗
+-- ║  sql_69 — Heartbeat run state (resume checkpoints)                     ║
+-- ║  `heartbeat.py --resume` records the last fully processed profile id   ║
+-- ║  per scan / shard here.  A run that hits its time budget or is         ║
+-- ║  restarted after an error continues from that id and wraps around,     ║
+-- ║  so users late in the keyspace are not starved.                        ║
+-- ║  Safe to re-run (idempotent).                                          ║
+-- ╚══════════════════════════════════════════════════════════════════════════╝
+
+-- 1. Checkpoint table (service_role only)
+CREATE TABLE IF NOT EXISTS heartbeat_run_state (
+  scan_key         text        PRIMARY KEY,
+  last_profile_id  text,
+  updated_at       timestamptz NOT NULL DEFAULT now()
+);
+
+ALTER TABLE heartbeat_run_state ENABLE ROW LEVEL SECURITY;
+REVOKE ALL ON TABLE heartbeat_run_state FROM public, anon, authenticated;
+GRANT SELECT, INSERT, UPDATE, DELETE ON TABLE heartbeat_run_state TO service_role;
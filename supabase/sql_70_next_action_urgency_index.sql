@@ -0,0 +1,10 @@
+-- ╔══════════════════════════════════════════════════════════════════════════╗
+-- ║  sql_70 — Urgency-ordered due scan                                     ║
+-- ║  `heartbeat.py --scan due --order urgency` pages through due profiles  ║
+-- ║  by (next_action_at, id), most overdue first.  This index serves both  ║
+-- ║  the sort and the keyset seek.  Requires sql_67.                       ║
+-- ║  Safe to re-run (idempotent).                                          ║
+-- ╚══════════════════════════════════════════════════════════════════════════╝
+
+CREATE INDEX IF NOT EXISTS idx_profiles_active_next_action_id
+  ON profiles (next_action_at, id) WHERE status = 'active';
@@ -0,0 +1,66 @@
+-- ╔══════════════════════════════════════════════════════════════════════════╗
+-- ║  sql_71 — Add deferred_passes column to heartbeat_runs                 ║
+-- ║  The heartbeat's runtime planner sheds optional passes (heal guards,   ║
+-- ║  routine RevenueCat checks, 66% pushes, bot cleanup) when the          ║
+-- ║  remaining work will not fit the time budget.  Each run records what   ║
+-- ║  it deferred as {"pass": count}.                                       ║
+-- ║  Safe to re-run (idempotent).                                          ║
+-- ╚══════════════════════════════════════════════════════════════════════════╝
+
+-- 1. Add column (no-op if already exists)
+ALTER TABLE heartbeat_runs ADD COLUMN IF NOT EXISTS deferred_passes jsonb NOT NULL DEFAULT '{}'::jsonb;
+
+-- 2. admin_list_heartbeat_runs — include deferred_passes
+CREATE OR REPLACE FUNCTION public.admin_list_heartbeat_runs(
+  p_limit  int DEFAULT 20,
+  p_offset int DEFAULT 0
+)
+RETURNS json
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public
+AS $$
+DECLARE
+  result      json;
+  total_count bigint;
+  runs_arr    json;
+  safe_limit  int := LEAST(GREATEST(p_limit, 1), 100);
+  safe_offset int := GREATEST(p_offset, 0);
+BEGIN
+  IF NOT public.is_admin() THEN
+    RAISE EXCEPTION 'not authorized';
+  END IF;
+
+  SELECT count(*) INTO total_count FROM heartbeat_runs;
+
+  SELECT COALESCE(json_agg(row_to_json(t)), '[]'::json) INTO runs_arr
+  FROM (
+    SELECT
+      hr.id, hr.started_at, hr.completed_at, hr.runtime_seconds,
+      hr.profiles_processed, hr.entries_seen,
+      hr.emails_sent, hr.emails_failed,
+      hr.pushes_sent, hr.pushes_failed,
+      hr.entries_delivered, hr.entries_destroyed,
+      hr.entries_cleaned_up, hr.bots_cleaned_up,
+      hr.recurring_sent, hr.scheduled_delivered,
+      hr.downgrades_processed, hr.rc_verifications,
+      hr.errors, hr.warnings, hr.cleanup_stats,
+      hr.resend_quota_exhausted, hr.exit_reason,
+      hr.deferred_passes,
+      hr.stdout_log, hr.created_at
+    FROM heartbeat_runs hr
+    ORDER BY hr.started_at DESC
+    LIMIT safe_limit
+    OFFSET safe_offset
+  ) t;
+
+  RETURN json_build_object(
+    'total', total_count,
+    'runs',  runs_arr
+  );
+END;
+$$;
+
+REVOKE ALL ON FUNCTION public.admin_list_heartbeat_runs(int, int) FROM public;
+REVOKE ALL ON FUNCTION public.admin_list_heartbeat_runs(int, int) FROM anon;
+GRANT EXECUTE ON FUNCTION public.admin_list_heartbeat_runs(int, int) TO authenticated;
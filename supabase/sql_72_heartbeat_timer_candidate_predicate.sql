@@ -0,0 +1,119 @@
+-- ╔══════════════════════════════════════════════════════════════════════════╗
+-- ║  sql_72 — heartbeat_is_timer_candidate() predicate                     ║
+-- ║  Splits the candidate test of heartbeat_timer_candidates() (sql_68)    ║
+-- ║  into a pure function of one profile row and its active entries'       ║
+-- ║  entry_mode / data_type / scheduled_at, so test_timer_candidates.sql   ║
+-- ║  can run it on the same fixtures as is_timer_candidate() in            ║
+-- ║  automation/heartbeat.py.  Also brings the SQL in line with Python:    ║
+-- ║  audio entries match case-insensitively (lower(data_type)), and the    ║
+-- ║  timer length is greatest(1, COALESCE(timer_days, 30)) days, like      ║
+-- ║  _normalize_timer_days().  Safe to re-run (idempotent).                ║
+-- ╚══════════════════════════════════════════════════════════════════════════╝
+
+CREATE OR REPLACE FUNCTION public.heartbeat_is_timer_candidate(
+  p                        profiles,
+  p_entry_modes            text[],
+  p_data_types             text[],
+  p_scheduled_ats          timestamptz[],
+  p_now                    timestamptz,
+  p_push_66_fraction       float8,
+  p_push_33_fraction       float8,
+  p_warning_window_seconds int,
+  p_include_rc_candidates  boolean DEFAULT true
+)
+RETURNS boolean
+LANGUAGE sql
+STABLE
+AS $$
+  WITH e AS (
+    SELECT COALESCE(m, 'standard') AS entry_mode, dt AS data_type, s AS scheduled_at
+    FROM unnest(p_entry_modes, p_data_types, p_scheduled_ats) AS u(m, dt, s)
+  ),
+  t AS (
+    SELECT greatest(1, COALESCE(p.timer_days, 30)) * 86400 AS total_seconds,
+           lower(COALESCE(p.subscription_status, 'free')) AS sub_status,
+           -- Same rule as _has_pro_indicators(): NULL or 0 days is the free 30
+           (COALESCE(NULLIF(p.timer_days, 0), 30) <> 30
+            OR p.selected_theme NOT IN ('oledVoid', 'midnightFrost', 'shadowRose')
+            OR p.selected_soul_fire NOT IN ('etherealOrb', 'goldenPulse', 'nebulaHeart')
+           ) IS TRUE AS has_pro_indicators
+  ),
+  d AS (
+    SELECT p.last_check_in + make_interval(secs => t.total_seconds) AS deadline FROM t
+  )
+  SELECT
+    -- Non-timer work: always hand these to the heartbeat
+    lower(COALESCE(p.app_mode, 'vault')) = 'scheduled'
+    OR p.last_check_in IS NULL
+    OR COALESCE(p.downgrade_email_pending, false)
+    -- RevenueCat verification (paid or pro indicators)
+    OR (p_include_rc_candidates
+        AND (t.sub_status IN ('pro', 'lifetime', 'premium') OR t.has_pro_indicators))
+    -- Downgrade still has pro artifacts to revert
+    OR (t.sub_status = 'free'
+        AND (t.has_pro_indicators
+             OR EXISTS (
+               SELECT 1 FROM e
+               WHERE lower(e.data_type) = 'audio'
+                  OR (e.entry_mode <> 'recurring' AND e.scheduled_at > p_now + interval '30 days')
+             )))
+    -- Forever Letters
+    OR EXISTS (SELECT 1 FROM e WHERE e.entry_mode = 'recurring')
+    -- Timer work: only users with standard entries have a live timer
+    OR (
+      EXISTS (SELECT 1 FROM e WHERE e.entry_mode <> 'recurring')
+      AND (
+        -- expired (remaining whole seconds <= 0)
+        d.deadline - p_now < interval '1 second'
+        -- 66% push
+        OR (p_now >= p.last_check_in + make_interval(
+              secs => greatest(0, least(1, 1 - p_push_66_fraction)) * t.total_seconds)
+            AND NOT COALESCE(p.push_66_sent_at >= p.last_check_in, false))
+        -- 33% push
+        OR (p_now >= p.last_check_in + make_interval(
+              secs => greatest(0, least(1, 1 - p_push_33_fraction)) * t.total_seconds)
+            AND NOT COALESCE(p.push_33_sent_at >= p.last_check_in, false))
+        -- 24h warning email (paid only)
+        OR (t.sub_status IN ('pro', 'lifetime', 'premium')
+            AND p_now >= greatest(d.deadline - make_interval(secs => p_warning_window_seconds),
+                                  p.last_check_in)
+            AND NOT COALESCE(p.warning_sent_at >= p.last_check_in, false))
+      )
+    )
+  FROM t, d;
+$$;
+
+CREATE OR REPLACE FUNCTION public.heartbeat_timer_candidates(
+  p_now                    timestamptz,
+  p_push_66_fraction       float8,
+  p_push_33_fraction       float8,
+  p_warning_window_seconds int,
+  p_include_rc_candidates  boolean DEFAULT true
+)
+RETURNS SETOF profiles
+LANGUAGE sql
+STABLE
+SECURITY DEFINER
+SET search_path = public
+AS $$
+  SELECT p.*
+  FROM profiles p
+  CROSS JOIN LATERAL (
+    SELECT array_agg(e.entry_mode) AS entry_modes,
+           array_agg(e.data_type) AS data_types,
+           array_agg(e.scheduled_at) AS scheduled_ats
+    FROM vault_entries e
+    WHERE e.user_id = p.id AND e.status = 'active'
+  ) e
+  WHERE p.status = 'active'
+    AND public.heartbeat_is_timer_candidate(
+      p, e.entry_modes, e.data_types, e.scheduled_ats,
+      p_now, p_push_66_fraction, p_push_33_fraction,
+      p_warning_window_seconds, p_include_rc_candidates
+    );
+$$;
+
+REVOKE ALL ON FUNCTION public.heartbeat_is_timer_candidate(profiles, text[], text[], timestamptz[], timestamptz, float8, float8, int, boolean) FROM public, anon, authenticated;
+GRANT EXECUTE ON FUNCTION public.heartbeat_is_timer_candidate(profiles, text[], text[], timestamptz[], timestamptz, float8, float8, int, boolean) TO service_role;
+REVOKE ALL ON FUNCTION public.heartbeat_timer_candidates(timestamptz, float8, float8, int, boolean) FROM public, anon, authenticated;
+GRANT EXECUTE ON FUNCTION public.heartbeat_timer_candidates(timestamptz, float8, float8, int, boolean) TO service_role;
@@ -0,0 +1,68 @@
+-- ╔══════════════════════════════════════════════════════════════════════════╗
+-- ║  Fixtures for heartbeat_is_timer_candidate() (sql_72)                  ║
+-- ║  Runs every fixture through the SQL predicate and raises on the first  ║
+-- ║  run if any result differs from `expected`.  The same fixture lines    ║
+-- ║  are parsed by automation/tests/test_heartbeat.py and run through      ║
+-- ║  is_timer_candidate(), so keep one fixture per line when editing.      ║
+-- ║  Read-only: nothing is inserted.                                       ║
+-- ╚══════════════════════════════════════════════════════════════════════════╝
+
+DO $$
+DECLARE
+  f        record;
+  got      boolean;
+  failures int := 0;
+BEGIN
+  FOR f IN
+    SELECT * FROM (VALUES
+      -- fixtures:begin
+      ('free-idle', '{"subscription_status": "free", "timer_days": 30, "last_check_in": "2026-02-28T00:00:00+00:00"}', '[{"entry_mode": "standard"}]', false),
+      ('free-no-entries', '{"subscription_status": "free", "timer_days": 30, "last_check_in": "2026-02-28T00:00:00+00:00"}', '[]', false),
+      ('free-timer-days-null', '{"subscription_status": "free", "timer_days": null, "last_check_in": "2026-02-28T00:00:00+00:00"}', '[{"entry_mode": null}]', false),
+      ('free-timer-days-zero', '{"subscription_status": "free", "timer_days": 0, "last_check_in": "2026-02-28T23:00:00+00:00"}', '[{"entry_mode": "standard"}]', false),
+      ('free-timer-days-zero-expired', '{"subscription_status": "free", "timer_days": 0, "last_check_in": "2026-02-27T00:00:00+00:00"}', '[{"entry_mode": "standard"}]', true),
+      ('free-custom-timer', '{"subscription_status": "free", "timer_days": 7, "last_check_in": "2026-02-28T23:00:00+00:00"}', '[{"entry_mode": "standard"}]', true),
+      ('free-custom-theme', '{"subscription_status": "free", "timer_days": 30, "selected_theme": "velvetAbyss", "last_check_in": "2026-02-28T00:00:00+00:00"}', '[]', true),
+      ('free-audio-lowercase', '{"subscription_status": "free", "timer_days": 30, "last_check_in": "2026-02-28T00:00:00+00:00"}', '[{"entry_mode": "standard", "data_type": "audio"}]', true),
+      ('free-audio-uppercase', '{"subscription_status": "free", "timer_days": 30, "last_check_in": "2026-02-28T00:00:00+00:00"}', '[{"entry_mode": "standard", "data_type": "AUDIO"}]', true),
+      ('free-scheduled-past-free-limit', '{"subscription_status": "free", "timer_days": 30, "last_check_in": "2026-02-28T00:00:00+00:00"}', '[{"entry_mode": "standard", "scheduled_at": "2026-04-15T00:00:00+00:00"}]', true),
+      ('free-scheduled-within-free-limit', '{"subscription_status": "free", "timer_days": 30, "last_check_in": "2026-02-28T00:00:00+00:00"}', '[{"entry_mode": "standard", "scheduled_at": "2026-03-15T00:00:00+00:00"}]', false),
+      ('free-forever-letter', '{"subscription_status": "free", "timer_days": 30, "last_check_in": "2026-02-28T00:00:00+00:00"}', '[{"entry_mode": "recurring"}]', true),
+      ('time-capsule-mode', '{"subscription_status": "free", "timer_days": 30, "app_mode": "Scheduled", "last_check_in": "2026-02-28T00:00:00+00:00"}', '[]', true),
+      ('never-checked-in', '{"subscription_status": "free", "timer_days": 30, "last_check_in": null}', '[]', true),
+      ('downgrade-pending', '{"subscription_status": "pro", "timer_days": 30, "downgrade_email_pending": true, "last_check_in": "2026-02-28T00:00:00+00:00"}', '[]', true),
+      ('pro-idle', '{"subscription_status": "pro", "timer_days": 7, "last_check_in": "2026-02-28T00:00:00+00:00"}', '[{"entry_mode": "standard"}]', false),
+      ('pro-push-66-due', '{"subscription_status": "pro", "timer_days": 7, "last_check_in": "2026-02-26T00:00:00+00:00"}', '[{"entry_mode": "standard"}]', true),
+      ('pro-push-66-sent', '{"subscription_status": "pro", "timer_days": 7, "last_check_in": "2026-02-26T00:00:00+00:00", "push_66_sent_at": "2026-02-26T01:00:00+00:00"}', '[{"entry_mode": "standard"}]', false),
+      ('pro-push-66-sent-last-cycle', '{"subscription_status": "pro", "timer_days": 7, "last_check_in": "2026-02-26T00:00:00+00:00", "push_66_sent_at": "2026-02-25T23:00:00+00:00"}', '[{"entry_mode": "standard"}]', true),
+      ('pro-push-33-due', '{"subscription_status": "pro", "timer_days": 7, "last_check_in": "2026-02-24T00:00:00+00:00", "push_66_sent_at": "2026-02-25T00:00:00+00:00"}', '[{"entry_mode": "standard"}]', true),
+      ('pro-warning-due', '{"subscription_status": "Lifetime", "timer_days": 7, "last_check_in": "2026-02-22T12:00:00+00:00", "push_66_sent_at": "2026-02-25T00:00:00+00:00", "push_33_sent_at": "2026-02-27T00:00:00+00:00"}', '[{"entry_mode": "standard"}]', true),
+      ('pro-warning-sent', '{"subscription_status": "pro", "timer_days": 7, "last_check_in": "2026-02-22T12:00:00+00:00", "push_66_sent_at": "2026-02-25T00:00:00+00:00", "push_33_sent_at": "2026-02-27T00:00:00+00:00", "warning_sent_at": "2026-02-28T13:00:00+00:00"}', '[{"entry_mode": "standard"}]', false),
+      ('free-warning-window', '{"subscription_status": "free", "timer_days": 30, "last_check_in": "2026-01-30T12:00:00+00:00", "push_66_sent_at": "2026-02-10T00:00:00+00:00", "push_33_sent_at": "2026-02-20T00:00:00+00:00"}', '[{"entry_mode": "standard"}]', false),
+      ('pro-expired', '{"subscription_status": "pro", "timer_days": 7, "last_check_in": "2026-02-21T00:00:00+00:00", "push_66_sent_at": "2026-02-24T00:00:00+00:00", "push_33_sent_at": "2026-02-26T00:00:00+00:00", "warning_sent_at": "2026-02-27T00:00:00+00:00"}', '[{"entry_mode": "standard"}]', true),
+      ('pro-expired-forever-letters-only', '{"subscription_status": "pro", "timer_days": 7, "last_check_in": "2026-02-21T00:00:00+00:00"}', '[{"entry_mode": "recurring"}]', true)
+      -- fixtures:end
+    ) AS fixtures(label, profile, entries, expected)
+  LOOP
+    SELECT public.heartbeat_is_timer_candidate(
+      jsonb_populate_record(NULL::profiles, f.profile::jsonb),
+      ARRAY(SELECT x.value->>'entry_mode' FROM jsonb_array_elements(f.entries::jsonb) WITH ORDINALITY x ORDER BY x.ordinality),
+      ARRAY(SELECT x.value->>'data_type' FROM jsonb_array_elements(f.entries::jsonb) WITH ORDINALITY x ORDER BY x.ordinality),
+      ARRAY(SELECT (x.value->>'scheduled_at')::timestamptz FROM jsonb_array_elements(f.entries::jsonb) WITH ORDINALITY x ORDER BY x.ordinality),
+      p_now => '2026-03-01T00:00:00+00:00',
+      p_push_66_fraction => 0.66,
+      p_push_33_fraction => 0.33,
+      p_warning_window_seconds => 86400,
+      p_include_rc_candidates => false
+    ) INTO got;
+    IF got IS DISTINCT FROM f.expected THEN
+      failures := failures + 1;
+      RAISE WARNING 'timer candidate fixture %: expected %, got %', f.label, f.expected, got;
+    END IF;
+  END LOOP;
+  IF failures > 0 THEN
+    RAISE EXCEPTION '% timer candidate fixture(s) failed', failures;
+  END IF;
+  RAISE NOTICE 'All timer candidate fixtures passed';
+END
+$$;